@@ -0,0 +1,455 @@
+"""
+Офлайн-бенчмарк конвейера обработки видео.
+
+Синтетические источники генерируются локально через ffmpeg lavfi
+(testsrc2 + речеподобный тон с паузами), шаг yt-dlp заменяется
+копированием локального файла — сеть не нужна. Для каждого источника
+замеряются этапы и сквозной путь create_highlights; результат — JSON.
+
+Примеры:
+    python -m benchmarks.bench_pipeline --lengths 30,120 --resolutions 1280x720 \\
+        --output bench.json
+    python -m benchmarks.bench_pipeline --baseline baseline.json --threshold 0.15
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+ALL_STAGES = ("download", "extract_audio", "transcribe", "render", "e2e")
+
+# Речеподобный сигнал: основной тон с гармониками, слоговая модуляция 4 Гц
+# и паузы 1.5 с каждые 6 с, чтобы VAD и разбиение по паузам работали как на речи
+SPEECH_LIKE_EXPR = (
+    "(0.3*sin(2*PI*(140+20*sin(2*PI*0.7*t))*t)"
+    "+0.15*sin(2*PI*(280+40*sin(2*PI*0.7*t))*t)"
+    "+0.08*sin(2*PI*(420+60*sin(2*PI*0.7*t))*t))"
+    "*(0.55+0.45*sin(2*PI*4*t))"
+    "*lt(mod(t,6),4.5)"
+)
+
+
+class PeakRssSampler:
+    """
+    Пиковая RSS процесса и суммарная RSS его дочерних процессов (ffmpeg,
+    пул транскрипции) за время блока. Опрос /proc; вне Linux — ru_maxrss.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_self = 0
+        self.peak_children = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "PeakRssSampler":
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self_rss = _proc_rss(os.getpid())
+        if self_rss is None:
+            self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.peak_self = max(self.peak_self, self_rss)
+        children = sum(_proc_rss(pid) or 0 for pid in _child_pids(os.getpid()))
+        self.peak_children = max(self.peak_children, children)
+
+
+def _proc_rss(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def _child_pids(parent: int) -> List[int]:
+    """Все потомки процесса (ffmpeg запускается напрямую, воркеры пула — тоже)"""
+    parents = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return []
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # Имя процесса в скобках может содержать пробелы — берём поля после ')'
+                fields = f.read().rsplit(")", 1)[1].split()
+            parents.setdefault(int(fields[1]), []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+
+    result = []
+    stack = [parent]
+    while stack:
+        for child in parents.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def generate_source(work_dir: Path, seconds: int, resolution: str) -> Path:
+    """Синтетическое видео H.264/AAC; повторно используется между запусками"""
+    path = work_dir / "sources" / f"testsrc_{resolution}_{seconds}s.mp4"
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp.mp4")
+    cmd = [
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={resolution}:rate=30:duration={seconds}",
+        "-f", "lavfi", "-i", f"aevalsrc=exprs='{SPEECH_LIKE_EXPR}':sample_rate=44100:duration={seconds}",
+        "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-shortest", str(tmp_path)
+    ]
+    subprocess.run(cmd, check=True)
+    tmp_path.replace(path)
+    return path
+
+
+def synthetic_highlights(seconds: float, count: int, clip_seconds: float):
+    """count хайлайтов длиной clip_seconds, равномерно по записи"""
+    from models.schemas import HighlightSegment
+
+    clip_seconds = min(clip_seconds, seconds / max(1, count))
+    step = seconds / count
+    return [
+        HighlightSegment(
+            start_time=round(i * step, 3),
+            end_time=round(i * step + clip_seconds, 3),
+            title=f"bench {i}"
+        )
+        for i in range(count)
+    ]
+
+
+def synthetic_transcription(seconds: float, words_per_second: float = 2.5) -> Dict:
+    """Транскрипция с равномерными словами — рендер не зависит от Whisper"""
+    segments = []
+    word_seconds = 1.0 / words_per_second
+    t = 0.0
+    index = 0
+    while t < seconds:
+        end = min(seconds, t + 4.0)
+        words = []
+        w = t
+        while w + word_seconds <= end:
+            words.append({
+                "word": f"слово{index}",
+                "start": w,
+                "end": w + word_seconds * 0.9,
+                "probability": 0.9
+            })
+            index += 1
+            w += word_seconds
+        segments.append({
+            "start": t,
+            "end": end,
+            "text": " ".join(word["word"] for word in words),
+            "confidence": -0.2,
+            "words": words
+        })
+        t = end
+    return {"segments": segments, "language": "ru", "text": "", "duration": seconds}
+
+
+class PipelineBench:
+    """Прогон этапов на одном синтетическом источнике"""
+
+    def __init__(self, work_dir: Path, args: argparse.Namespace):
+        self.work_dir = work_dir
+        self.args = args
+        self._transcriber = None
+
+    def _processor(self, run_dir: Path, source: Path, seconds: float):
+        """VideoProcessor с чистым кэшем загрузок и заглушкой yt-dlp"""
+        from services.video_processor import VideoProcessor
+
+        os.environ["UPLOAD_DIR"] = str(run_dir / "uploads")
+        processor = VideoProcessor()
+
+        def extract_info(video_url: str, ydl_opts: Dict) -> Dict:
+            return {
+                "id": source.stem,
+                "extractor_key": "Benchmark",
+                "duration": seconds,
+                "webpage_url": video_url
+            }
+
+        def download(info: Dict, key: str, ydl_opts: Dict) -> str:
+            target = processor.download_cache.cache_dir / f"{key}{source.suffix}"
+            shutil.copyfile(source, target)
+            return str(target)
+
+        processor._extract_info = extract_info
+        processor._download = download
+        return processor
+
+    async def transcriber(self):
+        """Модель загружается один раз и вне замеров"""
+        if self._transcriber is None:
+            # Кэш транскрипций отключён — иначе повторы замеряют чтение кэша
+            os.environ["TRANSCRIPTION_CACHE_ENABLED"] = "false"
+            from services.audio_transcriber import AudioTranscriber
+
+            self._transcriber = AudioTranscriber()
+            await self._transcriber.load_model()
+        return self._transcriber
+
+    def editor(self, run_dir: Path):
+        from services.video_editor import VideoEditor
+
+        os.environ["OUTPUT_DIR"] = str(run_dir / "outputs")
+        (run_dir / "outputs").mkdir(parents=True, exist_ok=True)
+        return VideoEditor()
+
+    async def run_stage(self, stage: str, source: Path, seconds: float) -> Dict:
+        run_dir = self.work_dir / "runs" / f"{stage}_{time.time_ns()}"
+        run_dir.mkdir(parents=True)
+        url = f"https://www.youtube.com/watch?v={source.stem}"
+        highlights = synthetic_highlights(seconds, self.args.clips, self.args.clip_seconds)
+        clip_media = sum(h.end_time - h.start_time for h in highlights)
+
+        try:
+            processor = self._processor(run_dir, source, seconds)
+            # Подготовка, не входящая в замер этапа
+            video_path = None
+            audio = None
+            if stage in ("extract_audio", "transcribe", "render"):
+                video_path = await processor.download_video(url)
+            if stage == "transcribe":
+                audio = await processor.extract_audio_pcm(video_path)
+            transcriber = await self.transcriber() if stage in ("transcribe", "e2e") else None
+            editor = self.editor(run_dir) if stage in ("render", "e2e") else None
+
+            with PeakRssSampler() as rss:
+                started = time.perf_counter()
+                media_seconds = seconds
+                output_bytes = 0
+
+                if stage == "download":
+                    video_path = await processor.download_video(url)
+                    output_bytes = os.path.getsize(video_path)
+                elif stage == "extract_audio":
+                    audio = await processor.extract_audio_pcm(video_path)
+                    output_bytes = audio.nbytes
+                elif stage == "transcribe":
+                    await transcriber.transcribe(audio)
+                elif stage == "render":
+                    clips = await editor.create_highlights(
+                        video_path, highlights, synthetic_transcription(seconds)
+                    )
+                    media_seconds = clip_media
+                    output_bytes = sum(os.path.getsize(p) for p in clips)
+                elif stage == "e2e":
+                    video_path = await processor.download_video(url)
+                    audio = await processor.extract_audio_pcm(video_path)
+                    transcription = await transcriber.transcribe(audio)
+                    clips = await editor.create_highlights(video_path, highlights, transcription)
+                    output_bytes = sum(os.path.getsize(p) for p in clips)
+
+                wall = time.perf_counter() - started
+
+            if video_path:
+                processor.release_video(video_path)
+
+            input_bytes = source.stat().st_size
+            return {
+                "wall_seconds": wall,
+                "media_seconds": media_seconds,
+                "realtime_factor": media_seconds / wall if wall > 0 else None,
+                "input_mb_per_second": input_bytes / wall / 1024 ** 2 if wall > 0 else None,
+                "output_bytes": output_bytes,
+                "peak_rss_mb": rss.peak_self / 1024 ** 2,
+                "peak_children_rss_mb": rss.peak_children / 1024 ** 2
+            }
+        finally:
+            if not self.args.keep:
+                shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def summarize(samples: List[Dict]) -> Dict:
+    """Медиана по повторам для времени, максимум — для памяти"""
+    wall = statistics.median(s["wall_seconds"] for s in samples)
+    first = samples[0]
+    return {
+        "repeats": len(samples),
+        "wall_seconds": round(wall, 4),
+        "wall_seconds_min": round(min(s["wall_seconds"] for s in samples), 4),
+        "media_seconds": first["media_seconds"],
+        "realtime_factor": round(first["media_seconds"] / wall, 3) if wall > 0 else None,
+        "input_mb_per_second": round(statistics.median(s["input_mb_per_second"] for s in samples), 3),
+        "output_bytes": first["output_bytes"],
+        "peak_rss_mb": round(max(s["peak_rss_mb"] for s in samples), 1),
+        "peak_children_rss_mb": round(max(s["peak_children_rss_mb"] for s in samples), 1)
+    }
+
+
+def environment_info() -> Dict:
+    def command_output(cmd: List[str]) -> Optional[str]:
+        try:
+            return subprocess.run(cmd, capture_output=True, text=True, check=True).stdout.splitlines()[0]
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            return None
+
+    settings = {
+        name: os.environ[name]
+        for name in sorted(os.environ)
+        if name.startswith(("RENDER_", "FFMPEG_", "TRANSCRIBE_", "VAD_", "SINGLE_PASS_", "AUDIO_"))
+    }
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": command_output(["ffmpeg", "-version"]),
+        "git_commit": command_output(["git", "rev-parse", "--short", "HEAD"]),
+        "settings": settings
+    }
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[Dict]:
+    """
+    Сравнение с базовым прогоном: регрессия — если время или пиковая
+    память выросли больше чем на threshold (доля)
+    """
+    base = {(r["case"], r["stage"]): r for r in baseline.get("results", [])}
+    rows = []
+    for result in current["results"]:
+        reference = base.get((result["case"], result["stage"]))
+        if reference is None:
+            continue
+        wall_ratio = result["wall_seconds"] / reference["wall_seconds"] if reference["wall_seconds"] else 1.0
+        rss_ratio = result["peak_rss_mb"] / reference["peak_rss_mb"] if reference["peak_rss_mb"] else 1.0
+        rows.append({
+            "case": result["case"],
+            "stage": result["stage"],
+            "baseline_wall_seconds": reference["wall_seconds"],
+            "wall_seconds": result["wall_seconds"],
+            "wall_ratio": round(wall_ratio, 3),
+            "rss_ratio": round(rss_ratio, 3),
+            "regression": wall_ratio > 1 + threshold or rss_ratio > 1 + threshold
+        })
+    return rows
+
+
+def print_table(results: List[Dict], comparison: Optional[List[Dict]]):
+    ratios = {(row["case"], row["stage"]): row for row in comparison or []}
+    header = f"{'case':<22} {'stage':<14} {'wall, s':>9} {'RTF':>8} {'RSS, MB':>9} {'child, MB':>10}"
+    if comparison is not None:
+        header += f" {'vs base':>9}"
+    print(header, file=sys.stderr)
+    for r in results:
+        line = (
+            f"{r['case']:<22} {r['stage']:<14} {r['wall_seconds']:>9.2f} "
+            f"{(r['realtime_factor'] or 0):>8.2f} {r['peak_rss_mb']:>9.1f} {r['peak_children_rss_mb']:>10.1f}"
+        )
+        row = ratios.get((r["case"], r["stage"]))
+        if row is not None:
+            line += f" {row['wall_ratio']:>8.2f}x" + ("  РЕГРЕССИЯ" if row["regression"] else "")
+        print(line, file=sys.stderr)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк конвейера нарезки")
+    parser.add_argument("--lengths", default="30,120", help="длительности источников, с")
+    parser.add_argument("--resolutions", default="1280x720", help="разрешения, через запятую")
+    parser.add_argument("--stages", default=",".join(ALL_STAGES), help="этапы, через запятую")
+    parser.add_argument("--repeat", type=int, default=3, help="повторов на этап (берётся медиана)")
+    parser.add_argument("--clips", type=int, default=3, help="хайлайтов на источник")
+    parser.add_argument("--clip-seconds", type=float, default=15.0, help="длина хайлайта, с")
+    parser.add_argument(
+        "--work-dir",
+        default=os.path.join(tempfile.gettempdir(), "narezka-bench"),
+        help="каталог источников и прогонов"
+    )
+    parser.add_argument("--output", help="файл для JSON с результатами (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON базового прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.10, help="допустимое ухудшение, доля")
+    parser.add_argument("--keep", action="store_true", help="не удалять файлы прогонов")
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    work_dir = Path(args.work_dir).resolve()
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(ALL_STAGES)
+    if unknown:
+        raise SystemExit(f"Неизвестные этапы: {', '.join(sorted(unknown))}")
+
+    bench = PipelineBench(work_dir, args)
+    results = []
+    for resolution in args.resolutions.split(","):
+        for seconds in (int(value) for value in args.lengths.split(",")):
+            source = generate_source(work_dir, seconds, resolution)
+            case = f"{resolution}_{seconds}s"
+            for stage in stages:
+                samples = [await bench.run_stage(stage, source, seconds) for _ in range(args.repeat)]
+                result = dict(case=case, stage=stage, resolution=resolution, **summarize(samples))
+                results.append(result)
+                print(
+                    f"{case} {stage}: {result['wall_seconds']:.2f} с, RTF {result['realtime_factor']}",
+                    file=sys.stderr
+                )
+
+    return {"environment": environment_info(), "results": results}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+
+    comparison = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare(report, baseline, args.threshold)
+        report["comparison"] = {"baseline": args.baseline, "threshold": args.threshold, "rows": comparison}
+
+    print_table(report["results"], comparison)
+
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(data, encoding="utf-8")
+    else:
+        print(data)
+
+    regressions = [row for row in comparison or [] if row["regression"]]
+    if regressions:
+        print(f"Регрессий: {len(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
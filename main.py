@@ -1,26 +1,45 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse
-from pydantic import BaseModel, HttpUrl
-from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from typing import Optional
+from collections import OrderedDict
 import os
-import json
+import asyncio
 import uuid
+from urllib.parse import quote
 from datetime import datetime
 import logging
 from dotenv import load_dotenv
 
-from services.video_processor import VideoProcessor
-from services.audio_transcriber import AudioTranscriber
-from services.video_editor import VideoEditor
 from models.schemas import (
     VideoProcessRequest, 
-    TranscriptionResponse, 
+    BatchProcessRequest,
     HighlightRequest, 
-    ProcessingStatus
+    HighlightDetectionRequest,
+    HighlightProposal,
+    RenderUpgradeRequest
 )
-from utils.exceptions import VideoProcessingError
+from utils.exceptions import AdmissionRejected
 from utils.validators import validate_video_url
-from fastapi.responses import FileResponse
+from utils.http_range import parse_range
+from utils.zip_stream import ZipStreamWriter, iter_file
+from utils.media_probe import range_errors
+from utils.metrics import ADMISSION_BACKLOG, BYTES_WRITTEN, QUEUE_DEPTH, Span, render_metrics
+from utils.render_profiles import get_render_profile
+from utils.transcription_store import TranscriptionStore
+from utils import transcription_view
+from services.task_store import get_task_store
+from services.job_queue import JOB_ROUTES, get_job_queue
+from services.progress import TERMINAL_STATUSES, get_progress_bus, is_terminal, sse_format
+from services.storage import CLIPS_TTL, CONSUMED_GRACE, get_storage_manager
+from services.admission import (
+    get_admission_controller,
+    highlight_seconds,
+    render_cost,
+    transcribe_cost
+)
+from services.pipeline import get_video_processor
+from services.highlight_detector import DEFAULT_WEIGHTS, HighlightDetector
 
 load_dotenv()
 
@@ -34,19 +53,87 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# Инициализация сервисов
-video_processor = VideoProcessor()
-audio_transcriber = AudioTranscriber()
-video_editor = VideoEditor()
+# Хранилище задач, общее для всех процессов (SQLite/WAL или Redis)
+task_store = get_task_store()
+
+# Очередь заданий: download / transcribe / render (Celery или в процессе API)
+job_queue = get_job_queue()
+
+# События прогресса от воркеров для SSE
+progress_bus = get_progress_bus()
+
+# Учёт файлов задач: ссылки на время отдачи клипов, сроки хранения и квоты
+storage = get_storage_manager()
+
+# Приём заданий с учётом стоимости: 429 с Retry-After, когда пулы воркеров заняты
+admission = get_admission_controller()
+
+# Заголовок с идентификатором клиента для справедливого деления очереди;
+# без него клиентом считается IP-адрес
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "X-Client-Id")
+
+# Сколько ссылок пакета одновременно опрашивается за метаданными
+METADATA_CONCURRENCY = int(os.getenv("METADATA_CONCURRENCY", "8"))
+
+# Сколько разобранных транскрипций держать в памяти API: интерфейс выбора
+# хайлайтов запрашивает окна одной и той же транскрипции много раз подряд
+TRANSCRIPTION_CACHE_ENTRIES = int(os.getenv("TRANSCRIPTION_CACHE_ENTRIES", "4"))
+_transcriptions: "OrderedDict[str, TranscriptionStore]" = OrderedDict()
+
+# Максимальный размер страницы транскрипции (сегментов)
+TRANSCRIPTION_PAGE_MAX = int(os.getenv("TRANSCRIPTION_PAGE_MAX", "1000"))
+
+# Фоновая очистка файлов задач; достаточно одного процесса на том с данными
+STORAGE_SWEEPER = os.getenv("STORAGE_SWEEPER", "true").lower() in ("1", "true", "yes")
+
+# Интервал keep-alive комментариев в потоке SSE (секунды)
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
 
-# Хранилище задач (в продакшене лучше использовать Redis)
-tasks_storage = {}
+# Максимальное число ссылок в одном пакетном запросе
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "100"))
+
+# Как часто потоковый ZIP проверяет появление новых клипов во время рендеринга
+ZIP_POLL_INTERVAL = float(os.getenv("ZIP_POLL_INTERVAL", "1.0"))
+
+@app.on_event("startup")
+async def start_storage_sweeper():
+    if STORAGE_SWEEPER:
+        app.state.storage_sweeper = asyncio.create_task(storage.run_sweeper())
+
+@app.on_event("shutdown")
+async def stop_storage_sweeper():
+    sweeper = getattr(app.state, "storage_sweeper", None)
+    if sweeper is not None:
+        sweeper.cancel()
+
+def _client_id(http_request: Request) -> str:
+    client = http_request.headers.get(ADMISSION_CLIENT_HEADER)
+    if client:
+        return client
+    return http_request.client.host if http_request.client else "unknown"
+
+def _admit(pool: str, http_request: Request, jobs: dict):
+    """Приём заданий (task_id -> стоимость) или 429 с Retry-After"""
+    try:
+        return admission.admit(pool, _client_id(http_request), jobs)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+async def _video_duration(video_url: str) -> Optional[float]:
+    """Длительность по метаданным yt-dlp; None — оценка по умолчанию"""
+    try:
+        metadata = await get_video_processor().fetch_metadata(video_url)
+        return metadata["duration"]
+    except Exception as e:
+        logger.warning(f"Длительность {video_url} неизвестна, беру оценку по умолчанию: {str(e)}")
+        return None
 
 @app.post("/api/v1/process-video", response_model=dict)
-async def process_video(
-    request: VideoProcessRequest,
-    background_tasks: BackgroundTasks
-):
+async def process_video(request: VideoProcessRequest, http_request: Request):
     """
     Первый этап: обработка видео и извлечение таймкодов с текстом
     """
@@ -56,20 +143,33 @@ async def process_video(
         
         # Генерация уникального ID задачи
         task_id = str(uuid.uuid4())
+
+        # Стоимость оценивается по длительности из метаданных, до скачивания
+        duration = await _video_duration(str(request.video_url))
+        admitted = _admit("transcribe", http_request, {task_id: transcribe_cost(duration)})
         
-        # Сохранение статуса задачи
-        tasks_storage[task_id] = {
-            "status": "processing",
-            "created_at": datetime.now().isoformat(),
-            "video_url": request.video_url
-        }
-        
-        # Запуск фоновой задачи
-        background_tasks.add_task(
-            process_video_background, 
-            task_id, 
-            request.video_url
-        )
+        try:
+            # Сохранение статуса задачи
+            task_store.create(task_id, {
+                "status": "processing",
+                "stage": "queued_download",
+                "created_at": datetime.now().isoformat(),
+                "video_url": str(request.video_url),
+                "estimated_duration": duration,
+                "priority": admitted.priority
+            })
+
+            # Постановка в очередь скачивания; транскрипция пойдёт следом в свою очередь
+            await job_queue.submit(
+                "download",
+                priority=admitted.priority,
+                task_id=task_id,
+                video_url=str(request.video_url)
+            )
+        except Exception:
+            # Задание не попало в очередь и не должно занимать место в приёме
+            admission.release(task_id)
+            raise
         
         return {
             "task_id": task_id,
@@ -77,71 +177,365 @@ async def process_video(
             "message": "Видео поставлено в очередь на обработку"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при обработке видео: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/v1/process-videos", response_model=dict)
+async def process_videos(request: BatchProcessRequest, http_request: Request):
+    """
+    Пакетная обработка: каждое видео становится отдельной задачей в конвейере.
+    Этапы разных видео перекрываются: пока транскрибируется видео N,
+    скачивается видео N+1.
+    """
+    if not request.video_urls:
+        raise HTTPException(status_code=400, detail="Список ссылок пуст")
+    if len(request.video_urls) > BATCH_MAX_URLS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Слишком много ссылок: {len(request.video_urls)} (максимум {BATCH_MAX_URLS})"
+        )
+    for video_url in request.video_urls:
+        validate_video_url(video_url)
+
+    # Пакет принимается целиком или отклоняется целиком
+    semaphore = asyncio.Semaphore(METADATA_CONCURRENCY)
+
+    async def duration_of(video_url) -> Optional[float]:
+        async with semaphore:
+            return await _video_duration(str(video_url))
+
+    durations = await asyncio.gather(*(duration_of(url) for url in request.video_urls))
+    task_ids = [str(uuid.uuid4()) for _ in request.video_urls]
+    admitted = _admit("transcribe", http_request, {
+        task_id: transcribe_cost(duration) for task_id, duration in zip(task_ids, durations)
+    })
+
+    submitted = set()
+    try:
+        batch_id = str(uuid.uuid4())
+        created_at = datetime.now().isoformat()
+
+        for task_id, video_url, duration in zip(task_ids, request.video_urls, durations):
+            task_store.create(task_id, {
+                "status": "processing",
+                "stage": "queued_download",
+                "created_at": created_at,
+                "video_url": str(video_url),
+                "batch_id": batch_id,
+                "estimated_duration": duration,
+                "priority": admitted.priority
+            })
+
+        task_store.create(batch_id, {
+            "type": "batch",
+            "created_at": created_at,
+            "task_ids": task_ids
+        })
+
+        # Видео ставятся в очередь скачивания в порядке запроса
+        for task_id, video_url in zip(task_ids, request.video_urls):
+            await job_queue.submit(
+                "download",
+                priority=admitted.priority,
+                task_id=task_id,
+                video_url=str(video_url)
+            )
+            submitted.add(task_id)
+
+        return {
+            "batch_id": batch_id,
+            "task_ids": task_ids,
+            "status": "processing",
+            "message": f"{len(task_ids)} видео поставлено в очередь на обработку"
+        }
+
+    except Exception as e:
+        # Поставленные в очередь задания освободят место сами по завершении
+        for task_id in task_ids:
+            if task_id not in submitted:
+                admission.release(task_id)
+        logger.error(f"Ошибка при пакетной обработке видео: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/v1/batch-status/{batch_id}")
+async def get_batch_status(batch_id: str):
+    """
+    Сводный статус пакета: число задач по статусам и статус каждой задачи
+    """
+    batch = task_store.get(batch_id)
+    if batch is None or batch.get("type") != "batch":
+        raise HTTPException(status_code=404, detail="Пакет не найден")
+
+    tasks = {}
+    counts = {}
+    for task_id in batch["task_ids"]:
+        task = task_store.get(task_id) or {"status": "unknown"}
+        tasks[task_id] = {
+            "status": task["status"],
+            "stage": task.get("stage"),
+            "video_url": task.get("video_url"),
+            "error": task.get("error")
+        }
+        counts[task["status"]] = counts.get(task["status"], 0) + 1
+
+    return {
+        "batch_id": batch_id,
+        "created_at": batch["created_at"],
+        "total": len(batch["task_ids"]),
+        "counts": counts,
+        "tasks": tasks
+    }
+
 @app.get("/api/v1/task-status/{task_id}")
 async def get_task_status(task_id: str):
     """
     Получение статуса задачи
     """
-    if task_id not in tasks_storage:
+    task = task_store.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="Задача не найдена")
     
-    return tasks_storage[task_id]
+    return task
+
+@app.get("/api/v1/task-events/{task_id}")
+async def task_events(task_id: str):
+    """
+    Поток событий задачи (Server-Sent Events) вместо частого опроса статуса:
+    snapshot — текущая запись, progress — прогресс этапа (скачивание,
+    транскрипция, рендеринг), status — изменения записи. Поток закрывается
+    после завершения или ошибки задачи.
+    """
+    if task_store.get(task_id) is None:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+
+    async def event_stream():
+        # Подписка до чтения снимка, чтобы не потерять события между ними
+        subscription = await progress_bus.subscribe(task_id)
+        try:
+            task = task_store.get(task_id)
+            yield sse_format("snapshot", task)
+            if is_terminal(task):
+                return
+
+            while True:
+                event = await subscription.get(timeout=SSE_HEARTBEAT_INTERVAL)
+                if event is None:
+                    # Событие о завершении могло потеряться (Pub/Sub без гарантий доставки)
+                    task = task_store.get(task_id)
+                    if is_terminal(task):
+                        yield sse_format("status", dict(task, type="status"))
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield sse_format(event["type"], event)
+                if event["type"] == "status" and event.get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            await subscription.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def _load_transcription(task_id: str) -> TranscriptionStore:
+    store = _transcriptions.get(task_id)
+    if store is None:
+        transcription = await asyncio.to_thread(task_store.get_payload, task_id, "transcription")
+        if transcription is None:
+            raise HTTPException(status_code=404, detail="Транскрипция не найдена")
+        store = await asyncio.to_thread(TranscriptionStore.from_dict, transcription)
+        _transcriptions[task_id] = store
+        while len(_transcriptions) > TRANSCRIPTION_CACHE_ENTRIES:
+            _transcriptions.popitem(last=False)
+    _transcriptions.move_to_end(task_id)
+    return store
 
 @app.get("/api/v1/transcription/{task_id}")
-async def get_transcription(task_id: str):
+async def get_transcription(
+    task_id: str,
+    request: Request,
+    start: Optional[float] = Query(None, ge=0, description="Начало окна, секунды"),
+    end: Optional[float] = Query(None, gt=0, description="Конец окна, секунды"),
+    detail: str = Query("words", pattern="^(words|segments)$"),
+    limit: Optional[int] = Query(None, ge=1, description="Сегментов на странице"),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы")
+):
     """
-    Получение результата транскрипции
+    Получение результата транскрипции. Без параметров — целиком, как раньше
+    (тайминги без округления). start/end — только сегменты, пересекающиеся с окном; detail=segments — без
+    слов; limit/cursor — постраничная выдача. Формат выбирается по Accept:
+    application/json, application/x-ndjson (строка на сегмент) или
+    application/msgpack; при Accept-Encoding: gzip ответ сжимается. ETag
+    позволяет повторно запрашивать окно условным GET (304).
     """
-    if task_id not in tasks_storage:
+    task = task_store.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="Задача не найдена")
     
-    task = tasks_storage[task_id]
     if task["status"] != "completed":
         raise HTTPException(status_code=400, detail="Задача ещё не завершена")
-    
-    if "transcription" not in task:
-        raise HTTPException(status_code=404, detail="Транскрипция не найдена")
-    
-    return task["transcription"]
+
+    if start is not None and end is not None and end <= start:
+        raise HTTPException(status_code=422, detail="end должен быть больше start")
+    if limit is not None and limit > TRANSCRIPTION_PAGE_MAX:
+        raise HTTPException(
+            status_code=422,
+            detail=f"limit не больше {TRANSCRIPTION_PAGE_MAX}"
+        )
+
+    # Завершённая транскрипция не меняется: ETag проверяется до чтения данных
+    version = f"{task_id}:{task.get('completed_at')}"
+    media_type = transcription_view.negotiate(request.headers.get("accept"))
+    gzip_enabled = transcription_view.accepts_gzip(request.headers.get("accept-encoding"))
+    etag = transcription_view.make_etag(
+        version, start, end, detail, limit, cursor, media_type, gzip_enabled
+    )
+    headers = {
+        "ETag": etag,
+        # Клиент хранит ответ, но перед использованием сверяет ETag
+        "Cache-Control": "private, no-cache",
+        "Vary": "Accept, Accept-Encoding"
+    }
+    if transcription_view.etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    window = (start, end, detail)
+    offset = transcription_view.decode_cursor(cursor, version, window) if cursor else 0
+    # Новое представление (окно, страницы, без слов) — с таймингами до миллисекунд;
+    # полный документ отдаётся как раньше, без округления
+    windowed = any(value is not None for value in (start, end, limit, cursor))
+    store = await _load_transcription(task_id)
+    indices, next_offset = transcription_view.select_page(store, start, end, offset, limit)
+    segments = transcription_view.page_segments(
+        store, indices, words=detail == "words", round_times=windowed or detail != "words"
+    )
+
+    header = dict(store.extra)
+    if windowed:
+        # Полный текст всей записи в каждой странице не нужен
+        header.pop("full_text", None)
+        header.update(
+            window={"start": start, "end": end},
+            detail=detail,
+            next_cursor=(
+                transcription_view.encode_cursor(next_offset, version, window)
+                if next_offset is not None else None
+            )
+        )
+
+    body = await asyncio.to_thread(transcription_view.encode_page, media_type, header, segments)
+    body = await asyncio.to_thread(transcription_view.maybe_gzip, body, headers, gzip_enabled)
+    BYTES_WRITTEN.labels("transcription").inc(len(body))
+    return Response(content=body, media_type=media_type, headers=headers)
+
+@app.post("/api/v1/detect-highlights")
+async def detect_highlights(request: HighlightDetectionRequest):
+    """
+    Автоподбор хайлайтов по громкости и возбуждению звука, плотности и
+    разборчивости речи и ключевым словам. Результат можно передать в
+    /api/v1/create-highlights без изменений
+    """
+    task = task_store.get(request.original_task_id)
+    if task is None:
+        raise HTTPException(status_code=404, detail="Оригинальная задача не найдена")
+    if task["status"] != "completed":
+        raise HTTPException(status_code=400, detail="Оригинальная задача не завершена")
+
+    unknown = set(request.weights or {}) - set(DEFAULT_WEIGHTS)
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Неизвестные сигналы: {', '.join(sorted(unknown))}. "
+                   f"Доступны: {', '.join(DEFAULT_WEIGHTS)}"
+        )
+
+    store = await _load_transcription(request.original_task_id)
+    # Огибающей нет у задач, транскрибированных до появления детектора:
+    # тогда оценка строится только по речи
+    features = await asyncio.to_thread(
+        task_store.get_payload, request.original_task_id, "audio_features"
+    )
+    detector = HighlightDetector(request.weights)
+    highlights = await asyncio.to_thread(
+        detector.detect,
+        store,
+        features,
+        request.count,
+        request.min_duration,
+        request.max_duration,
+        request.keywords
+    )
+    return {
+        "original_task_id": request.original_task_id,
+        "audio_features": features is not None,
+        "highlights": [HighlightProposal(**h).dict() for h in highlights]
+    }
 
 @app.post("/api/v1/create-highlights")
-async def create_highlights(
-    request: HighlightRequest,
-    background_tasks: BackgroundTasks
-):
+async def create_highlights(request: HighlightRequest, http_request: Request):
     """
     Второй этап: создание видео с лучшими моментами
     """
     try:
         # Проверка существования оригинальной задачи
-        if request.original_task_id not in tasks_storage:
+        original_task = task_store.get(request.original_task_id)
+        if original_task is None:
             raise HTTPException(status_code=404, detail="Оригинальная задача не найдена")
         
-        original_task = tasks_storage[request.original_task_id]
         if original_task["status"] != "completed":
             raise HTTPException(status_code=400, detail="Оригинальная задача не завершена")
+
+        # Диапазоны сверяются с реальной длительностью источника до постановки
+        # в очередь, а не после падения ffmpeg
+        media = original_task.get("media") or {}
+        errors = range_errors(
+            media.get("duration"),
+            [(h.start_time, h.end_time) for h in request.highlights]
+        )
+        if errors:
+            raise HTTPException(status_code=422, detail=errors)
         
         # Генерация нового ID для задачи создания хайлайтов
         highlight_task_id = str(uuid.uuid4())
-        
-        tasks_storage[highlight_task_id] = {
-            "status": "processing",
-            "created_at": datetime.now().isoformat(),
-            "type": "highlight_creation",
-            "original_task_id": request.original_task_id
-        }
-        
-        # Запуск фоновой задачи создания хайлайтов
-        background_tasks.add_task(
-            create_highlights_background,
-            highlight_task_id,
-            request.original_task_id,
-            request.highlights
+
+        # Стоимость — суммарная длительность клипов с учётом профиля
+        cost = render_cost(
+            highlight_seconds(request.highlights),
+            get_render_profile(request.profile).cost_factor
         )
+        admitted = _admit("render", http_request, {highlight_task_id: cost})
+        
+        try:
+            task_store.create(highlight_task_id, {
+                "status": "processing",
+                "stage": "queued_render",
+                "created_at": datetime.now().isoformat(),
+                "type": "highlight_creation",
+                "original_task_id": request.original_task_id,
+                "highlights": [h.dict() for h in request.highlights],
+                "profile": request.profile,
+                "priority": admitted.priority
+            })
+
+            # Постановка в очередь рендеринга
+            await job_queue.submit(
+                "render",
+                priority=admitted.priority,
+                highlight_task_id=highlight_task_id,
+                original_task_id=request.original_task_id,
+                highlights=[h.dict() for h in request.highlights],
+                profile=request.profile
+            )
+        except Exception:
+            # Задание не попало в очередь и не должно занимать место в приёме
+            admission.release(highlight_task_id)
+            raise
         
         return {
             "task_id": highlight_task_id,
@@ -149,109 +543,264 @@ async def create_highlights(
             "message": "Создание хайлайтов запущено"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при создании хайлайтов: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/v1/download/{task_id}")
-async def download_video(task_id: str):
-    """
-    Скачивание готового архива хайлайтов
-    """
-    if task_id not in tasks_storage:
+def _get_highlight_task(task_id: str) -> dict:
+    task = task_store.get(task_id)
+    if task is None or task.get("type") != "highlight_creation":
         raise HTTPException(status_code=404, detail="Задача не найдена")
+    return task
 
-    task = tasks_storage[task_id]
-    if task["status"] != "completed" or "output_file" not in task:
-        raise HTTPException(status_code=400, detail="Задача ещё не завершена или файл не найден")
-
-    file_path = task["output_file"]
-    
-    if not isinstance(file_path, str):
-        raise HTTPException(status_code=500, detail="Неверный формат пути к файлу")
-    
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Файл не найден на диске")
+@app.post("/api/v1/upgrade-render/{task_id}")
+async def upgrade_render(
+    task_id: str,
+    http_request: Request,
+    request: RenderUpgradeRequest = RenderUpgradeRequest()
+):
+    """
+    Перерендер черновика (профиль preview) в другом качестве: субтитры и
+    скачанные фрагменты черновика используются повторно
+    """
+    preview_task = _get_highlight_task(task_id)
+    if preview_task["status"] != "completed":
+        raise HTTPException(status_code=400, detail="Рендеринг черновика ещё не завершён")
+    if not preview_task.get("upgradable"):
+        raise HTTPException(status_code=400, detail="Задача отрендерена не в профиле preview")
+    # Без фрагментов (режим full) нужен закреплённый исходник: скачивать заново не будем
+    if not preview_task.get("sources") and not get_video_processor().has_video(
+        preview_task.get("source_path")
+    ):
+        raise HTTPException(
+            status_code=409,
+            detail="Исходное видео черновика уже удалено, перерендер недоступен"
+        )
 
-    return FileResponse(
-        path=file_path,
-        filename=os.path.basename(file_path),
-        media_type="application/zip"
+    highlight_task_id = str(uuid.uuid4())
+    cost = render_cost(
+        highlight_seconds(preview_task["highlights"]),
+        get_render_profile(request.profile).cost_factor
     )
+    admitted = _admit("render", http_request, {highlight_task_id: cost})
 
-async def process_video_background(task_id: str, video_url: str):
-    """
-    Фоновая задача обработки видео
-    """
     try:
-        logger.info(f"Начинаю обработку видео {video_url}")
-        
-        # Скачивание видео
-        video_path = await video_processor.download_video(video_url)
-        
-        # Извлечение аудио
-        audio_path = await video_processor.extract_audio(video_path)
-        
-        # Транскрипция
-        transcription = await audio_transcriber.transcribe(audio_path)
-        
-        # Обновление статуса
-        tasks_storage[task_id].update({
-            "status": "completed",
-            "completed_at": datetime.now().isoformat(),
-            "transcription": transcription,
-            "video_path": video_path,
-            "audio_path": audio_path
+        task_store.create(highlight_task_id, {
+            "status": "processing",
+            "stage": "queued_render",
+            "created_at": datetime.now().isoformat(),
+            "type": "highlight_creation",
+            "original_task_id": preview_task["original_task_id"],
+            "highlights": preview_task["highlights"],
+            "profile": request.profile,
+            "upgraded_from": task_id,
+            "priority": admitted.priority
         })
-        
-        logger.info(f"Обработка видео {task_id} завершена")
-        
+
+        await job_queue.submit(
+            "render",
+            priority=admitted.priority,
+            highlight_task_id=highlight_task_id,
+            original_task_id=preview_task["original_task_id"],
+            highlights=preview_task["highlights"],
+            profile=request.profile,
+            upgrade_from=task_id
+        )
+
+        return {
+            "task_id": highlight_task_id,
+            "status": "processing",
+            "message": f"Перерендер в профиле {request.profile} запущен"
+        }
+
     except Exception as e:
-        logger.error(f"Ошибка при обработке видео {task_id}: {str(e)}")
-        tasks_storage[task_id].update({
-            "status": "failed",
-            "error": str(e),
-            "failed_at": datetime.now().isoformat()
-        })
+        admission.release(highlight_task_id)
+        logger.error(f"Ошибка при перерендере {task_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-async def create_highlights_background(
-    highlight_task_id: str, 
-    original_task_id: str, 
-    highlights: List[dict]
-):
+def _clips_dir(task: dict) -> str:
+    return task.get("clips_dir") or os.path.dirname(task["clips"][0]["file"])
+
+def _release_after(token: str, chunks):
+    """Отдача файла под ссылкой: очистка не удалит каталог посреди ответа"""
+    try:
+        yield from chunks
+    finally:
+        storage.release(token)
+
+def _content_disposition(filename: str) -> str:
+    # Имена клипов берутся из названий видео и могут быть не в ASCII (RFC 5987)
+    fallback = filename.encode('ascii', 'replace').decode().replace('"', '_')
+    return f'attachment; filename="{fallback}"; filename*=UTF-8\'\'{quote(filename)}'
+
+@app.get("/api/v1/clips/{task_id}")
+async def list_clips(task_id: str):
     """
-    Фоновая задача создания хайлайтов
+    Список готовых клипов: доступен во время рендеринга, клипы появляются
+    по мере готовности
+    """
+    task = _get_highlight_task(task_id)
+    return {
+        "task_id": task_id,
+        "status": task["status"],
+        "profile": task.get("profile"),
+        "clips_total": task.get("clips_total"),
+        "clips": [
+            {
+                "index": clip["index"],
+                "name": clip["name"],
+                "size": clip["size"],
+                "title": clip.get("title"),
+                "url": f"/api/v1/clips/{task_id}/{clip['index']}"
+            }
+            for clip in task.get("clips", [])
+        ]
+    }
+
+@app.get("/api/v1/clips/{task_id}/{index}")
+async def download_clip(task_id: str, index: int, request: Request):
     """
+    Скачивание одного клипа с поддержкой HTTP Range (докачка, перемотка в плеере)
+    """
+    task = _get_highlight_task(task_id)
+    clip = next((c for c in task.get("clips", []) if c["index"] == index), None)
+    if clip is None:
+        raise HTTPException(status_code=404, detail="Клип ещё не готов или не существует")
+
+    file_path = clip["file"]
+    clips_dir = _clips_dir(task)
     try:
-        logger.info(f"Создаю хайлайты для задачи {original_task_id}")
-        
-        original_task = tasks_storage[original_task_id]
-        video_path = original_task["video_path"]
-        transcription = original_task["transcription"]
-        
-        # Создание видео с хайлайтами
-        output_path = await video_editor.create_highlights(
-            video_path,
-            highlights,
-            transcription
+        size = os.path.getsize(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=410, detail="Клипы удалены по истечении срока хранения")
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": _content_disposition(clip["name"])
+    }
+
+    # Диапазон проверяется до ссылки: ответ 416 ничего не удерживает
+    byte_range = parse_range(request.headers.get("range"), size)
+    if byte_range is None:
+        start, end, status_code = 0, size - 1, 200
+        headers["Content-Length"] = str(size)
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+    token = storage.acquire(clips_dir)
+    try:
+        # Файл мог удалить очиститель до того, как появилась ссылка
+        if not os.path.exists(file_path):
+            raise HTTPException(status_code=410, detail="Клипы удалены по истечении срока хранения")
+        storage.touch(clips_dir, ttl=CLIPS_TTL)
+        # Ссылка снимается и по окончании потока, и фоновой задачей ответа:
+        # если клиент отключился до первого чанка, генератор не запускается
+        return StreamingResponse(
+            _release_after(token, iter_file(file_path, start, end)),
+            status_code=status_code,
+            media_type="video/mp4",
+            headers=headers,
+            background=BackgroundTask(storage.release, token)
         )
-        
-        # Обновление статуса
-        tasks_storage[highlight_task_id].update({
-            "status": "completed",
-            "completed_at": datetime.now().isoformat(),
-            "output_file": output_path
-        })
-        
-        logger.info(f"Хайлайты для задачи {highlight_task_id} созданы")
-        
-    except Exception as e:
-        logger.error(f"Ошибка при создании хайлайтов {highlight_task_id}: {str(e)}")
-        tasks_storage[highlight_task_id].update({
-            "status": "failed",
-            "error": str(e),
-            "failed_at": datetime.now().isoformat()
-        })
+    except BaseException:
+        storage.release(token)
+        raise
+
+async def _stream_clips_zip(task_id: str):
+    """
+    ZIP_STORED из готовых клипов без архива на диске. Если рендеринг ещё идёт,
+    клипы добавляются в архив по мере готовности.
+    """
+    writer = ZipStreamWriter()
+    sent = set()
+    # Хранилища синхронные: обращения к ним — в потоке, не в event loop
+    task = await asyncio.to_thread(task_store.get, task_id)
+    clips_dir = task.get("clips_dir")
+    token = await asyncio.to_thread(storage.acquire, clips_dir) if clips_dir else None
+    with Span("zip_stream"):
+        try:
+            while True:
+                task = await asyncio.to_thread(task_store.get, task_id)
+                pending = [c for c in task.get("clips", []) if c["index"] not in sent]
+
+                for clip in pending:
+                    sent.add(clip["index"])
+                    mtime = os.path.getmtime(clip["file"])
+                    yield writer.local_header(clip["name"], clip["size"], clip["crc32"], mtime)
+                    chunks = iter_file(clip["file"])
+                    while True:
+                        chunk = await asyncio.to_thread(next, chunks, None)
+                        if chunk is None:
+                            break
+                        yield chunk
+
+                if not pending:
+                    if task["status"] == "completed":
+                        break
+                    if task["status"] == "failed":
+                        # Статус уже отправлен: завершаем поток без центрального каталога,
+                        # такой архив не откроется как целый
+                        logger.error(
+                            f"Архив {task_id} оборван: рендеринг завершился с ошибкой: "
+                            f"{task.get('error')}"
+                        )
+                        return
+                    await asyncio.sleep(ZIP_POLL_INTERVAL)
+
+            yield writer.central_directory()
+
+            # Архив отдан целиком — клипы больше не нужны. Черновик остаётся
+            # до истечения срока: по нему можно запустить чистовой рендеринг
+            if clips_dir and not task.get("upgradable"):
+                await asyncio.to_thread(storage.expire_after, clips_dir, CONSUMED_GRACE)
+        finally:
+            BYTES_WRITTEN.labels("zip").inc(writer.offset)
+            if token:
+                storage.release(token)
+
+@app.get("/api/v1/download/{task_id}")
+async def download_video(task_id: str):
+    """
+    Скачивание архива хайлайтов. Архив собирается на лету из файлов клипов;
+    отдача начинается до окончания рендеринга всех клипов.
+    """
+    task = await asyncio.to_thread(_get_highlight_task, task_id)
+    if task["status"] == "failed":
+        raise HTTPException(status_code=400, detail=f"Задача завершилась с ошибкой: {task.get('error')}")
+
+    for clip in task.get("clips", []):
+        if not os.path.exists(clip["file"]):
+            raise HTTPException(status_code=410, detail="Клипы удалены по истечении срока хранения")
+
+    headers = {"Content-Disposition": _content_disposition(f"highlights_{task_id}.zip")}
+    if task["status"] == "completed":
+        # Все размеры известны — длина архива точная
+        headers["Content-Length"] = str(ZipStreamWriter.archive_size(
+            [(clip["name"], clip["size"]) for clip in task["clips"]]
+        ))
+
+    return StreamingResponse(
+        _stream_clips_zip(task_id),
+        media_type="application/zip",
+        headers=headers
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики Prometheus: время и realtime factor этапов, байты, очереди, ffmpeg, модели"""
+    for queue in set(JOB_ROUTES.values()):
+        try:
+            QUEUE_DEPTH.labels(queue).set(await job_queue.depth(queue))
+        except Exception as e:
+            logger.warning(f"Не удалось получить длину очереди {queue}: {str(e)}")
+    for pool, backlog in admission.backlog().items():
+        ADMISSION_BACKLOG.labels(pool).set(backlog)
+    data, content_type = render_metrics()
+    return Response(content=data, headers={"Content-Type": content_type})
 
 @app.get("/")
 async def root():
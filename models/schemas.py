@@ -1,12 +1,24 @@
 # models/schemas.py
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, HttpUrl, validator
 from typing import List, Optional, Dict, Any
 from datetime import datetime
 
+from utils.render_profiles import RENDER_PROFILES
+
+
+def _check_profile(value: Optional[str]) -> Optional[str]:
+    if value is not None and value not in RENDER_PROFILES:
+        raise ValueError(f"Неизвестный профиль рендеринга, доступны: {', '.join(RENDER_PROFILES)}")
+    return value
+
 class VideoProcessRequest(BaseModel):
     video_url: HttpUrl
     language: Optional[str] = "auto"
 
+class BatchProcessRequest(BaseModel):
+    video_urls: List[HttpUrl]
+    language: Optional[str] = "auto"
+
 class TranscriptionSegment(BaseModel):
     start: float
     end: float
@@ -24,9 +36,64 @@ class HighlightSegment(BaseModel):
     title: Optional[str] = None
     description: Optional[str] = None
 
+    @validator("start_time")
+    def start_not_negative(cls, value):
+        if value < 0:
+            raise ValueError("start_time не может быть отрицательным")
+        return value
+
+    @validator("end_time")
+    def end_after_start(cls, value, values):
+        if "start_time" in values and value <= values["start_time"]:
+            raise ValueError("end_time должен быть больше start_time")
+        return value
+
 class HighlightRequest(BaseModel):
     original_task_id: str
     highlights: List[HighlightSegment]
+    # preview | standard | final; по умолчанию RENDER_PROFILE_DEFAULT
+    profile: Optional[str] = None
+
+    _profile = validator("profile", allow_reuse=True)(_check_profile)
+
+class HighlightDetectionRequest(BaseModel):
+    original_task_id: str
+    # Сколько хайлайтов предложить
+    count: int = 5
+    min_duration: float = 15.0
+    max_duration: float = 60.0
+    # Слова, рядом с которыми оценка момента выше
+    keywords: List[str] = []
+    # Переопределение весов сигналов: loudness, excitement, speech, confidence, keywords
+    weights: Optional[Dict[str, float]] = None
+
+    @validator("count")
+    def count_in_range(cls, value):
+        if not 1 <= value <= 50:
+            raise ValueError("count должен быть от 1 до 50")
+        return value
+
+    @validator("min_duration")
+    def min_duration_positive(cls, value):
+        if value <= 0:
+            raise ValueError("min_duration должен быть положительным")
+        return value
+
+    @validator("max_duration")
+    def max_after_min(cls, value, values):
+        if "min_duration" in values and value < values["min_duration"]:
+            raise ValueError("max_duration не может быть меньше min_duration")
+        return value
+
+class HighlightProposal(HighlightSegment):
+    """Предложенный хайлайт; подходит для HighlightRequest.highlights как есть"""
+    score: float
+    signals: Dict[str, float] = {}
+
+class RenderUpgradeRequest(BaseModel):
+    profile: str = "final"
+
+    _profile = validator("profile", allow_reuse=True)(_check_profile)
 
 class ProcessingStatus(BaseModel):
     task_id: str
@@ -0,0 +1,226 @@
+import os
+import math
+import time
+import sqlite3
+import logging
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from services.job_queue import queue_concurrency
+from utils.exceptions import AdmissionRejected
+from utils.metrics import ADMISSION_DECISIONS
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# Стоимость задания — ожидаемые секунды работы одного воркера.
+# Транскрипция (со скачиванием) — доля длительности видео
+TRANSCRIBE_COST_FACTOR = float(os.getenv("TRANSCRIBE_COST_FACTOR", "0.3"))
+# Рендеринг — секунды хайлайтов, умноженные на RENDER_COST_FACTOR и
+# коэффициент профиля (RenderProfile.cost_factor)
+RENDER_COST_FACTOR = float(os.getenv("RENDER_COST_FACTOR", "1.0"))
+# Длительность, если метаданные видео получить не удалось
+DEFAULT_VIDEO_SECONDS = float(os.getenv("ADMISSION_DEFAULT_VIDEO_MINUTES", "60")) * 60
+
+# Сколько ожидаемой работы (секунд) может быть принято и не закончено в каждом
+# пуле воркеров; дальше новые задания получают 429
+BACKLOG_LIMITS = {
+    "transcribe": float(os.getenv("ADMISSION_TRANSCRIBE_BACKLOG_MINUTES", "240")) * 60,
+    "render": float(os.getenv("ADMISSION_RENDER_BACKLOG_MINUTES", "60")) * 60,
+}
+# Доля лимита, которую может занять один клиент, пока в системе есть чужие задания
+CLIENT_SHARE = float(os.getenv("ADMISSION_CLIENT_SHARE", "0.5"))
+# Задание, не освобождённое воркером (например, упавшим), перестаёт занимать место
+ENTRY_TTL = float(os.getenv("ADMISSION_ENTRY_TTL_HOURS", "24")) * 3600
+MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", "3600"))
+
+# Шкала приоритетов очереди: 0 — самый высокий (как у Celery на Redis)
+PRIORITY_LEVELS = 10
+# Ранг задания удваивается на каждом следующем уровне приоритета
+PRIORITY_UNIT_SECONDS = float(os.getenv("PRIORITY_UNIT_SECONDS", "30"))
+
+
+def transcribe_cost(duration: Optional[float]) -> float:
+    return (duration or DEFAULT_VIDEO_SECONDS) * TRANSCRIBE_COST_FACTOR
+
+
+def render_cost(highlight_seconds: float, profile_factor: float = 1.0) -> float:
+    return highlight_seconds * RENDER_COST_FACTOR * profile_factor
+
+
+def priority_for(rank: float) -> int:
+    """
+    Приоритет очереди по рангу задания: короткие задания клиентов с
+    небольшой очередью идут раньше длинных. Уровни логарифмические:
+    30 с -> 1, 90 с -> 2, ... 4 ч -> 9.
+    """
+    level = int(math.log2(1 + max(rank, 0.0) / PRIORITY_UNIT_SECONDS))
+    return min(PRIORITY_LEVELS - 1, level)
+
+
+@dataclass(frozen=True)
+class Admission:
+    """Решение о приёме: стоимость и приоритет для очереди"""
+    cost: float
+    priority: int
+
+
+class AdmissionController:
+    """
+    Приём заданий с учётом стоимости. Принятые и не завершённые задания
+    хранятся в SQLite (WAL), общем для API и воркеров на одном томе: API
+    принимает задание, воркер освобождает место по окончании. Если
+    ожидаемая работа пула превышает лимит или клиент занял больше своей
+    доли, задание отклоняется с оценкой, через сколько секунд повторить.
+
+    Порядок выполнения принятых заданий задаёт приоритет очереди: ранг
+    задания — его стоимость плюс незавершённая работа того же клиента.
+    Короткие задания обгоняют длинные, а клиент с большой очередью не
+    вытесняет остальных.
+    """
+
+    def __init__(self, db_path: str, limits: Dict[str, float] = None):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.limits = limits or BACKLOG_LIMITS
+        self.concurrency = queue_concurrency()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS admitted ("
+            "task_id TEXT PRIMARY KEY, client TEXT NOT NULL, pool TEXT NOT NULL, "
+            "cost REAL NOT NULL, admitted_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS admitted_pool ON admitted (pool, client)"
+        )
+
+    def admit(self, pool: str, client: str, jobs: Dict[str, float]) -> Admission:
+        """
+        Приём одного задания или пакета (task_id -> стоимость) целиком.
+        AdmissionRejected — пул или доля клиента заполнены.
+        """
+        cost = sum(jobs.values())
+        limit = self.limits[pool]
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM admitted WHERE admitted_at < ?", (now - ENTRY_TTL,)
+                )
+                backlog, client_backlog = self._conn.execute(
+                    "SELECT COALESCE(SUM(cost), 0), "
+                    "COALESCE(SUM(CASE WHEN client = ? THEN cost END), 0) "
+                    "FROM admitted WHERE pool = ?",
+                    (client, pool)
+                ).fetchone()
+
+                # Пустой пул принимает задание любой стоимости: иначе очень
+                # длинное видео не было бы принято никогда
+                if backlog > 0 and backlog + cost > limit:
+                    reason = "Очередь обработки заполнена"
+                    excess = backlog + cost - limit
+                elif (
+                    client_backlog > 0
+                    and backlog > client_backlog
+                    and client_backlog + cost > limit * CLIENT_SHARE
+                ):
+                    reason = "Превышена доля очереди для клиента"
+                    excess = client_backlog + cost - limit * CLIENT_SHARE
+                else:
+                    reason = None
+
+                if reason is None:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO admitted "
+                        "(task_id, client, pool, cost, admitted_at) VALUES (?, ?, ?, ?, ?)",
+                        [(task_id, client, pool, job_cost, now) for task_id, job_cost in jobs.items()]
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if reason is not None:
+            ADMISSION_DECISIONS.labels(pool, "rejected").inc()
+            retry_after = self._retry_after(pool, excess)
+            logger.info(
+                f"Задание клиента {client} отклонено ({pool}): стоимость {cost:.0f} с, "
+                f"в работе {backlog:.0f} с, повтор через {retry_after} с"
+            )
+            raise AdmissionRejected(reason, retry_after)
+
+        ADMISSION_DECISIONS.labels(pool, "admitted").inc()
+        # Для пакета ранг считается по среднему заданию: видео пакета
+        # конкурируют с чужими заданиями, а не друг с другом
+        rank = client_backlog + cost / max(1, len(jobs))
+        return Admission(cost=cost, priority=priority_for(rank))
+
+    def _retry_after(self, pool: str, excess: float) -> int:
+        """Когда освободится нужная доля: лишняя работа делится на число воркеров пула"""
+        workers = max(1, self.concurrency.get(pool, 1))
+        return int(min(MAX_RETRY_AFTER, max(1, math.ceil(excess / workers))))
+
+    def release(self, task_id: str):
+        """Задание закончено (успешно или нет) и больше не занимает место"""
+        with self._lock:
+            self._conn.execute("DELETE FROM admitted WHERE task_id = ?", (task_id,))
+
+    def backlog(self) -> Dict[str, float]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT pool, SUM(cost) FROM admitted WHERE admitted_at >= ? GROUP BY pool",
+                (time.time() - ENTRY_TTL,)
+            ).fetchall()
+        return {pool: cost for pool, cost in rows}
+
+
+class _AllowAll:
+    """Приём без ограничений (ADMISSION_ENABLED=false)"""
+
+    def admit(self, pool: str, client: str, jobs: Dict[str, float]) -> Admission:
+        return Admission(cost=sum(jobs.values()), priority=priority_for(sum(jobs.values())))
+
+    def release(self, task_id: str):
+        pass
+
+    def backlog(self) -> Dict[str, float]:
+        return {}
+
+
+_admission_controller = None
+
+
+def get_admission_controller():
+    """Общий для процесса контроль приёма заданий"""
+    global _admission_controller
+    if _admission_controller is None:
+        if ADMISSION_ENABLED:
+            upload_dir = Path(os.getenv("UPLOAD_DIR", "./uploads"))
+            _admission_controller = AdmissionController(
+                os.getenv("ADMISSION_DB_PATH", str(upload_dir / "admission.sqlite3"))
+            )
+        else:
+            _admission_controller = _AllowAll()
+    return _admission_controller
+
+
+def highlight_seconds(highlights: List) -> float:
+    """Суммарная длительность хайлайтов (модели или словари)"""
+    total = 0.0
+    for h in highlights:
+        if isinstance(h, dict):
+            total += h["end_time"] - h["start_time"]
+        else:
+            total += h.end_time - h.start_time
+    return total
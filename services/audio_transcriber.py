@@ -1,68 +1,401 @@
-import whisper
+import os
+import json
+import asyncio
+import hashlib
 import logging
-from typing import Dict, List
-import torch
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+
+from utils.audio import (
+    SAMPLE_RATE,
+    AudioSource,
+    audio_fingerprint,
+    find_silence_split_points,
+    num_samples,
+    read_range
+)
+from services.model_registry import ModelSpec, configure_torch_threads, get_model
+from utils.metrics import CACHE_LOOKUPS, Span
+from utils.transcription_cache import TranscriptionCache
+from utils.vad import SpeechTimeline, detect_speech_regions
 
 logger = logging.getLogger(__name__)
 
+# Модель, загруженная один раз в каждом процессе пула
+_worker_model = None
+
+
+def _init_worker(spec: ModelSpec, num_threads: int):
+    """Инициализация процесса пула: прогрев модели и ограничение потоков torch"""
+    global _worker_model
+    if spec.backend == "openai":
+        configure_torch_threads(num_threads)
+    _worker_model = get_model(spec)
+
+
+def _transcribe_ranges(
+    model,
+    audio: AudioSource,
+    ranges: List[Tuple[int, int]],
+    verbose: Optional[bool] = None
+) -> Dict:
+    """
+    Транскрипция склейки интервалов записи (в сэмплах); тайминги
+    переводятся обратно на глобальную шкалу записи
+    """
+    compact = np.concatenate([read_range(audio, start, end) for start, end in ranges])
+    return _transcribe_compact(model, compact, ranges, verbose)
+
+
+def _transcribe_compact(
+    model,
+    compact: np.ndarray,
+    ranges: List[Tuple[int, int]],
+    verbose: Optional[bool] = None
+) -> Dict:
+    """Транскрипция уже склеенного PCM, полученного из интервалов ranges"""
+    result = model.transcribe(compact, verbose=verbose)
+    timeline = SpeechTimeline(ranges)
+    return {
+        "segments": _format_segments(result["segments"], timeline),
+        "language": result["language"],
+        "text": result["text"],
+        "duration": timeline.compact_length / SAMPLE_RATE
+    }
+
+
+def _transcribe_chunk(
+    audio: AudioSource,
+    ranges: List[Tuple[int, int]],
+    spec: Optional[ModelSpec] = None
+) -> Dict:
+    """
+    Транскрипция одного чанка в процессе пула (или в потоке, если пула нет —
+    тогда модель берётся по spec). WAV читается самим воркером по пути;
+    PCM из памяти передаётся уже склеенным фрагментом.
+    """
+    model = _worker_model if _worker_model is not None else get_model(spec)
+    if isinstance(audio, np.ndarray):
+        return _transcribe_compact(model, audio, ranges)
+    return _transcribe_ranges(model, audio, ranges)
+
+
+def _format_segments(raw_segments: List[Dict], timeline: SpeechTimeline) -> List[Dict]:
+    """Приведение сегментов Whisper к формату, который использует _create_ass_file"""
+    segments = []
+    for segment in raw_segments:
+        # Извлекаем слова с таймингами
+        words = []
+        if "words" in segment:
+            for word_data in segment["words"]:
+                words.append({
+                    "word": word_data.get("word", "").strip(),
+                    "start": timeline.to_original(word_data.get("start", 0)),
+                    "end": timeline.to_original(word_data.get("end", 0), is_end=True),
+                    "probability": word_data.get("probability", 0)
+                })
+
+        segments.append({
+            "start": timeline.to_original(segment["start"]),
+            "end": timeline.to_original(segment["end"], is_end=True),
+            "text": segment["text"].strip(),
+            "confidence": segment.get("avg_logprob", 0),
+            "words": words  # Добавляем пословную информацию
+        })
+    return segments
+
+
 class AudioTranscriber:
     def __init__(self):
-        # Загрузка модели Whisper
-        self.model = whisper.load_model("tiny")
-        logger.info("Модель Whisper загружена")
-    
-    async def transcribe(self, audio_path: str) -> Dict:
+        # Модель (WHISPER_MODEL, WHISPER_DEVICE, WHISPER_BACKEND, WHISPER_QUANTIZE)
+        # загружается при первой транскрипции, а не при создании сервиса
+        self.model_spec = ModelSpec.from_env()
+        self.model_name = self.model_spec.name
+
+        # Параметры чанковой транскрипции длинных записей
+        self.chunk_seconds = float(os.getenv("TRANSCRIBE_CHUNK_SECONDS", "600"))
+        self.workers = max(1, int(os.getenv(
+            "TRANSCRIBE_WORKERS",
+            max(1, (os.cpu_count() or 1) // 4)
+        )))
+        self._pool = None
+
+        # Энергетический VAD: в модель попадают только участки с речью
+        self.vad_enabled = os.getenv("VAD_ENABLED", "true").lower() in ("1", "true", "yes")
+        self.vad_options = {
+            "high_db": float(os.getenv("VAD_HIGH_DB", "12")),
+            "low_db": float(os.getenv("VAD_LOW_DB", "6")),
+            "zcr_max": float(os.getenv("VAD_ZCR_MAX", "0.35")),
+            "min_speech_seconds": float(os.getenv("VAD_MIN_SPEECH_SECONDS", "0.25")),
+            "padding_seconds": float(os.getenv("VAD_PADDING_SECONDS", "0.3")),
+            "merge_gap_seconds": float(os.getenv("VAD_MERGE_GAP_SECONDS", "1.0")),
+        }
+
+        # Кэш результатов по отпечатку аудио и настройкам модели
+        self.cache = None
+        if os.getenv("TRANSCRIPTION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes"):
+            self.cache = TranscriptionCache(
+                cache_dir=Path(os.getenv("TRANSCRIPTION_CACHE_DIR", "./cache/transcriptions")),
+                max_bytes=int(float(os.getenv("TRANSCRIPTION_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+            )
+
+    @property
+    def model(self):
+        return get_model(self.model_spec)
+
+    async def load_model(self):
+        """Прогрев: загрузка модели заранее, без блокировки event loop"""
+        await asyncio.to_thread(get_model, self.model_spec)
+
+    async def transcribe(
+        self,
+        audio: AudioSource,
+        progress_callback: Optional[Callable[..., None]] = None,
+        checkpoints=None
+    ) -> Dict:
         """
-        Транскрипция аудио с помощью Whisper с пословными таймингами
+        Транскрипция аудио с помощью Whisper с пословными таймингами.
+        Принимает путь к WAV или float32 PCM 16 кГц из extract_audio_pcm.
+        progress_callback(доля, **детали) вызывается по мере готовности чанков.
+        checkpoints (TaskCheckpoints) — результат каждого чанка сохраняется,
+        и перезапущенная задача продолжает с первого незавершённого чанка.
         """
         try:
-            logger.info(f"Начинаю транскрипцию: {audio_path}")
-            
-            # Транскрипция с word_timestamps для караоке
-            result = self.model.transcribe(
-                audio_path,
-                verbose=True,
-                word_timestamps=True,  # Важно для караоке-эффекта
-                language=None  # Автоопределение языка
-            )
-            
-            # Форматирование результата
-            segments = []
-            for segment in result["segments"]:
-                # Извлекаем слова с таймингами
-                words = []
-                if "words" in segment:
-                    for word_data in segment["words"]:
-                        words.append({
-                            "word": word_data.get("word", "").strip(),
-                            "start": word_data.get("start", 0),
-                            "end": word_data.get("end", 0),
-                            "probability": word_data.get("probability", 0)
-                        })
-                
-                segments.append({
-                    "start": segment["start"],
-                    "end": segment["end"],
-                    "text": segment["text"].strip(),
-                    "confidence": segment.get("avg_logprob", 0),
-                    "words": words  # Добавляем пословную информацию
-                })
-            
-            transcription_result = {
-                "segments": segments,
-                "language": result["language"],
-                "duration": result["segments"][-1]["end"] if segments else 0,
-                "full_text": result["text"]
-            }
-            
+            if isinstance(audio, np.ndarray):
+                logger.info(f"Начинаю транскрипцию PCM: {len(audio) / SAMPLE_RATE:.1f} с")
+            else:
+                logger.info(f"Начинаю транскрипцию: {audio}")
+
+            # Повторная транскрипция той же дорожки берётся из кэша
+            cache_key = None
+            if self.cache is not None:
+                fingerprint = await asyncio.to_thread(audio_fingerprint, audio)
+                cache_key = TranscriptionCache.make_key(fingerprint, self._cache_settings())
+                cached = await asyncio.to_thread(self.cache.get, cache_key)
+                CACHE_LOOKUPS.labels("transcription", "hit" if cached is not None else "miss").inc()
+                if cached is not None:
+                    logger.info(f"Транскрипция найдена в кэше: {cache_key}")
+                    return cached
+
+            with Span("transcribe", media_seconds=num_samples(audio) / SAMPLE_RATE):
+                transcription_result = await self._run_transcription(
+                    audio, progress_callback, checkpoints
+                )
+
+            if cache_key is not None:
+                await asyncio.to_thread(self.cache.put, cache_key, transcription_result)
+
+            segments = transcription_result["segments"]
             logger.info(f"Транскрипция завершена. Найдено {len(segments)} сегментов")
-            
+
             # Логирование для отладки
             for i, seg in enumerate(segments[:3]):  # Первые 3 сегмента для примера
                 logger.debug(f"Сегмент {i}: {seg['text'][:50]}... Words: {len(seg.get('words', []))}")
-            
+
             return transcription_result
-            
+
         except Exception as e:
             logger.error(f"Ошибка при транскрипции: {str(e)}")
-            raise Exception(f"Не удалось выполнить транскрипцию: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Не удалось выполнить транскрипцию: {str(e)}")
+
+    async def _run_transcription(
+        self,
+        audio: AudioSource,
+        progress_callback: Optional[Callable[..., None]] = None,
+        checkpoints=None
+    ) -> Dict:
+        """VAD и транскрипция речевых участков одним вызовом модели или по чанкам"""
+        total_samples = num_samples(audio)
+        if self.vad_enabled:
+            regions = await asyncio.to_thread(
+                detect_speech_regions, audio, **self.vad_options
+            )
+        else:
+            regions = [(0, total_samples)] if total_samples else []
+
+        vad_stats = self._vad_stats(total_samples, regions)
+        if self.vad_enabled:
+            logger.info(
+                f"VAD: речь {vad_stats['speech_seconds']:.1f} с из "
+                f"{vad_stats['audio_seconds']:.1f} с, пропущено "
+                f"{vad_stats['skipped_seconds']:.1f} с ({vad_stats['skipped_ratio']:.0%})"
+            )
+
+        if not regions:
+            transcription_result = self._build_result([])
+        elif (
+            (self.workers > 1 or checkpoints is not None or isinstance(audio, np.memmap))
+            and vad_stats["speech_seconds"] > self.chunk_seconds * 1.5
+        ):
+            # С контрольными точками длинная запись делится на чанки и без пула;
+            # memmap тоже: склейка всей речи вернула бы запись в память целиком
+            transcription_result = await self._transcribe_chunked(
+                audio, regions, progress_callback, checkpoints
+            )
+        else:
+            # Модель загружается (при первом вызове) в том же потоке, не в event loop
+            chunk = await asyncio.to_thread(
+                lambda: _transcribe_ranges(self.model, audio, regions, True)
+            )
+            transcription_result = self._build_result([chunk])
+
+        transcription_result["vad"] = vad_stats
+        return transcription_result
+
+    def _cache_settings(self) -> Dict:
+        """Настройки, от которых зависит результат; входят в ключ кэша"""
+        return {
+            "model": self.model_spec.cache_settings(),
+            "language": "auto",
+            "word_timestamps": True,
+            "vad": self.vad_options if self.vad_enabled else None
+        }
+
+    async def _transcribe_chunked(
+        self,
+        audio: AudioSource,
+        regions: List[Tuple[int, int]],
+        progress_callback: Optional[Callable[..., None]] = None,
+        checkpoints=None
+    ) -> Dict:
+        """
+        Транскрипция длинной записи: разбиение по паузам и параллельная
+        обработка чанков в пуле процессов с прогретой моделью в каждом
+        (при одном воркере — по очереди в потоке). Готовые чанки
+        сохраняются в контрольных точках и при перезапуске не пересчитываются.
+        """
+        chunks = self._group_regions(audio, regions)
+        logger.info(f"Аудио разбито на {len(chunks)} чанков, воркеров: {self.workers}")
+
+        def chunk_payload(ranges: List[Tuple[int, int]]) -> AudioSource:
+            if isinstance(audio, np.ndarray):
+                return np.concatenate([read_range(audio, start, end) for start, end in ranges])
+            return audio
+
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool() if self.workers > 1 else None
+        # Ограничиваем число чанков в очереди пула, чтобы не копировать всю запись сразу
+        in_flight = asyncio.Semaphore(self.workers * 2 if pool else 1)
+
+        # Прогресс — доля обработанной речи по завершённым чанкам
+        total_samples = sum(end - start for ranges in chunks for start, end in ranges) or 1
+        done_samples = 0
+        done_chunks = 0
+
+        async def run_chunk(ranges: List[Tuple[int, int]]) -> Dict:
+            nonlocal done_samples, done_chunks
+            key = self._chunk_key(ranges)
+            result = None
+            if checkpoints is not None:
+                result = await asyncio.to_thread(checkpoints.load_unit, key)
+            if result is None:
+                async with in_flight:
+                    # Чтение интервалов из memmap — дисковый ввод-вывод, не в event loop
+                    payload = await asyncio.to_thread(chunk_payload, ranges)
+                    result = await loop.run_in_executor(
+                        pool, _transcribe_chunk, payload, ranges, self.model_spec
+                    )
+                if checkpoints is not None:
+                    await asyncio.to_thread(checkpoints.save_unit, key, result)
+            done_samples += sum(end - start for start, end in ranges)
+            done_chunks += 1
+            if progress_callback:
+                progress_callback(
+                    done_samples / total_samples,
+                    chunks_done=done_chunks,
+                    chunks_total=len(chunks)
+                )
+            return result
+
+        results = await asyncio.gather(*(run_chunk(ranges) for ranges in chunks))
+        if checkpoints is not None:
+            # Итог сохраняет вызывающий; промежуточные чанки больше не нужны
+            for ranges in chunks:
+                await asyncio.to_thread(checkpoints.drop_unit, self._chunk_key(ranges))
+        return self._build_result(results)
+
+    def _chunk_key(self, ranges: List[Tuple[int, int]]) -> str:
+        """Имя контрольной точки чанка: границы в сэмплах и настройки модели"""
+        bounds = [[int(start), int(end)] for start, end in ranges]
+        raw = json.dumps([bounds, self._cache_settings()], sort_keys=True)
+        return "chunk-" + hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+    def _group_regions(
+        self,
+        audio: AudioSource,
+        regions: List[Tuple[int, int]]
+    ) -> List[List[Tuple[int, int]]]:
+        """
+        Упаковка речевых участков в чанки не длиннее chunk_seconds;
+        слишком длинные участки режутся по паузам
+        """
+        chunk_samples = int(self.chunk_seconds * SAMPLE_RATE)
+        chunks = []
+        current = []
+        current_length = 0
+
+        for start, end in regions:
+            if end - start > chunk_samples:
+                if current:
+                    chunks.append(current)
+                    current, current_length = [], 0
+                boundaries = find_silence_split_points(
+                    audio, self.chunk_seconds, start_sample=start, end_sample=end
+                )
+                chunks.extend([(s, e)] for s, e in zip(boundaries[:-1], boundaries[1:]))
+                continue
+
+            if current and current_length + (end - start) > chunk_samples:
+                chunks.append(current)
+                current, current_length = [], 0
+            current.append((start, end))
+            current_length += end - start
+
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def _build_result(self, chunks: List[Dict]) -> Dict:
+        """Склейка чанков в порядке следования; язык — преобладающий по длительности"""
+        segments = []
+        texts = []
+        languages = Counter()
+        for chunk in chunks:
+            segments.extend(chunk["segments"])
+            texts.append(chunk["text"].strip())
+            languages[chunk["language"]] += chunk["duration"]
+
+        return {
+            "segments": segments,
+            "language": languages.most_common(1)[0][0] if languages else None,
+            "duration": segments[-1]["end"] if segments else 0,
+            "full_text": " ".join(text for text in texts if text)
+        }
+
+    def _vad_stats(self, total_samples: int, regions: List[Tuple[int, int]]) -> Dict:
+        audio_seconds = total_samples / SAMPLE_RATE
+        speech_seconds = sum(end - start for start, end in regions) / SAMPLE_RATE
+        skipped_seconds = audio_seconds - speech_seconds
+        return {
+            "enabled": self.vad_enabled,
+            "audio_seconds": audio_seconds,
+            "speech_seconds": speech_seconds,
+            "skipped_seconds": skipped_seconds,
+            "skipped_ratio": skipped_seconds / audio_seconds if audio_seconds else 0.0
+        }
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """Ленивое создание пула, живущего между задачами, чтобы модели оставались прогретыми"""
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.workers)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_spec, threads)
+            )
+        return self._pool
@@ -0,0 +1,192 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from services.task_store import get_task_store
+from services.progress import update_task
+from utils.exceptions import StageBusy
+
+logger = logging.getLogger(__name__)
+
+# Захват этапа задачи воркером; продлевается, пока этап выполняется.
+# Повторно доставленное задание (перезапуск контейнера, таймаут брокера)
+# не запускает этап второй раз, пока жив владелец захвата
+STAGE_LEASE_SECONDS = float(os.getenv("STAGE_LEASE_SECONDS", "120"))
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    attempts: int
+    # Пауза перед повтором удваивается с каждой попыткой
+    backoff: float
+
+
+# Этапы идемпотентны (повтор продолжает с последней контрольной точки),
+# поэтому временные ошибки — сеть, OOM ffmpeg — повторяются
+RETRY_POLICIES: Dict[str, RetryPolicy] = {
+    "download": RetryPolicy(
+        attempts=int(os.getenv("DOWNLOAD_RETRIES", "3")),
+        backoff=float(os.getenv("DOWNLOAD_RETRY_BACKOFF", "10"))
+    ),
+    "transcribe": RetryPolicy(
+        attempts=int(os.getenv("TRANSCRIBE_RETRIES", "2")),
+        backoff=float(os.getenv("TRANSCRIBE_RETRY_BACKOFF", "30"))
+    ),
+    "render": RetryPolicy(
+        attempts=int(os.getenv("RENDER_RETRIES", "2")),
+        backoff=float(os.getenv("RENDER_RETRY_BACKOFF", "10"))
+    ),
+}
+
+
+class TaskCheckpoints:
+    """
+    Контрольные точки задачи. Отметки этапов (небольшие словари) хранятся
+    в записи задачи в поле checkpoints, результаты единиц работы (чанков
+    транскрипции) — в payload checkpoint:<имя>.
+    """
+
+    def __init__(self, task_id: str):
+        self.task_id = task_id
+        self.store = get_task_store()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def get(self, stage: str) -> Optional[Dict]:
+        record = self.store.get(self.task_id) or {}
+        return (record.get("checkpoints") or {}).get(stage)
+
+    def save(self, stage: str, data: Dict):
+        record = self.store.get(self.task_id) or {}
+        checkpoints = dict(record.get("checkpoints") or {})
+        checkpoints[stage] = dict(data, saved_at=time.time())
+        self.store.update(self.task_id, {"checkpoints": checkpoints})
+
+    def clear(self, stage: str):
+        record = self.store.get(self.task_id) or {}
+        checkpoints = dict(record.get("checkpoints") or {})
+        if checkpoints.pop(stage, None) is not None:
+            self.store.update(self.task_id, {"checkpoints": checkpoints})
+
+    def load_unit(self, name: str) -> Optional[Any]:
+        return self.store.get_payload(self.task_id, f"checkpoint:{name}")
+
+    def save_unit(self, name: str, data: Any):
+        self.store.put_payload(self.task_id, f"checkpoint:{name}", data)
+
+    def drop_unit(self, name: str):
+        self.store.delete_payload(self.task_id, f"checkpoint:{name}")
+
+    def busy_for(self, stage: str) -> float:
+        """
+        Сколько секунд ещё действует захват этапа другим живым воркером
+        (0 — этап свободен). Захват процесса, который умер на этом же
+        хосте, считается истёкшим сразу.
+        """
+        record = self.store.get(self.task_id) or {}
+        lease = record.get("lease") or {}
+        if lease.get("stage") != stage or lease.get("owner") in (None, self.owner):
+            return 0.0
+        remaining = lease.get("expires_at", 0) - time.time()
+        if remaining <= 0 or not _owner_alive(lease["owner"]):
+            return 0.0
+        return remaining
+
+    def claim(self, stage: str) -> bool:
+        """
+        Захват этапа этим процессом. False — этап уже выполняет другой живой
+        воркер. Захват не атомарен между процессами: он защищает от
+        повторной доставки задания, а не от одновременного старта.
+        """
+        if self.busy_for(stage) > 0:
+            return False
+        self._renew(stage)
+        return True
+
+    def _renew(self, stage: str):
+        self.store.update(self.task_id, {"lease": {
+            "stage": stage,
+            "owner": self.owner,
+            "expires_at": time.time() + STAGE_LEASE_SECONDS
+        }})
+
+    def release(self):
+        self.store.update(self.task_id, {"lease": None})
+
+    @asynccontextmanager
+    async def lease(self, stage: str):
+        """
+        Захват этапа с продлением в фоне. Если этап выполняет другой живой
+        воркер — StageBusy: задание не подтверждается, а откладывается до
+        истечения чужого захвата (владелец мог упасть, не освободив его)
+        """
+        if not self.claim(stage):
+            retry_after = max(1.0, self.busy_for(stage))
+            logger.info(
+                f"Этап {stage} задачи {self.task_id} уже выполняет другой воркер, "
+                f"повтор через {retry_after:.0f} с"
+            )
+            raise StageBusy(f"Этап {stage} задачи {self.task_id} занят", retry_after)
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(STAGE_LEASE_SECONDS / 3)
+                await asyncio.to_thread(self._renew, stage)
+
+        renewer = asyncio.create_task(heartbeat())
+        try:
+            yield True
+        finally:
+            renewer.cancel()
+            self.release()
+
+
+def _owner_alive(owner: str) -> bool:
+    """Жив ли процесс hostname:pid; про процессы других хостов судить нельзя — True"""
+    hostname, _, pid = owner.rpartition(":")
+    if hostname != socket.gethostname() or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+async def run_with_retries(
+    stage: str,
+    task_id: str,
+    attempt: Callable[[], Awaitable[Any]]
+) -> Any:
+    """
+    Выполнение попытки этапа по политике RETRY_POLICIES. Каждая попытка
+    продолжает с сохранённых контрольных точек; после последней неудачной
+    ошибка пробрасывается.
+    """
+    policy = RETRY_POLICIES[stage]
+    for number in range(1, max(1, policy.attempts) + 1):
+        try:
+            return await attempt()
+        except (asyncio.CancelledError, StageBusy):
+            # Занятый этап — не ошибка попытки: задание вернётся в очередь
+            raise
+        except Exception as e:
+            if number >= policy.attempts:
+                raise
+            delay = policy.backoff * 2 ** (number - 1)
+            logger.warning(
+                f"Этап {stage} задачи {task_id}: попытка {number} не удалась ({str(e)}), "
+                f"повтор через {delay:.0f} с"
+            )
+            update_task(task_id, {
+                "stage": f"retrying_{stage}",
+                "attempt": number + 1,
+                "last_error": str(e)
+            })
+            await asyncio.sleep(delay)
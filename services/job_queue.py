@@ -0,0 +1,235 @@
+import os
+import heapq
+import asyncio
+import logging
+import itertools
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+from utils.metrics import Span
+from utils.exceptions import StageBusy
+
+logger = logging.getLogger(__name__)
+
+# Задание -> очередь. Очереди обслуживаются отдельными пулами воркеров:
+# download — сеть, transcribe — память (Whisper), render — CPU (x264)
+JOB_ROUTES = {
+    "download": "download",
+    "transcribe": "transcribe",
+    "render": "render",
+}
+
+# Приоритет заданий: 0 — самый высокий, 9 — самый низкий (как у Celery на Redis).
+# Задания без оценки стоимости получают средний
+DEFAULT_PRIORITY = 5
+PRIORITY_STEPS = list(range(10))
+
+
+def celery_transport_options() -> Dict:
+    """Настройки брокера Redis, общие для API (отправка) и воркеров (приём)"""
+    return {
+        # Неподтверждённое задание брокер отдаёт повторно через этот срок; этапы
+        # продолжают с контрольных точек, а захват этапа не даёт выполнить его дважды
+        "visibility_timeout": int(os.getenv("CELERY_VISIBILITY_TIMEOUT", "3600")),
+        # Отдельный список Redis на каждый приоритет; воркер берёт из старшего
+        "queue_order_strategy": "priority",
+        "priority_steps": PRIORITY_STEPS,
+        "sep": ":",
+    }
+
+
+async def execute_job(job: str, kwargs: Dict, job_queue: "JobQueue"):
+    """Выполнение задания в текущем процессе"""
+    from services import pipeline
+
+    stages = {
+        "download": lambda: pipeline.download_stage(job_queue=job_queue, **kwargs),
+        "transcribe": lambda: pipeline.transcribe_stage(**kwargs),
+        "render": lambda: pipeline.render_stage(**kwargs),
+    }
+    if job not in stages:
+        raise ValueError(f"Неизвестное задание: {job}")
+    with Span(f"job_{job}"):
+        await stages[job]()
+
+
+class JobQueue(ABC):
+    """Очередь заданий конвейера"""
+
+    # Через сколько секунд задание, упёршееся в обратное давление, берётся снова
+    backpressure_retry = float(os.getenv("BACKPRESSURE_RETRY_SECONDS", "5"))
+
+    @abstractmethod
+    async def submit(self, job: str, priority: Optional[int] = None, **kwargs):
+        """
+        Постановка задания в очередь, соответствующую JOB_ROUTES. Из очереди
+        сначала берутся задания с меньшим priority, внутри приоритета — по порядку
+        """
+
+    @abstractmethod
+    async def depth(self, queue: str) -> int:
+        """Число заданий очереди, ещё не взятых в работу"""
+
+    async def has_capacity(self, queue: str, limit: int) -> bool:
+        """
+        Обратное давление: в очереди меньше limit заданий. limit <= 0 —
+        очередь не ограничена. Задание, которому места нет, не ждёт в слоте
+        воркера, а возвращается в очередь (StageBusy)
+        """
+        return limit <= 0 or await self.depth(queue) < limit
+
+
+class _PrioritySlots:
+    """Семафор, который будит ожидающих по приоритету, а не по порядку прихода"""
+
+    def __init__(self, limit: int):
+        self._free = max(1, limit)
+        self._waiters = []
+        self._order = itertools.count()
+
+    def __len__(self) -> int:
+        return sum(1 for *_, waiter in self._waiters if not waiter.done())
+
+    async def acquire(self, priority: int):
+        if self._free > 0 and not self._waiters:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # Слот мог быть уже передан этому ожидающему — возвращаем его
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            *_, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                # Слот передаётся следующему ожидающему напрямую
+                waiter.set_result(None)
+                return
+        self._free += 1
+
+
+class InProcessJobQueue(JobQueue):
+    """
+    Очередь внутри процесса API для разработки и тестов: задания выполняются
+    как asyncio-задачи, число одновременных заданий ограничено для каждой
+    очереди, ожидающие задания запускаются по приоритету
+    """
+
+    def __init__(self, concurrency: Dict[str, int]):
+        self._slots = {queue: _PrioritySlots(limit) for queue, limit in concurrency.items()}
+        # Ссылки на задачи, чтобы их не собрал сборщик мусора
+        self._tasks = set()
+
+    async def submit(self, job: str, priority: Optional[int] = None, **kwargs):
+        task = asyncio.create_task(self._run(job, priority, kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def depth(self, queue: str) -> int:
+        return len(self._slots[queue])
+
+    async def _run(self, job: str, priority: Optional[int], kwargs: Dict):
+        slots = self._slots[JOB_ROUTES[job]]
+        await slots.acquire(DEFAULT_PRIORITY if priority is None else priority)
+        try:
+            await execute_job(job, kwargs, self)
+        except StageBusy as e:
+            # Этап занят или следующая очередь заполнена: слот освобождается
+            # сразу, а задание возвращается в очередь через retry_after
+            # (как task.retry у Celery)
+            slots.release()
+            slots = None
+            await asyncio.sleep(e.retry_after)
+            await self.submit(job, priority=priority, **kwargs)
+        except Exception as e:
+            logger.error(f"Задание {job} завершилось с ошибкой: {str(e)}")
+        finally:
+            if slots is not None:
+                slots.release()
+
+
+class CeleryJobQueue(JobQueue):
+    """
+    Распределённая очередь на Celery + Redis. Задания выполняют воркеры из
+    worker.py, каждый слушает свою очередь со своей concurrency.
+    """
+
+    def __init__(self, broker_url: str):
+        from celery import Celery
+
+        self.app = Celery("narezka", broker=broker_url)
+        self.app.conf.broker_transport_options = celery_transport_options()
+        self.broker_url = broker_url
+        self._redis = None
+
+    async def submit(self, job: str, priority: Optional[int] = None, **kwargs):
+        await asyncio.to_thread(
+            self.app.send_task,
+            f"jobs.{job}",
+            kwargs=kwargs,
+            queue=JOB_ROUTES[job],
+            priority=DEFAULT_PRIORITY if priority is None else priority
+        )
+
+    async def depth(self, queue: str) -> int:
+        # Брокер Redis хранит очередь Celery в списках: приоритет 0 — под именем
+        # очереди, остальные — <очередь>:<приоритет>
+        if self._redis is None:
+            import redis
+
+            self._redis = redis.Redis.from_url(self.broker_url)
+
+        def total():
+            with self._redis.pipeline() as pipe:
+                for step in PRIORITY_STEPS:
+                    pipe.llen(f"{queue}:{step}" if step else queue)
+                return sum(pipe.execute())
+
+        return await asyncio.to_thread(total)
+
+
+def queue_concurrency() -> Dict[str, int]:
+    return {
+        "download": int(os.getenv("DOWNLOAD_CONCURRENCY", "4")),
+        "transcribe": int(os.getenv("TRANSCRIBE_CONCURRENCY", "1")),
+        "render": int(os.getenv("RENDER_CONCURRENCY", "2")),
+    }
+
+
+def queue_limits() -> Dict[str, int]:
+    """
+    Ёмкость очередей между этапами. Если транскрипция отстаёт, скачивание
+    следующих видео приостанавливается, пока очередь transcribe не разгрузится.
+    0 — без ограничения.
+    """
+    return {
+        "transcribe": int(os.getenv("TRANSCRIBE_QUEUE_LIMIT", "2")),
+    }
+
+
+def create_job_queue() -> JobQueue:
+    """Выбор очереди по переменной JOB_QUEUE: inprocess | celery"""
+    backend = os.getenv("JOB_QUEUE", "inprocess").lower()
+    if backend == "celery":
+        queue = CeleryJobQueue(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        queue = InProcessJobQueue(queue_concurrency())
+    logger.info(f"Очередь заданий: {type(queue).__name__}")
+    return queue
+
+
+_job_queue: Optional[JobQueue] = None
+
+
+def get_job_queue() -> JobQueue:
+    """Общий для процесса экземпляр очереди заданий"""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = create_job_queue()
+    return _job_queue
@@ -0,0 +1,253 @@
+import os
+import logging
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass
+from typing import Dict, Optional, Type
+
+import numpy as np
+
+from utils.metrics import MODEL_MEMORY, Span, model_memory_bytes, resident_memory_bytes
+
+logger = logging.getLogger(__name__)
+
+# torch и движки распознавания импортируются только при загрузке модели:
+# процессы API и воркеры скачивания/рендеринга их не загружают
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """Какую модель распознавания и как загружать"""
+    name: str = "tiny"
+    # cpu | cuda | auto
+    device: str = "cpu"
+    # openai (пакет openai-whisper) | faster (faster-whisper, CTranslate2)
+    backend: str = "openai"
+    # none | int8 — динамическое квантование весов для CPU
+    quantize: str = "none"
+
+    @classmethod
+    def from_env(cls) -> "ModelSpec":
+        return cls(
+            name=os.getenv("WHISPER_MODEL", "tiny"),
+            device=os.getenv("WHISPER_DEVICE", "cpu").lower(),
+            backend=os.getenv("WHISPER_BACKEND", "openai").lower(),
+            quantize=os.getenv("WHISPER_QUANTIZE", "none").lower()
+        )
+
+    def cache_settings(self) -> Dict:
+        """Параметры, от которых зависит текст распознавания (для ключа кэша)"""
+        return asdict(self)
+
+    @property
+    def label(self) -> str:
+        suffix = f"-{self.quantize}" if self.quantize != "none" else ""
+        return f"whisper-{self.name}-{self.backend}{suffix}"
+
+
+def configure_torch_threads(num_threads: Optional[int] = None):
+    """
+    Потоки torch для процесса: TORCH_NUM_THREADS (внутри операций) и
+    TORCH_INTEROP_THREADS (между операциями). Без настройки torch занимает
+    все ядра в каждом процессе пула, и процессы мешают друг другу.
+    """
+    import torch
+
+    num_threads = num_threads or int(os.getenv("TORCH_NUM_THREADS", "0"))
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    interop_threads = int(os.getenv("TORCH_INTEROP_THREADS", "0"))
+    if interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # Можно задать только до первой параллельной операции в процессе
+            logger.warning("TORCH_INTEROP_THREADS не применён: torch уже запущен")
+
+
+class WhisperBackend(ABC):
+    """
+    Движок распознавания. transcribe возвращает результат в формате
+    openai-whisper: segments (со словами), language, text.
+    """
+
+    def __init__(self, spec: ModelSpec):
+        self.spec = spec
+        # Память весов после load — для метрики MODEL_MEMORY
+        self.memory_bytes = 0
+
+    @abstractmethod
+    def load(self):
+        """Загрузка весов модели"""
+
+    def unload(self):
+        """Освобождение весов модели"""
+        self.model = None
+
+    @abstractmethod
+    def transcribe(self, audio: np.ndarray, verbose: Optional[bool] = None) -> Dict:
+        """Распознавание float32 PCM 16 кГц с пословными таймингами"""
+
+
+class OpenAIWhisperBackend(WhisperBackend):
+    """Эталонная реализация openai-whisper на torch"""
+
+    def load(self):
+        import torch
+        import whisper
+
+        configure_torch_threads()
+        device = self.spec.device
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+
+        model = whisper.load_model(self.spec.name, device=device)
+        if self.spec.quantize == "int8":
+            if device != "cpu":
+                raise ValueError("Квантование int8 поддерживается только на CPU")
+            model = self._quantize(model)
+        self.model = model
+        self.memory_bytes = model_memory_bytes(model)
+
+    def _quantize(self, model):
+        """Динамическое int8-квантование линейных слоёв: меньше памяти, быстрее на CPU"""
+        import torch
+
+        # Whisper использует подкласс nn.Linear, который квантование не распознаёт;
+        # в float32 на CPU он ведёт себя как обычный nn.Linear
+        for module in model.modules():
+            if isinstance(module, torch.nn.Linear):
+                module.__class__ = torch.nn.Linear
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def transcribe(self, audio: np.ndarray, verbose: Optional[bool] = None) -> Dict:
+        return self.model.transcribe(
+            audio,
+            verbose=verbose,
+            word_timestamps=True,  # Важно для караоке-эффекта
+            language=None,  # Автоопределение языка
+            fp16=self.device == "cuda"
+        )
+
+
+class FasterWhisperBackend(WhisperBackend):
+    """
+    faster-whisper (CTranslate2): заметно быстрее на CPU, int8 без torch.
+    Необязательная зависимость — нужен пакет faster-whisper.
+    """
+
+    def load(self):
+        try:
+            from faster_whisper import WhisperModel
+        except ImportError as e:
+            raise RuntimeError("Для WHISPER_BACKEND=faster нужен пакет faster-whisper") from e
+
+        compute_type = "int8" if self.spec.quantize == "int8" else "default"
+        # У CTranslate2 нет тензоров torch: память весов — прирост резидентной
+        # памяти процесса за загрузку (на CUDA веса в видеопамяти не учитываются)
+        resident_before = resident_memory_bytes()
+        self.model = WhisperModel(
+            self.spec.name,
+            device=self.spec.device,
+            compute_type=compute_type,
+            cpu_threads=int(os.getenv("TORCH_NUM_THREADS", "0"))
+        )
+        resident_after = resident_memory_bytes()
+        if resident_before is not None and resident_after is not None:
+            self.memory_bytes = max(0, resident_after - resident_before)
+
+    def transcribe(self, audio: np.ndarray, verbose: Optional[bool] = None) -> Dict:
+        segments, info = self.model.transcribe(audio, word_timestamps=True, language=None)
+        result_segments = []
+        for segment in segments:
+            result_segments.append({
+                "start": segment.start,
+                "end": segment.end,
+                "text": segment.text,
+                "avg_logprob": segment.avg_logprob,
+                "words": [
+                    {
+                        "word": word.word,
+                        "start": word.start,
+                        "end": word.end,
+                        "probability": word.probability
+                    }
+                    for word in segment.words or []
+                ]
+            })
+            if verbose:
+                logger.info(f"[{segment.start:.2f} -> {segment.end:.2f}] {segment.text}")
+        return {
+            "segments": result_segments,
+            "language": info.language,
+            "text": "".join(segment["text"] for segment in result_segments)
+        }
+
+
+BACKENDS: Dict[str, Type[WhisperBackend]] = {
+    "openai": OpenAIWhisperBackend,
+    "faster": FasterWhisperBackend,
+}
+
+
+def register_backend(name: str, backend: Type[WhisperBackend]):
+    """Подключение собственного движка распознавания (WHISPER_BACKEND=<name>)"""
+    BACKENDS[name] = backend
+
+
+class ModelRegistry:
+    """Модели процесса: загружаются при первом обращении, одна на ModelSpec"""
+
+    def __init__(self):
+        self._models: Dict[ModelSpec, WhisperBackend] = {}
+        self._lock = threading.Lock()
+
+    def get(self, spec: ModelSpec) -> WhisperBackend:
+        model = self._models.get(spec)
+        if model is not None:
+            return model
+        with self._lock:
+            model = self._models.get(spec)
+            if model is None:
+                if spec.backend not in BACKENDS:
+                    raise ValueError(
+                        f"Неизвестный движок распознавания: {spec.backend}. "
+                        f"Доступны: {', '.join(BACKENDS)}"
+                    )
+                model = BACKENDS[spec.backend](spec)
+                with Span("model_load"):
+                    model.load()
+                MODEL_MEMORY.labels(spec.label).inc(model.memory_bytes)
+                logger.info(
+                    f"Модель загружена: {spec.label} ({spec.device}), "
+                    f"{model.memory_bytes / 1024 ** 2:.0f} МБ"
+                )
+                self._models[spec] = model
+        return model
+
+    def unload(self, spec: ModelSpec):
+        """Выгрузка модели процесса; метрика памяти уменьшается"""
+        with self._lock:
+            model = self._models.pop(spec, None)
+            if model is None:
+                return
+            model.unload()
+            MODEL_MEMORY.labels(spec.label).dec(model.memory_bytes)
+            logger.info(f"Модель выгружена: {spec.label}")
+
+    def is_loaded(self, spec: ModelSpec) -> bool:
+        return spec in self._models
+
+
+_model_registry = ModelRegistry()
+
+
+def get_model(spec: Optional[ModelSpec] = None) -> WhisperBackend:
+    """Модель распознавания процесса (по умолчанию — из переменных окружения)"""
+    return _model_registry.get(spec or ModelSpec.from_env())
+
+
+def unload_model(spec: Optional[ModelSpec] = None):
+    """Выгрузка модели процесса, например перед сменой ModelSpec"""
+    _model_registry.unload(spec or ModelSpec.from_env())
@@ -0,0 +1,526 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from models.schemas import HighlightSegment
+from services.task_store import get_task_store
+from services.job_queue import queue_limits
+from services.progress import ProgressTracker, is_terminal, update_task
+from services.checkpoints import TaskCheckpoints, run_with_retries
+from services.admission import get_admission_controller
+from services.storage import CLIPS_TTL, INTERMEDIATE_TTL, get_storage_manager
+from utils.audio import SAMPLE_RATE, num_samples
+from utils.audio_features import audio_envelope
+from utils.media_probe import media_summary
+from utils.metrics import Span
+from utils.exceptions import StageBusy
+from utils.render_profiles import get_render_profile
+from utils.transcription_store import TranscriptionStore
+from utils.zip_stream import file_crc32
+
+logger = logging.getLogger(__name__)
+
+# Извлекать аудио потоком в память вместо промежуточного WAV
+AUDIO_IN_MEMORY = os.getenv("AUDIO_IN_MEMORY", "true").lower() in ("1", "true", "yes")
+
+# Режим конвейера: full — скачивание видео целиком; audio_first — на первом этапе
+# скачивается только аудио, а для хайлайтов — только нужные фрагменты видео
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "full")
+
+# Сервисы создаются лениво: воркер рендеринга не загружает Whisper,
+# а воркер скачивания — ни Whisper, ни редактор
+_services: Dict[str, object] = {}
+
+
+def get_video_processor():
+    if "video_processor" not in _services:
+        from services.video_processor import VideoProcessor
+        _services["video_processor"] = VideoProcessor()
+    return _services["video_processor"]
+
+
+def get_audio_transcriber():
+    if "audio_transcriber" not in _services:
+        from services.audio_transcriber import AudioTranscriber
+        _services["audio_transcriber"] = AudioTranscriber()
+    return _services["audio_transcriber"]
+
+
+def get_video_editor():
+    if "video_editor" not in _services:
+        from services.video_editor import VideoEditor
+        _services["video_editor"] = VideoEditor()
+    return _services["video_editor"]
+
+
+def _mark_failed(task_id: str, error: Exception):
+    update_task(task_id, {
+        "status": "failed",
+        "error": str(error),
+        "failed_at": datetime.now().isoformat()
+    })
+    get_admission_controller().release(task_id)
+
+
+async def download_stage(task_id: str, video_url: str, job_queue) -> None:
+    """
+    Этап 1а: скачивание видео или только аудио, затем постановка
+    транскрипции в очередь transcribe
+    """
+    # Повторная доставка задания, которое уже довели до конца
+    if is_terminal(get_task_store().get(task_id)):
+        return
+    checkpoints = TaskCheckpoints(task_id)
+    try:
+        async with checkpoints.lease("download"):
+            await run_with_retries(
+                "download", task_id,
+                lambda: _download_attempt(task_id, video_url, job_queue, checkpoints)
+            )
+
+    except StageBusy:
+        # Задание должно вернуться в очередь, а не считаться выполненным
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обработке видео {task_id}: {str(e)}")
+        _mark_failed(task_id, e)
+
+
+async def _download_attempt(
+    task_id: str,
+    video_url: str,
+    job_queue,
+    checkpoints: TaskCheckpoints
+) -> None:
+    video_path = None
+    video_processor = get_video_processor()
+    try:
+        saved = checkpoints.get("download")
+        if saved and video_processor.retain_video(saved["source_path"]):
+            # Файл уже скачан до перезапуска — осталось поставить транскрипцию
+            video_path = saved["source_path"]
+            media = saved["media"]
+            logger.info(f"Задача {task_id}: скачивание восстановлено из контрольной точки")
+        else:
+            # Обратное давление: пока транскрипция не разобрала очередь, новые видео
+            # не скачиваются — иначе сеть и диск убегают далеко вперёд Whisper
+            # Задание при этом не держит слот скачивания, а возвращается в очередь
+            limit = queue_limits()["transcribe"]
+            if not await job_queue.has_capacity("transcribe", limit):
+                update_task(task_id, {"stage": "waiting_transcription_capacity"})
+                raise StageBusy(
+                    f"Очередь transcribe заполнена (лимит {limit})",
+                    retry_after=job_queue.backpressure_retry
+                )
+
+            logger.info(f"Начинаю обработку видео {video_url}")
+            update_task(task_id, {"stage": "downloading"})
+
+            # Скачивание видео или только аудио (или получение из кэша загрузок);
+            # оборванная загрузка продолжается с .part-файла
+            progress = ProgressTracker(task_id, "download")
+            if PIPELINE_MODE == "audio_first":
+                video_path = await video_processor.download_audio(video_url, progress)
+            else:
+                video_path = await video_processor.download_video(video_url, progress)
+            progress(1.0)
+
+            # Один probe на источник: по нему проверяются запросы хайлайтов
+            media = media_summary(await video_processor.probe_media(video_path))
+            checkpoints.save("download", {"source_path": video_path, "media": media})
+
+        update_task(task_id, {
+            "stage": "queued_transcription",
+            "source_path": video_path,
+            "pipeline_mode": PIPELINE_MODE,
+            "media": media
+        })
+        # Транскрипция наследует приоритет, назначенный при приёме задания
+        priority = (get_task_store().get(task_id) or {}).get("priority")
+        await job_queue.submit("transcribe", priority=priority, task_id=task_id)
+
+    finally:
+        if video_path:
+            video_processor.release_video(video_path)
+
+
+async def transcribe_stage(task_id: str) -> None:
+    """Этап 1б: извлечение аудио и транскрипция"""
+    if is_terminal(get_task_store().get(task_id)):
+        return
+    checkpoints = TaskCheckpoints(task_id)
+    try:
+        async with checkpoints.lease("transcribe"):
+            try:
+                await run_with_retries(
+                    "transcribe", task_id, lambda: _transcribe_attempt(task_id, checkpoints)
+                )
+            except Exception:
+                # Попытки исчерпаны: сохранённое для повтора аудио больше не нужно
+                _discard_audio_checkpoint(checkpoints)
+                raise
+
+    except StageBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обработке видео {task_id}: {str(e)}")
+        _mark_failed(task_id, e)
+
+
+async def _transcribe_attempt(task_id: str, checkpoints: TaskCheckpoints) -> None:
+    task_store = get_task_store()
+    video_path = None
+    video_processor = get_video_processor()
+    try:
+        task = task_store.get(task_id)
+        update_task(task_id, {"stage": "transcribing"})
+
+        # Файл из кэша загрузок; если его уже вытеснили — скачиваем заново
+        video_path = task["source_path"]
+        if not video_processor.retain_video(video_path):
+            if task.get("pipeline_mode") == "audio_first":
+                video_path = await video_processor.download_audio(task["video_url"])
+            else:
+                video_path = await video_processor.download_video(task["video_url"])
+
+        # Аудио, извлечённое до перезапуска (WAV или файл сброса PCM), используется повторно
+        saved = checkpoints.get("audio")
+        audio = video_processor.reopen_audio(saved) if saved else None
+        if audio is None:
+            # Извлечение аудио: в память (без WAV на диске) или в WAV файл
+            if AUDIO_IN_MEMORY:
+                audio = await video_processor.extract_audio_pcm(video_path, task_id)
+            else:
+                audio = await video_processor.extract_audio(video_path, task_id)
+            reference = video_processor.audio_reference(audio)
+            if reference:
+                checkpoints.save("audio", reference)
+        else:
+            logger.info(f"Задача {task_id}: аудио восстановлено из контрольной точки")
+
+        # Транскрипция; готовые чанки сохраняются в контрольных точках
+        progress = ProgressTracker(task_id, "transcription")
+        with video_processor.hold_audio(audio):
+            # Огибающая громкости для автоподбора хайлайтов: после транскрипции
+            # аудио удаляется, а детектору нужен только этот компактный ряд
+            if not checkpoints.get("audio_features"):
+                with Span("audio_features", media_seconds=num_samples(audio) / SAMPLE_RATE):
+                    features = await asyncio.to_thread(audio_envelope, audio)
+                await asyncio.to_thread(task_store.put_payload, task_id, "audio_features", features)
+                checkpoints.save("audio_features", {"frames": len(features["loudness_db"])})
+            transcription = await get_audio_transcriber().transcribe(audio, progress, checkpoints)
+        progress(1.0)
+
+        # Транскрипция хранится отдельно от записи статуса
+        await asyncio.to_thread(task_store.put_payload, task_id, "transcription", transcription)
+
+        # Обновление статуса
+        update_task(task_id, {
+            "status": "completed",
+            "stage": "completed",
+            "completed_at": datetime.now().isoformat(),
+            "video_path": video_path
+        })
+        get_admission_controller().release(task_id)
+
+        # WAV или файл сброса PCM нужен только транскрипции
+        video_processor.discard_audio(audio)
+        checkpoints.clear("audio")
+
+        logger.info(f"Обработка видео {task_id} завершена")
+
+    finally:
+        if video_path:
+            video_processor.release_video(video_path)
+
+
+async def _download_sections(
+    video_processor,
+    checkpoints: TaskCheckpoints,
+    video_url: str,
+    highlights: List[HighlightSegment],
+    sections_dir: Path,
+    progress_callback,
+    temporary: bool
+) -> List[Tuple[str, float]]:
+    """
+    Фрагменты видео под хайлайты. Фрагменты, скачанные до повтора или
+    перезапуска, берутся из контрольной точки; скачиваются только недостающие
+    """
+    ranges = [(h.start_time, h.end_time) for h in highlights]
+    saved = checkpoints.get("sections") or {}
+    sources = {
+        tuple(item["range"]): (item["file"], item["section_start"])
+        for item in saved.get("sources", [])
+        if Path(item["file"]).exists()
+    }
+    missing = [r for r in dict.fromkeys(ranges) if r not in sources]
+    if sources:
+        logger.info(
+            f"Фрагменты из контрольной точки: {len(ranges) - len(missing)}, "
+            f"скачать: {len(missing)}"
+        )
+
+    if missing:
+        downloaded = await video_processor.download_sections(
+            video_url, missing, sections_dir, progress_callback
+        )
+        sources.update(zip(missing, downloaded))
+        checkpoints.save("sections", {
+            "dir": str(sections_dir),
+            "temporary": temporary,
+            "sources": [
+                {"range": list(r), "file": file, "section_start": section_start}
+                for r, (file, section_start) in sources.items()
+            ]
+        })
+    return [sources[r] for r in ranges]
+
+
+def _discard_sections_checkpoint(checkpoints: TaskCheckpoints):
+    saved = checkpoints.get("sections")
+    if saved:
+        if saved.get("temporary"):
+            get_storage_manager().remove(saved["dir"])
+        checkpoints.clear("sections")
+
+
+def _discard_audio_checkpoint(checkpoints: TaskCheckpoints):
+    saved = checkpoints.get("audio")
+    if saved:
+        get_video_processor().discard_audio(saved["path"])
+        checkpoints.clear("audio")
+
+
+async def render_stage(
+    highlight_task_id: str,
+    original_task_id: str,
+    highlights: List[Dict],
+    profile: Optional[str] = None,
+    upgrade_from: Optional[str] = None
+) -> None:
+    """
+    Этап 2: создание клипов с хайлайтами. upgrade_from — задача-черновик
+    (профиль preview), чьи субтитры и скачанные фрагменты используются
+    повторно: транскрипция не читается, видео заново не скачивается
+    (в режиме full исходник закреплён в кэше загрузок за черновиком). Клипы, дорендеренные до
+    перезапуска, не рендерятся заново.
+    """
+    if is_terminal(get_task_store().get(highlight_task_id)):
+        return
+    checkpoints = TaskCheckpoints(highlight_task_id)
+    try:
+        async with checkpoints.lease("render"):
+            try:
+                await run_with_retries(
+                    "render", highlight_task_id,
+                    lambda: _render_attempt(
+                        highlight_task_id, original_task_id, highlights, checkpoints,
+                        profile, upgrade_from
+                    )
+                )
+            except Exception:
+                # Попытки исчерпаны: фрагменты, сохранённые для повтора, больше не нужны
+                _discard_sections_checkpoint(checkpoints)
+                raise
+
+    except StageBusy:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при создании хайлайтов {highlight_task_id}: {str(e)}")
+        _mark_failed(highlight_task_id, e)
+
+
+def _clip_intact(clip: Dict) -> bool:
+    """Клип из записи задачи цел: файл на месте и его размер совпадает"""
+    path = Path(clip["file"])
+    return path.exists() and path.stat().st_size == clip["size"]
+
+
+async def _render_attempt(
+    highlight_task_id: str,
+    original_task_id: str,
+    highlights: List[Dict],
+    checkpoints: TaskCheckpoints,
+    profile: Optional[str] = None,
+    upgrade_from: Optional[str] = None
+) -> None:
+    task_store = get_task_store()
+    highlights = [HighlightSegment(**h) if isinstance(h, dict) else h for h in highlights]
+    video_path = None
+    video_processor = get_video_processor()
+    # Ссылки на каталоги, которые нельзя удалять, пока идёт рендеринг
+    holds = []
+    try:
+        render_profile = get_render_profile(profile)
+        video_editor = get_video_editor()
+        storage = get_storage_manager()
+        logger.info(
+            f"Создаю хайлайты для задачи {original_task_id} (профиль {render_profile.name})"
+        )
+
+        # Каталог клипов учитывается сразу: если рендеринг упадёт, его удалит очистка
+        clips_dir = video_editor.clips_dir(highlight_task_id)
+        storage.register(clips_dir, "clips", highlight_task_id, ttl=CLIPS_TTL)
+        holds.append(storage.acquire(clips_dir))
+
+        # Клипы, записанные в задачу до перезапуска, — контрольные точки рендеринга.
+        # Файл попадает в запись только после окончания кодирования
+        ready_clips = [
+            clip for clip in (task_store.get(highlight_task_id) or {}).get("clips") or []
+            if _clip_intact(clip)
+        ]
+        if ready_clips:
+            logger.info(f"Задача {highlight_task_id}: готово клипов до перезапуска: {len(ready_clips)}")
+
+        update_task(highlight_task_id, {
+            "stage": "rendering",
+            "profile": render_profile.name,
+            "clips_dir": str(clips_dir),
+            "clips_total": len(highlights),
+            "clips": ready_clips
+        })
+
+        # Готовые клипы публикуются сразу: их можно скачивать, пока рендерятся остальные
+        async def on_clip_ready(index: int, path: Path):
+            size = path.stat().st_size
+            crc = await asyncio.to_thread(file_crc32, str(path))
+            clip = {
+                "index": index,
+                "file": str(path),
+                "name": path.name,
+                "size": size,
+                "crc32": crc,
+                "title": highlights[index].title
+            }
+            if render_profile.keep_intermediates:
+                clip["subtitles"] = str(video_editor.subtitle_path(path))
+            ready_clips.append(clip)
+            update_task(highlight_task_id, {"clips": sorted(ready_clips, key=lambda c: c["index"])})
+
+        progress = ProgressTracker(highlight_task_id, "render")
+
+        original_task = task_store.get(original_task_id)
+        render_options = dict(
+            task_id=highlight_task_id,
+            on_clip_ready=on_clip_ready,
+            progress_callback=progress,
+            profile=render_profile,
+            skip={clip["index"] for clip in ready_clips}
+        )
+        transcription = None
+        sources = None
+
+        if upgrade_from:
+            # Перерендер черновика: субтитры уже готовы, транскрипция не нужна
+            preview_task = task_store.get(upgrade_from)
+            preview_dir = video_editor.clips_dir(upgrade_from)
+            holds.append(storage.acquire(preview_dir))
+            if not preview_dir.exists():
+                raise Exception("Файлы черновика уже удалены по истечении срока хранения")
+            preview_clips = sorted(preview_task["clips"], key=lambda c: c["index"])
+            render_options["subtitle_paths"] = [c["subtitles"] for c in preview_clips]
+            if preview_task.get("sources"):
+                sources = [tuple(source) for source in preview_task["sources"]]
+        else:
+            # Компактное колоночное представление с индексом по времени
+            transcription = TranscriptionStore.from_dict(
+                await asyncio.to_thread(task_store.get_payload, original_task_id, "transcription")
+            )
+
+        if sources:
+            await video_editor.create_highlights(
+                original_task["video_path"],
+                highlights,
+                transcription,
+                sources=sources,
+                **render_options
+            )
+        elif original_task.get("pipeline_mode") == "audio_first":
+            # Скачиваем только фрагменты видео под запрошенные хайлайты.
+            # Фрагменты черновика остаются рядом с клипами для чистового перерендера
+            if render_profile.keep_intermediates:
+                sections_dir = video_editor.clips_dir(highlight_task_id) / "sections"
+            else:
+                sections_dir = video_processor.upload_dir / "sections" / highlight_task_id
+                storage.register(sections_dir, "sections", highlight_task_id, ttl=INTERMEDIATE_TTL)
+            sources = await _download_sections(
+                video_processor,
+                checkpoints,
+                original_task["video_url"],
+                highlights,
+                sections_dir,
+                ProgressTracker(highlight_task_id, "download_sections"),
+                temporary=not render_profile.keep_intermediates
+            )
+            await video_editor.create_highlights(
+                original_task["video_path"],
+                highlights,
+                transcription,
+                sources=sources,
+                **render_options
+            )
+            # При ошибке фрагменты остаются для повтора; удаляются после успеха
+            # или в render_stage, когда попытки исчерпаны
+            if not render_profile.keep_intermediates:
+                storage.remove(sections_dir)
+            checkpoints.clear("sections")
+            if render_profile.keep_intermediates:
+                update_task(highlight_task_id, {"sources": [list(source) for source in sources]})
+        elif upgrade_from:
+            # Перерендер черновика в режиме full: исходник закреплён в кэше
+            # загрузок за черновиком и заново не скачивается
+            source_path = preview_task.get("source_path")
+            if not source_path or not video_processor.retain_video(source_path):
+                raise Exception("Исходное видео черновика уже удалено из кэша загрузок")
+            video_path = source_path
+            await video_editor.create_highlights(
+                video_path,
+                highlights,
+                transcription,
+                **render_options
+            )
+        else:
+            # Видео берётся через кэш загрузок: ссылка защищает файл от вытеснения,
+            # а если он уже вытеснен — он будет скачан заново
+            video_path = await video_processor.download_video(
+                original_task["video_url"],
+                ProgressTracker(highlight_task_id, "download")
+            )
+
+            # Создание видео с хайлайтами
+            await video_editor.create_highlights(
+                video_path,
+                highlights,
+                transcription,
+                **render_options
+            )
+            if render_profile.keep_intermediates:
+                # Исходник черновика остаётся в кэше, пока черновик можно перерендерить
+                video_processor.pin_video(video_path, highlight_task_id, CLIPS_TTL)
+                update_task(highlight_task_id, {"source_path": video_path})
+
+        # Срок хранения клипов отсчитывается от окончания рендеринга
+        storage.update_size(clips_dir)
+        storage.touch(clips_dir, ttl=CLIPS_TTL)
+
+        # Обновление статуса
+        update_task(highlight_task_id, {
+            "status": "completed",
+            "stage": "completed",
+            # Черновик можно перерендерить в чистовом качестве
+            "upgradable": render_profile.keep_intermediates,
+            "completed_at": datetime.now().isoformat()
+        })
+        get_admission_controller().release(highlight_task_id)
+
+        logger.info(f"Хайлайты для задачи {highlight_task_id} созданы")
+
+    finally:
+        for token in holds:
+            get_storage_manager().release(token)
+        if video_path:
+            video_processor.release_video(video_path)
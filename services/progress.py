@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Dict, Optional, Set
+
+from services.task_store import get_task_store
+
+logger = logging.getLogger(__name__)
+
+# Не чаще одного события прогресса в шину за интервал (секунды)
+PROGRESS_EVENT_INTERVAL = float(os.getenv("PROGRESS_EVENT_INTERVAL", "0.5"))
+# Запись прогресса в хранилище задач — реже, для клиентов, которые опрашивают статус
+PROGRESS_STORE_INTERVAL = float(os.getenv("PROGRESS_STORE_INTERVAL", "5.0"))
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class Subscription(ABC):
+    """Подписка на события одной задачи"""
+
+    @abstractmethod
+    async def get(self, timeout: float) -> Optional[Dict]:
+        """Следующее событие или None, если за timeout событий не было"""
+
+    @abstractmethod
+    async def close(self):
+        """Отписка"""
+
+
+class ProgressBus(ABC):
+    """
+    Шина событий прогресса от воркеров к API. publish можно вызывать
+    из любого потока (хуки yt-dlp работают в потоке загрузки).
+    """
+
+    @abstractmethod
+    def publish(self, task_id: str, event: Dict):
+        """Отправка события подписчикам задачи"""
+
+    @abstractmethod
+    async def subscribe(self, task_id: str) -> Subscription:
+        """Подписка на события задачи"""
+
+
+class _QueueSubscription(Subscription):
+    def __init__(self, bus: "InProcessProgressBus", task_id: str):
+        self.bus = bus
+        self.task_id = task_id
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+
+    def push(self, event: Dict):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Медленный клиент: промежуточные события прогресса можно потерять
+            pass
+
+    async def get(self, timeout: float) -> Optional[Dict]:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self.bus._unsubscribe(self)
+
+
+class InProcessProgressBus(ProgressBus):
+    """Шина в памяти процесса — для очереди заданий inprocess"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Set[_QueueSubscription]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, task_id: str, event: Dict):
+        with self._lock:
+            subscribers = list(self._subscribers.get(task_id, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.push, event)
+            except RuntimeError:
+                # Цикл подписчика уже закрыт
+                continue
+
+    async def subscribe(self, task_id: str) -> Subscription:
+        subscription = _QueueSubscription(self, task_id)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, subscription: _QueueSubscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.task_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.task_id]
+
+
+class _RedisSubscription(Subscription):
+    def __init__(self, client, pubsub):
+        self.client = client
+        self.pubsub = pubsub
+
+    async def get(self, timeout: float) -> Optional[Dict]:
+        message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if message is None:
+            return None
+        return json.loads(message["data"])
+
+    async def close(self):
+        await self.pubsub.unsubscribe()
+        await self.pubsub.close()
+        await self.client.close()
+
+
+class RedisProgressBus(ProgressBus):
+    """Redis Pub/Sub: события из воркеров Celery доходят до любого процесса API"""
+
+    def __init__(self, url: str):
+        import redis
+
+        self.url = url
+        self.client = redis.Redis.from_url(url)
+
+    def _channel(self, task_id: str) -> str:
+        return f"progress:{task_id}"
+
+    def publish(self, task_id: str, event: Dict):
+        try:
+            self.client.publish(self._channel(task_id), json.dumps(event, ensure_ascii=False))
+        except Exception as e:
+            # Прогресс не должен ронять обработку
+            logger.warning(f"Не удалось отправить событие прогресса {task_id}: {str(e)}")
+
+    async def subscribe(self, task_id: str) -> Subscription:
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(self._channel(task_id))
+        return _RedisSubscription(client, pubsub)
+
+
+def create_progress_bus() -> ProgressBus:
+    """
+    Выбор шины по PROGRESS_BUS: inprocess | redis. По умолчанию redis,
+    если задания выполняют воркеры Celery, иначе inprocess.
+    """
+    default = "redis" if os.getenv("JOB_QUEUE", "inprocess").lower() == "celery" else "inprocess"
+    backend = os.getenv("PROGRESS_BUS", default).lower()
+    if backend == "redis":
+        bus = RedisProgressBus(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        bus = InProcessProgressBus()
+    logger.info(f"Шина прогресса: {type(bus).__name__}")
+    return bus
+
+
+_progress_bus: Optional[ProgressBus] = None
+
+
+def get_progress_bus() -> ProgressBus:
+    """Общий для процесса экземпляр шины прогресса"""
+    global _progress_bus
+    if _progress_bus is None:
+        _progress_bus = create_progress_bus()
+    return _progress_bus
+
+
+def update_task(task_id: str, fields: Dict):
+    """Обновление записи задачи с рассылкой изменений подписчикам"""
+    get_task_store().update(task_id, fields)
+    get_progress_bus().publish(task_id, dict(fields, type="status"))
+
+
+def publish_event(task_id: str, event_type: str, data: Dict):
+    get_progress_bus().publish(task_id, dict(data, type=event_type))
+
+
+class ProgressTracker:
+    """
+    Прогресс одного этапа задачи. Вызывается как progress(доля, **детали)
+    из любого потока. В шину — не чаще PROGRESS_EVENT_INTERVAL, в хранилище
+    задач — не чаще PROGRESS_STORE_INTERVAL; завершение этапа (1.0)
+    отправляется всегда.
+    """
+
+    def __init__(self, task_id: str, stage: str):
+        self.task_id = task_id
+        self.stage = stage
+        self._lock = threading.Lock()
+        self._last_event = 0.0
+        self._last_store = 0.0
+        self._last_value = -1.0
+
+    def __call__(self, fraction: float, **details):
+        fraction = min(1.0, max(0.0, fraction))
+        now = time.monotonic()
+        with self._lock:
+            final = fraction >= 1.0
+            if fraction <= self._last_value and not final:
+                return
+            send_event = final or now - self._last_event >= PROGRESS_EVENT_INTERVAL
+            write_store = final or now - self._last_store >= PROGRESS_STORE_INTERVAL
+            if not send_event and not write_store:
+                return
+            self._last_value = fraction
+            if send_event:
+                self._last_event = now
+            if write_store:
+                self._last_store = now
+
+        progress = {"stage": self.stage, "value": round(fraction, 4), **details}
+        if send_event:
+            publish_event(self.task_id, "progress", progress)
+        if write_store:
+            get_task_store().update(self.task_id, {
+                "progress": dict(progress, updated_at=datetime.now().isoformat())
+            })
+
+
+def is_terminal(record: Optional[Dict]) -> bool:
+    return bool(record) and record.get("status") in TERMINAL_STATUSES
+
+
+def sse_format(event_type: str, data: Dict) -> str:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
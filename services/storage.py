@@ -0,0 +1,287 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from utils.metrics import STORAGE_BYTES, STORAGE_EVICTED_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Общий бюджет на клипы и промежуточные файлы задач; скачанные видео
+# ограничивает собственный кэш загрузок (DOWNLOAD_CACHE_MAX_GB)
+STORAGE_MAX_BYTES = int(float(os.getenv("STORAGE_MAX_GB", "20")) * 1024 ** 3)
+# Сколько хранятся клипы после последнего обращения
+CLIPS_TTL = float(os.getenv("CLIPS_TTL_HOURS", "24")) * 3600
+# Страховочный срок для промежуточных файлов (WAV, фрагменты видео), если
+# задача упала раньше, чем удалила их сама
+INTERMEDIATE_TTL = float(os.getenv("INTERMEDIATE_TTL_MINUTES", "60")) * 60
+# Клипы, отданные целым ZIP, удаляются через этот срок (повтор оборвавшейся загрузки)
+CONSUMED_GRACE = float(os.getenv("CONSUMED_GRACE_SECONDS", "300"))
+# Ссылка, которую процесс не снял (например, упал), перестаёт защищать файл
+REF_LEASE = float(os.getenv("STORAGE_REF_LEASE_HOURS", "12")) * 3600
+SWEEP_INTERVAL = float(os.getenv("STORAGE_SWEEP_INTERVAL", "30"))
+# Удалений за один шаг: очистка идёт порциями и не блокирует диск надолго
+SWEEP_BATCH = int(os.getenv("STORAGE_SWEEP_BATCH", "20"))
+
+
+def disk_usage(path: Path) -> int:
+    """Размер файла или суммарный размер файлов каталога"""
+    path = Path(path)
+    try:
+        if path.is_dir():
+            return sum(p.stat().st_size for p in path.rglob('*') if p.is_file())
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def delete_path(path: Path):
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        path.unlink(missing_ok=True)
+
+
+class StorageManager:
+    """
+    Учёт файлов, которые создают задачи (каталоги клипов, WAV, фрагменты
+    видео). Индекс в SQLite (WAL) общий для API и воркеров на одном томе:
+    файлы не ищутся обходом каталогов. Файл с активной ссылкой (рендеринг,
+    отдача клиенту) не удаляется; остальные удаляются по истечении срока
+    (expires_at) и по LRU, пока суммарный объём больше бюджета.
+    """
+
+    def __init__(self, db_path: str, max_bytes: int = STORAGE_MAX_BYTES):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifacts ("
+            "path TEXT PRIMARY KEY, kind TEXT NOT NULL, task_id TEXT, "
+            "size INTEGER NOT NULL, created_at REAL NOT NULL, "
+            "last_access REAL NOT NULL, expires_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS artifacts_last_access ON artifacts (last_access)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS artifacts_expires_at ON artifacts (expires_at)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS artifact_refs ("
+            "token TEXT PRIMARY KEY, path TEXT NOT NULL, acquired_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS artifact_refs_path ON artifact_refs (path)"
+        )
+
+    def register(
+        self,
+        path,
+        kind: str,
+        task_id: Optional[str] = None,
+        ttl: Optional[float] = None
+    ):
+        """Учёт файла или каталога задачи; ttl — срок хранения от текущего момента"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO artifacts "
+                "(path, kind, task_id, size, created_at, last_access, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(path), kind, task_id, disk_usage(path), now, now,
+                 now + ttl if ttl is not None else None)
+            )
+
+    def update_size(self, path):
+        """Пересчёт размера после того, как файлы дописаны"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE artifacts SET size = ? WHERE path = ?",
+                (disk_usage(path), str(path))
+            )
+
+    def touch(self, path, ttl: Optional[float] = None):
+        """Обращение к файлу: продлевает LRU и, если задан ttl, срок хранения"""
+        now = time.time()
+        with self._lock:
+            if ttl is None:
+                self._conn.execute(
+                    "UPDATE artifacts SET last_access = ? WHERE path = ?", (now, str(path))
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE artifacts SET last_access = ?, expires_at = ? WHERE path = ?",
+                    (now, now + ttl, str(path))
+                )
+
+    def expire_after(self, path, seconds: float):
+        """Сокращение срока хранения (файл использован и больше не нужен)"""
+        deadline = time.time() + seconds
+        with self._lock:
+            self._conn.execute(
+                "UPDATE artifacts SET expires_at = MIN(COALESCE(expires_at, ?), ?) WHERE path = ?",
+                (deadline, deadline, str(path))
+            )
+
+    def acquire(self, path) -> str:
+        """Ссылка, защищающая файл от удаления; снимается через release(token)"""
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO artifact_refs (token, path, acquired_at) VALUES (?, ?, ?)",
+                (token, str(path), time.time())
+            )
+        return token
+
+    def release(self, token: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM artifact_refs WHERE token = ?", (token,))
+
+    @contextmanager
+    def hold(self, path):
+        token = self.acquire(path)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def remove(self, path, force: bool = False) -> bool:
+        """
+        Удаление промежуточного файла, который уже использован. Если на файл
+        есть активные ссылки, удаление откладывается: срок хранения истекает
+        сразу, и файл удалит очистка после снятия ссылок. force — удалить
+        без проверки ссылок. Возвращает True, если файл удалён сейчас.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                referenced = not force and self._conn.execute(
+                    "SELECT 1 FROM artifact_refs WHERE path = ? AND acquired_at >= ? LIMIT 1",
+                    (str(path), now - REF_LEASE)
+                ).fetchone() is not None
+                if referenced:
+                    self._conn.execute(
+                        "UPDATE artifacts SET expires_at = ? WHERE path = ?", (now, str(path))
+                    )
+                else:
+                    self._conn.execute("DELETE FROM artifacts WHERE path = ?", (str(path),))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if referenced:
+            logger.info(f"Хранилище: {path} используется, удаление отложено")
+            return False
+        delete_path(Path(path))
+        return True
+
+    def forget(self, path):
+        with self._lock:
+            self._conn.execute("DELETE FROM artifacts WHERE path = ?", (str(path),))
+
+    def total_bytes(self) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM artifacts").fetchone()
+        return row[0]
+
+    def sweep_step(self, batch: int = SWEEP_BATCH) -> int:
+        """
+        Одна порция очистки: сначала просроченные файлы, затем давно не
+        использованные, если превышен бюджет. Возвращает число удалённых.
+        """
+        now = time.time()
+        victims: List[Tuple[str, str, int, str]] = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM artifact_refs WHERE acquired_at < ?", (now - REF_LEASE,)
+                )
+                unreferenced = (
+                    "NOT EXISTS (SELECT 1 FROM artifact_refs r WHERE r.path = artifacts.path)"
+                )
+                for path, kind, size in self._conn.execute(
+                    f"SELECT path, kind, size FROM artifacts "
+                    f"WHERE expires_at IS NOT NULL AND expires_at <= ? AND {unreferenced} "
+                    f"ORDER BY expires_at LIMIT ?",
+                    (now, batch)
+                ).fetchall():
+                    victims.append((path, kind, size, "ttl"))
+
+                total = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM artifacts"
+                ).fetchone()[0] - sum(v[2] for v in victims)
+                if total > self.max_bytes and len(victims) < batch:
+                    chosen = {v[0] for v in victims}
+                    for path, kind, size in self._conn.execute(
+                        f"SELECT path, kind, size FROM artifacts WHERE {unreferenced} "
+                        f"ORDER BY last_access LIMIT ?",
+                        (batch * 2,)
+                    ).fetchall():
+                        if total <= self.max_bytes or len(victims) >= batch:
+                            break
+                        if path in chosen:
+                            continue
+                        victims.append((path, kind, size, "quota"))
+                        total -= size
+
+                self._conn.executemany(
+                    "DELETE FROM artifacts WHERE path = ?", [(v[0],) for v in victims]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        # Файлы удаляются вне транзакции: индекс не ждёт диска
+        for path, kind, size, reason in victims:
+            delete_path(Path(path))
+            STORAGE_EVICTED_BYTES.labels(kind, reason).inc(size)
+            logger.info(f"Хранилище: удалён {path} ({kind}, {size} байт, причина: {reason})")
+
+        STORAGE_BYTES.set(self.total_bytes())
+        return len(victims)
+
+    async def run_sweeper(self, interval: float = SWEEP_INTERVAL):
+        """Фоновая очистка: порции подряд, пока есть что удалять, затем пауза"""
+        while True:
+            try:
+                deleted = await asyncio.to_thread(self.sweep_step)
+            except Exception as e:
+                logger.error(f"Ошибка очистки хранилища: {str(e)}")
+                deleted = 0
+            await asyncio.sleep(0 if deleted >= SWEEP_BATCH else interval)
+
+
+_storage_manager: Optional[StorageManager] = None
+
+
+def get_storage_manager() -> StorageManager:
+    """Общий для процесса экземпляр учёта файлов"""
+    global _storage_manager
+    if _storage_manager is None:
+        upload_dir = Path(os.getenv("UPLOAD_DIR", "./uploads"))
+        _storage_manager = StorageManager(
+            os.getenv("STORAGE_DB_PATH", str(upload_dir / "storage.sqlite3"))
+        )
+    return _storage_manager
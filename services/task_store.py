@@ -0,0 +1,272 @@
+import os
+import json
+import zlib
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _encode_payload(data: Any) -> bytes:
+    return zlib.compress(
+        json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    )
+
+
+def _decode_payload(data: bytes) -> Any:
+    return json.loads(zlib.decompress(data))
+
+
+class TaskStore(ABC):
+    """
+    Хранилище задач, общее для всех процессов API и воркеров.
+    Небольшие записи статуса хранятся отдельно от крупных данных (payload),
+    например транскрипции, чтобы опрос статуса не гонял мегабайты JSON.
+    """
+
+    @abstractmethod
+    def create(self, task_id: str, record: Dict):
+        """Создание записи задачи"""
+
+    @abstractmethod
+    def get(self, task_id: str) -> Optional[Dict]:
+        """Запись статуса задачи или None"""
+
+    @abstractmethod
+    def update(self, task_id: str, fields: Dict):
+        """Атомарное обновление полей записи"""
+
+    @abstractmethod
+    def put_payload(self, task_id: str, name: str, data: Any):
+        """Сохранение крупных данных задачи"""
+
+    @abstractmethod
+    def get_payload(self, task_id: str, name: str) -> Optional[Any]:
+        """Крупные данные задачи или None"""
+
+    @abstractmethod
+    def delete_payload(self, task_id: str, name: str):
+        """Удаление крупных данных задачи"""
+
+    def exists(self, task_id: str) -> bool:
+        return self.get(task_id) is not None
+
+
+class MemoryTaskStore(TaskStore):
+    """Хранилище в памяти процесса — только для разработки с одним воркером"""
+
+    def __init__(self):
+        self._records: Dict[str, Dict] = {}
+        self._payloads: Dict[tuple, bytes] = {}
+        self._lock = threading.Lock()
+
+    def create(self, task_id: str, record: Dict):
+        with self._lock:
+            self._records[task_id] = dict(record)
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        with self._lock:
+            record = self._records.get(task_id)
+            return dict(record) if record is not None else None
+
+    def update(self, task_id: str, fields: Dict):
+        with self._lock:
+            self._records.setdefault(task_id, {}).update(fields)
+
+    def put_payload(self, task_id: str, name: str, data: Any):
+        encoded = _encode_payload(data)
+        with self._lock:
+            self._payloads[(task_id, name)] = encoded
+
+    def get_payload(self, task_id: str, name: str) -> Optional[Any]:
+        with self._lock:
+            encoded = self._payloads.get((task_id, name))
+        return _decode_payload(encoded) if encoded is not None else None
+
+    def delete_payload(self, task_id: str, name: str):
+        with self._lock:
+            self._payloads.pop((task_id, name), None)
+
+
+class SQLiteTaskStore(TaskStore):
+    """
+    SQLite в режиме WAL: несколько процессов читают параллельно с записью,
+    обновления выполняются в транзакции BEGIN IMMEDIATE
+    """
+
+    def __init__(self, db_path: str):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            db_path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "task_id TEXT PRIMARY KEY, record TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS task_payloads ("
+            "task_id TEXT NOT NULL, name TEXT NOT NULL, data BLOB NOT NULL, "
+            "PRIMARY KEY (task_id, name))"
+        )
+
+    def create(self, task_id: str, record: Dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, record) VALUES (?, ?)",
+                (task_id, json.dumps(record, ensure_ascii=False))
+            )
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT record FROM tasks WHERE task_id = ?", (task_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, task_id: str, fields: Dict):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT record FROM tasks WHERE task_id = ?", (task_id,)
+                ).fetchone()
+                record = json.loads(row[0]) if row else {}
+                record.update(fields)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tasks (task_id, record) VALUES (?, ?)",
+                    (task_id, json.dumps(record, ensure_ascii=False))
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def put_payload(self, task_id: str, name: str, data: Any):
+        encoded = _encode_payload(data)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO task_payloads (task_id, name, data) VALUES (?, ?, ?)",
+                (task_id, name, encoded)
+            )
+
+    def get_payload(self, task_id: str, name: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM task_payloads WHERE task_id = ? AND name = ?",
+                (task_id, name)
+            ).fetchone()
+        return _decode_payload(row[0]) if row else None
+
+    def delete_payload(self, task_id: str, name: str):
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM task_payloads WHERE task_id = ? AND name = ?",
+                (task_id, name)
+            )
+
+
+class RedisTaskStore(TaskStore):
+    """
+    Redis: запись задачи — хэш task:<id> (значения полей в JSON), обновление
+    одним HSET атомарно; крупные данные — отдельные ключи task:<id>:payload:<name>.
+    Вместо настоящего клиента можно передать fakeredis.FakeRedis().
+    """
+
+    def __init__(self, url: Optional[str] = None, client=None, ttl_seconds: Optional[int] = None):
+        if client is None:
+            try:
+                import redis
+            except ImportError as e:
+                raise RuntimeError("Для TASK_STORE=redis нужен пакет redis") from e
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+
+    def _key(self, task_id: str) -> str:
+        return f"task:{task_id}"
+
+    def _payload_key(self, task_id: str, name: str) -> str:
+        return f"task:{task_id}:payload:{name}"
+
+    def _encode_fields(self, fields: Dict) -> Dict[str, str]:
+        return {key: json.dumps(value, ensure_ascii=False) for key, value in fields.items()}
+
+    def create(self, task_id: str, record: Dict):
+        key = self._key(task_id)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        if record:
+            pipe.hset(key, mapping=self._encode_fields(record))
+        if self.ttl_seconds:
+            pipe.expire(key, self.ttl_seconds)
+        pipe.execute()
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        raw = self.client.hgetall(self._key(task_id))
+        if not raw:
+            return None
+        return {
+            (k.decode() if isinstance(k, bytes) else k): json.loads(v)
+            for k, v in raw.items()
+        }
+
+    def update(self, task_id: str, fields: Dict):
+        if not fields:
+            return
+        key = self._key(task_id)
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping=self._encode_fields(fields))
+        # Срок хранения отсчитывается от последнего обновления: долгая задача
+        # не должна исчезнуть, пока она ещё выполняется
+        if self.ttl_seconds:
+            pipe.expire(key, self.ttl_seconds)
+        pipe.execute()
+
+    def put_payload(self, task_id: str, name: str, data: Any):
+        self.client.set(self._payload_key(task_id, name), _encode_payload(data), ex=self.ttl_seconds)
+
+    def get_payload(self, task_id: str, name: str) -> Optional[Any]:
+        encoded = self.client.get(self._payload_key(task_id, name))
+        return _decode_payload(encoded) if encoded is not None else None
+
+    def delete_payload(self, task_id: str, name: str):
+        self.client.delete(self._payload_key(task_id, name))
+
+
+def create_task_store() -> TaskStore:
+    """Выбор хранилища по переменной окружения TASK_STORE: sqlite | redis | memory"""
+    backend = os.getenv("TASK_STORE", "sqlite").lower()
+    if backend == "redis":
+        ttl = os.getenv("TASK_TTL_SECONDS")
+        store = RedisTaskStore(
+            url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            ttl_seconds=int(ttl) if ttl else None
+        )
+    elif backend == "memory":
+        store = MemoryTaskStore()
+    else:
+        store = SQLiteTaskStore(os.getenv("TASK_STORE_PATH", "./data/tasks.sqlite3"))
+    logger.info(f"Хранилище задач: {type(store).__name__}")
+    return store
+
+
+_task_store: Optional[TaskStore] = None
+
+
+def get_task_store() -> TaskStore:
+    """Общий для процесса экземпляр хранилища задач"""
+    global _task_store
+    if _task_store is None:
+        _task_store = create_task_store()
+    return _task_store
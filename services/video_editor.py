@@ -1,153 +1,445 @@
 import os
+import asyncio
 from pathlib import Path
-import subprocess
 import logging
-from typing import List, Dict
+from typing import Awaitable, Callable, List, Dict, Optional, Set, Tuple, Union
 from uuid import uuid4
-import zipfile
-import json
 import re
+import numpy as np
 from models.schemas import HighlightSegment
+from utils.process_runner import ProcessRunner, process_runner
+from utils.ffmpeg_progress import FfmpegProgressParser, progress_args
+from utils.media_probe import MediaProbe, crop_filter, range_errors, seek_lead_in
+from utils.metrics import BYTES_WRITTEN, Span
+from utils.render_profiles import RenderProfile, get_render_profile
+from utils.transcription_store import TranscriptionStore
 
 logger = logging.getLogger(__name__)
 
 class VideoEditor:
-    def __init__(self):
+    def __init__(self, runner: ProcessRunner = None):
+        self.runner = runner or process_runner
+        self.media_probe = MediaProbe(self.runner)
         self.output_dir = Path(os.getenv("OUTPUT_DIR", "./outputs"))
         self.output_dir.mkdir(exist_ok=True)
-        
-        # Параметры для TikTok формата
-        self.tiktok_width = 1080
-        self.tiktok_height = 1920
+
+        # Пул параллельного рендеринга: число одновременных кодирований и
+        # бюджет потоков на каждый ffmpeg, чтобы x264 не конкурировали за ядра
+        cpu_count = os.cpu_count() or 1
+        self.render_workers = max(1, int(os.getenv("RENDER_WORKERS", max(1, cpu_count // 4))))
+        self.threads_per_job = max(1, int(os.getenv(
+            "FFMPEG_THREADS_PER_JOB",
+            max(1, cpu_count // self.render_workers)
+        )))
+
+        # Режим рендеринга: auto | per_clip | single_pass
+        self.render_mode = os.getenv("RENDER_MODE", "auto")
+        # Условная стоимость запуска ffmpeg в секундах медиа; декодирование от
+        # ключевого кадра до точки входа добавляется по индексу ключевых кадров
+        self.seek_overhead = float(os.getenv("RENDER_SEEK_OVERHEAD", "2.0"))
+        self.single_pass_max_outputs = int(os.getenv("SINGLE_PASS_MAX_OUTPUTS", "16"))
         
     async def create_highlights(
         self,
         video_path: str,
         highlights: List[HighlightSegment],
-        transcription: Dict
-    ) -> str:
+        transcription: Dict,
+        sources: Optional[List[Tuple[str, float]]] = None,
+        task_id: Optional[str] = None,
+        on_clip_ready: Optional[Callable[[int, Path], Awaitable[None]]] = None,
+        progress_callback: Optional[Callable[..., None]] = None,
+        profile: Union[str, RenderProfile, None] = None,
+        subtitle_paths: Optional[List[str]] = None,
+        skip: Optional[Set[int]] = None
+    ) -> List[str]:
+        """
+        Возвращает пути готовых клипов в порядке хайлайтов. Клипы пишутся в
+        каталог OUTPUT_DIR/<task_id>; on_clip_ready(index, path) вызывается,
+        как только очередной клип дорендерен, — его уже можно отдавать.
+        progress_callback(доля) — общий прогресс по выводу `ffmpeg -progress`.
+
+        sources — для каждого хайлайта отдельный файл-фрагмент и время его
+        начала в исходном видео (скачивание только нужных секций); в этом
+        случае video_path используется только для имён файлов.
+
+        profile — профиль качества (preview | standard | final). Субтитры
+        черновика остаются рядом с клипами (<клип>.ass); subtitle_paths —
+        готовые ASS-файлы для перерендера без транскрипции.
+
+        skip — индексы клипов, уже готовых после прерванной попытки: они не
+        рендерятся заново, on_clip_ready для них не вызывается
+        """
         try:
             video_path = Path(video_path)
-            task_id = uuid4().hex
-            work_dir = self.output_dir / task_id
-            work_dir.mkdir(exist_ok=True)
+            profile = profile if isinstance(profile, RenderProfile) else get_render_profile(profile)
+            task_id = task_id or uuid4().hex
+            work_dir = self.clips_dir(task_id)
+            work_dir.mkdir(parents=True, exist_ok=True)
+
+            if sources:
+                video_info = None
+            else:
+                video_info = await self.media_probe.probe(str(video_path))
+                errors = range_errors(
+                    video_info["duration"],
+                    [(h.start_time, h.end_time) for h in highlights]
+                )
+                if errors:
+                    raise Exception("; ".join(errors))
 
-            output_paths = []
+            owned_subtitles = subtitle_paths is None
+            if owned_subtitles:
+                ass_paths = self.prepare_subtitles(video_path, highlights, transcription, work_dir)
+            else:
+                ass_paths = [Path(path) for path in subtitle_paths]
+                missing = [str(path) for path in ass_paths if not path.exists()]
+                if missing:
+                    raise Exception(f"Не найдены файлы субтитров: {', '.join(missing)}")
 
+            skip = skip or set()
+            if sources or skip:
+                # Досрендер после перезапуска — только недостающие клипы
+                render_mode = "per_clip"
+            else:
+                render_mode = self._choose_render_mode(highlights, video_info)
+            logger.info(
+                f"Режим рендеринга: {render_mode}, профиль {profile.name} ({len(highlights)} клипов)"
+            )
+
+            try:
+                if render_mode == "single_pass":
+                    output_paths = await self._render_single_pass(
+                        video_path, video_info, highlights, ass_paths, work_dir, profile,
+                        progress_callback
+                    )
+                    # За один проход все клипы готовы одновременно
+                    if on_clip_ready:
+                        for i, path in enumerate(output_paths):
+                            await on_clip_ready(i, path)
+                else:
+                    output_paths = await self._render_per_clip(
+                        video_path, highlights, ass_paths, work_dir, profile, sources,
+                        on_clip_ready, progress_callback, skip
+                    )
+            finally:
+                # Чужие субтитры (перерендер черновика) не трогаем
+                if owned_subtitles and not profile.keep_intermediates:
+                    for ass_path in ass_paths:
+                        if ass_path.exists():
+                            ass_path.unlink()
+
+            # Архив на диске не собирается: ZIP отдаётся потоком из файлов клипов
+            logger.info(f"Клипы готовы: {work_dir}")
+            return [str(path) for path in output_paths]
+
+        except Exception as e:
+            logger.error(f"Ошибка: {str(e)}")
+            raise
+
+    def prepare_subtitles(
+        self,
+        video_path: Path,
+        highlights: List[HighlightSegment],
+        transcription: Dict,
+        work_dir: Path
+    ) -> List[Path]:
+        """ASS-файлы с караоке для всех хайлайтов: <клип>.ass в каталоге клипов"""
+        # Индекс по времени строится один раз на все клипы
+        store = TranscriptionStore.ensure(transcription)
+        ass_paths = []
+        with Span("subtitles"):
             for i, highlight in enumerate(highlights):
-                clip_path = work_dir / f"highlight_{i}_{video_path.stem}_tiktok.mp4"
-                
+                ass_path = self.subtitle_path(self._clip_path(work_dir, i, video_path))
+                self._create_ass_file(store, highlight.start_time, highlight.end_time, ass_path)
+                ass_paths.append(ass_path)
+        return ass_paths
+
+    def clips_dir(self, task_id: str) -> Path:
+        """Каталог клипов задачи"""
+        return self.output_dir / task_id
+
+    def _clip_path(self, work_dir: Path, index: int, video_path: Path) -> Path:
+        return work_dir / f"highlight_{index}_{video_path.stem}_tiktok.mp4"
+
+    def subtitle_path(self, clip_path: Path) -> Path:
+        return clip_path.with_suffix(".ass")
+
+    def _choose_render_mode(
+        self,
+        highlights: List[HighlightSegment],
+        video_info: Optional[Dict] = None
+    ) -> str:
+        """
+        Выбор режима рендеринга по оценке стоимости декодирования.
+        Поклиповый режим декодирует каждое окно отдельно (перекрытия дважды) и
+        платит за запуск каждого ffmpeg и декодирование от предыдущего
+        ключевого кадра до начала клипа; однопроходный декодирует весь охват
+        от первого до последнего хайлайта, включая промежутки между ними.
+        """
+        if self.render_mode != "auto":
+            return self.render_mode
+        if len(highlights) < 2 or len(highlights) > self.single_pass_max_outputs:
+            return "per_clip"
+
+        base_time = min(h.start_time for h in highlights)
+        span = max(h.end_time for h in highlights) - base_time
+        total_duration = sum(h.end_time - h.start_time for h in highlights)
+        lead_in = seek_lead_in(video_info or {}, [h.start_time for h in highlights])
+
+        per_clip_cost = total_duration + float(lead_in.sum()) + len(highlights) * self.seek_overhead
+        single_pass_cost = span + float(seek_lead_in(video_info or {}, [base_time])[0])
+
+        logger.debug(
+            f"Оценка стоимости рендеринга: per_clip={per_clip_cost:.1f}, "
+            f"single_pass={single_pass_cost:.1f}"
+        )
+        return "single_pass" if single_pass_cost < per_clip_cost else "per_clip"
+
+    async def _render_per_clip(
+        self,
+        video_path: Path,
+        highlights: List[HighlightSegment],
+        ass_paths: List[Path],
+        work_dir: Path,
+        profile: RenderProfile,
+        sources: Optional[List[Tuple[str, float]]] = None,
+        on_clip_ready: Optional[Callable[[int, Path], Awaitable[None]]] = None,
+        progress_callback: Optional[Callable[..., None]] = None,
+        skip: Set[int] = frozenset()
+    ) -> List[Path]:
+        """Отдельный ffmpeg на каждый клип, параллельно в пределах пула"""
+        semaphore = asyncio.Semaphore(self.render_workers)
+        completed = len(skip)
+
+        # Общий прогресс — доля уже закодированных секунд всех клипов
+        total_duration = sum(h.end_time - h.start_time for h in highlights) or 1.0
+        encoded = [
+            h.end_time - h.start_time if i in skip else 0.0
+            for i, h in enumerate(highlights)
+        ]
+
+        def clip_progress(i: int, duration: float):
+            if progress_callback is None:
+                return None
+
+            def update(seconds: float):
+                encoded[i] = min(seconds, duration)
+                progress_callback(
+                    sum(encoded) / total_duration,
+                    clips_done=completed,
+                    clips_total=len(highlights)
+                )
+
+            return update
+
+        # Один probe на каждый файл-источник (у секций он общий для нескольких клипов)
+        if sources:
+            source_paths = {source for i, (source, _) in enumerate(sources) if i not in skip}
+        else:
+            source_paths = {str(video_path)}
+        source_info = {path: await self.media_probe.probe(path) for path in source_paths}
+
+        async def render_clip(i: int, highlight: HighlightSegment) -> Path:
+            nonlocal completed
+            clip_path = self._clip_path(work_dir, i, video_path)
+            if i in skip:
+                return clip_path
+            source_path, source_offset = sources[i] if sources else (str(video_path), 0.0)
+
+            async with semaphore:
                 # Создаем видео с субтитрами и караоке-эффектом
                 await self._create_simple_clip(
-                    video_path=str(video_path),
+                    video_path=source_path,
                     output_path=str(clip_path),
                     start_time=highlight.start_time,
                     end_time=highlight.end_time,
-                    transcription=transcription
+                    ass_path=ass_paths[i],
+                    profile=profile,
+                    video_info=source_info[source_path],
+                    source_offset=source_offset,
+                    progress_callback=clip_progress(i, highlight.end_time - highlight.start_time)
                 )
-                
-                output_paths.append(clip_path)
-                logger.info(f"Создан клип {i+1}/{len(highlights)}")
 
-            # Создаём zip-архив
-            zip_path = self.output_dir / f"highlights_{video_path.stem}_{task_id}.zip"
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for path in output_paths:
-                    zipf.write(path, arcname=path.name)
+            completed += 1
+            logger.info(f"Создан клип {completed}/{len(highlights)} (highlight_{i})")
+            if on_clip_ready:
+                await on_clip_ready(i, clip_path)
+            return clip_path
 
-            logger.info(f"ZIP создан: {zip_path}")
-            return str(zip_path)
-
-        except Exception as e:
-            logger.error(f"Ошибка: {str(e)}")
+        tasks = [
+            asyncio.create_task(render_clip(i, highlight))
+            for i, highlight in enumerate(highlights)
+        ]
+        try:
+            # gather сохраняет порядок клипов независимо от порядка завершения
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
             raise
 
+    async def _render_single_pass(
+        self,
+        video_path: Path,
+        video_info: Dict,
+        highlights: List[HighlightSegment],
+        ass_paths: List[Path],
+        work_dir: Path,
+        profile: RenderProfile,
+        progress_callback: Optional[Callable[..., None]] = None
+    ) -> List[Path]:
+        """
+        Один ffmpeg на все клипы: вход декодируется один раз, затем поток
+        делится split/asplit и обрезается trim/atrim под каждый хайлайт
+        """
+        has_audio = video_info.get('has_audio', True)
+
+        base_time = min(h.start_time for h in highlights)
+        last_time = max(h.end_time for h in highlights)
+        count = len(highlights)
+        # Все энкодеры работают в одном процессе — делим между ними ядра
+        threads = max(1, (os.cpu_count() or 1) // count)
+
+        filters = [f"[0:v]split={count}" + "".join(f"[vin{i}]" for i in range(count))]
+        if has_audio:
+            filters.append(f"[0:a]asplit={count}" + "".join(f"[ain{i}]" for i in range(count)))
+
+        clip_paths = []
+        outputs = []
+        for i, highlight in enumerate(highlights):
+            clip_path = self._clip_path(work_dir, i, video_path)
+
+            # Время относительно точки входа после -ss
+            start = highlight.start_time - base_time
+            end = highlight.end_time - base_time
+            filters.append(
+                f"[vin{i}]trim=start={start}:end={end},setpts=PTS-STARTPTS,"
+                f"{self._clip_video_filter(ass_paths[i], profile, video_info)}[v{i}]"
+            )
+            outputs += ['-map', f'[v{i}]']
+            if has_audio:
+                filters.append(
+                    f"[ain{i}]atrim=start={start}:end={end},asetpts=PTS-STARTPTS[a{i}]"
+                )
+                outputs += ['-map', f'[a{i}]']
+            outputs += profile.encoder_args(threads) + [str(clip_path)]
+            clip_paths.append(clip_path)
+
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-ss', str(base_time),
+            '-to', str(last_time),
+            '-i', str(video_path),
+            '-filter_complex', ';'.join(filters),
+        ] + outputs
+
+        parser = None
+        if progress_callback:
+            span = (last_time - base_time) or 1.0
+            parser = FfmpegProgressParser(lambda seconds: progress_callback(seconds / span))
+            cmd[1:1] = progress_args()
+
+        logger.info(f"Запуск FFmpeg: {' '.join(cmd)}")
+        media_seconds = sum(h.end_time - h.start_time for h in highlights)
+        with Span("encode_single_pass", media_seconds=media_seconds):
+            result = await self.runner.run(
+                cmd,
+                capture_stdout=False,
+                stdout_callback=parser.feed if parser else None
+            )
+
+        if result.returncode != 0:
+            logger.error(f"FFmpeg stderr: {result.stderr}")
+            raise Exception(f"FFmpeg error: {result.stderr}")
+
+        BYTES_WRITTEN.labels("clip").inc(sum(p.stat().st_size for p in clip_paths if p.exists()))
+        logger.info(f"Создано клипов за один проход: {count}")
+        return clip_paths
+
+    def _clip_video_filter(
+        self,
+        ass_path: Path,
+        profile: RenderProfile,
+        video_info: Optional[Dict] = None
+    ) -> str:
+        """Цепочка crop/scale/subtitles для вертикального клипа"""
+        # Format the subtitle path for FFmpeg (use forward slashes and escape spaces)
+        ass_path_str = str(ass_path).replace('\\', '/').replace(' ', '\\ ')
+        return (
+            f"{crop_filter(video_info, profile.width, profile.height)},"
+            f"subtitles='{ass_path_str}'"
+        )
+
     async def _create_simple_clip(
         self,
         video_path: str,
         output_path: str,
         start_time: float,
         end_time: float,
-        transcription: Dict
+        ass_path: Path,
+        profile: RenderProfile,
+        video_info: Optional[Dict] = None,
+        source_offset: float = 0.0,
+        progress_callback: Optional[Callable[[float], None]] = None
     ):
-        """Создание клипа с субтитрами и караоке-эффектом"""
-        
-        # Создаем ASS файл с субтитрами и караоке-эффектом
-        ass_path = Path(output_path).parent / f"{Path(output_path).stem}.ass"
-        self._create_ass_file(transcription, start_time, end_time, ass_path)
-        
+        """
+        Создание клипа с готовыми субтитрами (ASS с караоке-эффектом).
+        source_offset — время начала файла video_path в исходном видео,
+        если это скачанный фрагмент; тайминги субтитров остаются абсолютными.
+        progress_callback получает число уже закодированных секунд клипа.
+        """
+
         # Ensure the ASS file exists
         if not ass_path.exists():
             logger.error(f"ASS file not found: {ass_path}")
             raise Exception(f"ASS file not found: {ass_path}")
 
-        # Format the subtitle path for FFmpeg (use forward slashes and escape spaces)
-        ass_path_str = str(ass_path).replace('\\', '/').replace(' ', '\\ ')
-        
         # Команда FFmpeg с ASS субтитрами
         cmd = [
             'ffmpeg',
-            '-ss', str(start_time),
-            '-to', str(end_time),
+            '-ss', str(start_time - source_offset),
+            '-to', str(end_time - source_offset),
             '-i', video_path,
-            '-vf', (
-                f"crop=ih*9/16:ih:iw/2-ih*9/32:0,"
-                f"scale={self.tiktok_width}:{self.tiktok_height},"
-                f"subtitles='{ass_path_str}'"
-            ),
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '23',
-            '-c:a', 'aac',
-            '-b:a', '128k',
+            '-vf', self._clip_video_filter(ass_path, profile, video_info),
+        ] + profile.encoder_args(self.threads_per_job) + [
             '-y',
             output_path
         ]
+
+        parser = None
+        if progress_callback:
+            parser = FfmpegProgressParser(progress_callback)
+            cmd[1:1] = progress_args()
         
         # Log the FFmpeg command for debugging
         logger.info(f"Запуск FFmpeg: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
-        
-        # Удаляем временный ASS файл
-        if ass_path.exists():
-            ass_path.unlink()
-        
+        with Span("encode_clip", media_seconds=end_time - start_time):
+            result = await self.runner.run(
+                cmd,
+                capture_stdout=False,
+                stdout_callback=parser.feed if parser else None
+            )
+
         if result.returncode != 0:
             logger.error(f"FFmpeg stderr: {result.stderr}")
             raise Exception(f"FFmpeg error: {result.stderr}")
 
+        BYTES_WRITTEN.labels("clip").inc(os.path.getsize(output_path))
+
     def _create_ass_file(
         self,
-        transcription: Dict,
+        transcription: Union[Dict, TranscriptionStore],
         start_time: float,
         end_time: float,
         ass_path: Path
     ):
         """Создание ASS файла с субтитрами и караоке-эффектом для целых фраз"""
         
-        # Фильтруем релевантные сегменты
-        relevant_segments = []
-        for segment in transcription["segments"]:
-            if segment["end"] > start_time and segment["start"] < end_time:
-                segment_start = max(0, segment["start"] - start_time)
-                segment_end = min(end_time - start_time, segment["end"] - start_time)
-                words = []
-                if "words" in segment:
-                    for word in segment["words"]:
-                        word_start = max(0, word["start"] - start_time)
-                        word_end = min(end_time - start_time, word["end"] - start_time)
-                        if word_start < word_end:
-                            words.append({
-                                "start": word_start,
-                                "end": word_end,
-                                "text": self._clean_text(word["word"])
-                            })
-                relevant_segments.append({
-                    "start": segment_start,
-                    "end": segment_end,
-                    "words": words
-                })
-        
+        store = TranscriptionStore.ensure(transcription)
+        clip_length = end_time - start_time
+
         # Создаем ASS содержимое
         ass_content = [
             "[Script Info]",
@@ -165,23 +457,35 @@ class VideoEditor:
             "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text"
         ]
         
-        for i, segment in enumerate(relevant_segments, 1):
-            if not segment["words"]:  # Пропускаем пустые сегменты
+        # Двоичный поиск сегментов, пересекающихся с клипом, вместо полного перебора
+        for index in store.segments_in_range(start_time, end_time):
+            first, last = store.segment_words(index)
+            if first == last:  # Пропускаем пустые сегменты
+                continue
+
+            # Тайминги слов относительно начала клипа, обрезанные его границами
+            word_starts = np.maximum(0, store.word_start[first:last] - start_time)
+            word_ends = np.minimum(clip_length, store.word_end[first:last] - start_time)
+            visible = np.flatnonzero(word_starts < word_ends)
+            if not len(visible):
                 continue
+
             # Создаем текст с караоке-тегами для каждого слова
-            karaoke_text = ""
-            for word in segment["words"]:
-                duration_centisec = int((word["end"] - word["start"]) * 100)  # Длительность в сотых секунды
-                karaoke_text += f"{{\\k{duration_centisec}}}{word['text']} "
-            karaoke_text = karaoke_text.rstrip()  # Удаляем конечный пробел
-            start_time_str = self._format_ass_time(segment["start"])
-            end_time_str = self._format_ass_time(segment["end"])
+            karaoke_text = " ".join(
+                f"{{\\k{int((word_ends[j] - word_starts[j]) * 100)}}}"  # Длительность в сотых секунды
+                f"{self._clean_text(store.word_text(first + j))}"
+                for j in visible
+            )
+            segment_start = max(0, store.segment_start[index] - start_time)
+            segment_end = min(clip_length, store.segment_end[index] - start_time)
+            start_time_str = self._format_ass_time(segment_start)
+            end_time_str = self._format_ass_time(segment_end)
             ass_content.append(
                 f"Dialogue: 0,{start_time_str},{end_time_str},Karaoke,,0,0,0,,{karaoke_text}"
             )
         
         # Log ASS content for debugging
-        logger.debug(f"ASS content:\n{'\n'.join(ass_content)}")
+        logger.debug("ASS content:\n" + "\n".join(ass_content))
         
         # Записываем файл
         with open(ass_path, 'w', encoding='utf-8') as f:
@@ -226,24 +530,3 @@ class VideoEditor:
         centisecs = int((secs % 1) * 100)
         secs = int(secs)
         return f"{hours}:{minutes:02d}:{secs:02d}.{centisecs:02d}"
-
-    async def _get_video_info(self, video_path: str) -> Dict:
-        """Получение информации о видео"""
-        cmd = [
-            'ffprobe',
-            '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
-            '-of', 'json',
-            video_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            info = json.loads(result.stdout)
-            stream = info['streams'][0]
-            return {
-                'width': int(stream['width']),
-                'height': int(stream['height'])
-            }
-        return {'width': 1920, 'height': 1080}  # Значения по умолчанию
\ No newline at end of file
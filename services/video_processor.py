@@ -1,55 +1,394 @@
 import os
+import re
+import uuid
+import asyncio
+import hashlib
+from contextlib import contextmanager
 import yt_dlp
-import subprocess
 from pathlib import Path
 import logging
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from dotenv import load_dotenv
+import numpy as np
+from utils.audio import SAMPLE_RATE, PcmStreamBuffer
+from utils.download_cache import DownloadCache
+from utils.media_probe import MediaProbe
+from utils.metrics import BYTES_DOWNLOADED, BYTES_WRITTEN, CACHE_LOOKUPS, Span
+from utils.process_runner import ProcessRunner, process_runner
+from services.storage import INTERMEDIATE_TTL, get_storage_manager
 
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
 class VideoProcessor:
-    def __init__(self):
+    def __init__(self, runner: ProcessRunner = None):
+        self.runner = runner or process_runner
+        self.media_probe = MediaProbe(self.runner)
         self.upload_dir = Path(os.getenv("UPLOAD_DIR", "./uploads"))
         self.upload_dir.mkdir(exist_ok=True)
         self.cookies_file = os.getenv("COOKIES_FILE", "./cookies.txt")
+        if os.path.exists(self.cookies_file):
+            logger.info(f"Используются cookies из {self.cookies_file}")
+        else:
+            logger.warning("Файл cookies не найден. Продолжаю без авторизации.")
+        # Сколько хранятся метаданные по ссылке для оценки стоимости при приёме
+        self.metadata_ttl = float(os.getenv("METADATA_CACHE_HOURS", "24")) * 3600
+        # Порог, после которого PCM из ffmpeg сбрасывается в memmap-файл
+        self.audio_memory_limit = int(os.getenv("AUDIO_MEMORY_LIMIT_MB", "1024")) * 1024 * 1024
+        # Кэш скачанных видео с общим бюджетом на диске
+        self.video_format = 'best[height<=720]'
+        self.audio_format = 'bestaudio/best'
+        # Запас по краям секций при скачивании только нужных фрагментов видео
+        self.section_padding = float(os.getenv("SECTION_PADDING_SECONDS", "1.0"))
+        self.download_cache = DownloadCache(
+            cache_dir=self.upload_dir / "videos",
+            max_bytes=int(float(os.getenv("DOWNLOAD_CACHE_MAX_GB", "50")) * 1024 ** 3),
+            ttl_seconds=float(os.getenv("DOWNLOAD_CACHE_TTL_HOURS", "72")) * 3600
+        )
+        # WAV и файлы сброса PCM учитываются, чтобы не пережить упавшую задачу
+        self.storage = get_storage_manager()
+        # Промежуточное аудио у каждой задачи своё: видео из кэша загрузок
+        # общее, и задачи с одной ссылкой не должны делить WAV
+        self.audio_dir = self.upload_dir / "audio"
+        self.audio_dir.mkdir(exist_ok=True)
 
-    async def download_video(self, video_url: str) -> str:
+    async def download_video(
+        self,
+        video_url: str,
+        progress_callback: Optional[Callable[..., None]] = None
+    ) -> str:
         """
-        Скачивание видео с YouTube/Twitch с поддержкой cookies
+        Скачивание видео с YouTube/Twitch с поддержкой cookies.
+        Файл берётся из кэша загрузок; вызывающий обязан вызвать release_video.
+        progress_callback(доля, **детали) вызывается из потока загрузки.
         """
         try:
-            ydl_opts = {
-                'format': 'best[height<=720]',
-                'outtmpl': str(self.upload_dir / '%(title)s.%(ext)s'),
-                'max_filesize': 500_000_000,
-            }
-
-            if os.path.exists(self.cookies_file):
-                logger.info(f"Используются cookies из {self.cookies_file}")
-                ydl_opts['cookiefile'] = self.cookies_file
+            filename = await self._download_cached(video_url, self.video_format, progress_callback)
+            logger.info(f"Видео скачано: {filename}")
+            return filename
+
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании видео: {str(e)}")
+            raise Exception(f"Не удалось скачать видео: {str(e)}")
+
+    async def download_audio(
+        self,
+        video_url: str,
+        progress_callback: Optional[Callable[..., None]] = None
+    ) -> str:
+        """
+        Скачивание только лучшей аудиодорожки — для транскрипции видео не нужно.
+        Файл берётся из кэша загрузок; вызывающий обязан вызвать release_video.
+        """
+        try:
+            filename = await self._download_cached(video_url, self.audio_format, progress_callback)
+            logger.info(f"Аудио скачано: {filename}")
+            return filename
+
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании аудио: {str(e)}")
+            raise Exception(f"Не удалось скачать аудио: {str(e)}")
+
+    async def fetch_metadata(self, video_url: str) -> Dict:
+        """
+        Метаданные видео без скачивания и без выбора форматов: длительность
+        нужна для оценки стоимости задания до постановки в очередь. Ссылки,
+        которые уже запрашивались или скачивались, берутся из кэша загрузок
+        """
+        try:
+            cached = await asyncio.to_thread(
+                self.download_cache.get_metadata, video_url, self.metadata_ttl
+            )
+            CACHE_LOOKUPS.labels("metadata", "hit" if cached is not None else "miss").inc()
+            if cached is not None:
+                return cached
+            ydl_opts = dict(self._ydl_options(self.video_format), quiet=True)
+            info = await asyncio.to_thread(self._extract_metadata, video_url, ydl_opts)
+            metadata = self._metadata(info)
+            await asyncio.to_thread(self._remember_metadata, video_url, metadata)
+            return metadata
+
+        except Exception as e:
+            logger.error(f"Ошибка при получении метаданных видео: {str(e)}")
+            raise Exception(f"Не удалось получить метаданные видео: {str(e)}")
+
+    def _metadata(self, info: Dict) -> Dict:
+        return {
+            "duration": info.get("duration"),
+            "title": info.get("title"),
+            "is_live": bool(info.get("is_live"))
+        }
+
+    def _remember_metadata(self, video_url: str, metadata: Dict):
+        # Длительность трансляции растёт, её метаданные не кэшируются
+        if metadata["duration"] and not metadata["is_live"]:
+            self.download_cache.put_metadata(video_url, metadata)
+
+    def _extract_metadata(self, video_url: str, ydl_opts: Dict) -> Dict:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(video_url, download=False, process=False)
+
+    async def download_sections(
+        self,
+        video_url: str,
+        ranges: List[Tuple[float, float]],
+        work_dir: Path,
+        progress_callback: Optional[Callable[..., None]] = None
+    ) -> List[Tuple[str, float]]:
+        """
+        Скачивание только фрагментов видео, покрывающих диапазоны ranges.
+        Близкие и перекрывающиеся диапазоны объединяются в одну секцию.
+        Возвращает для каждого диапазона пару (файл секции, время начала секции).
+        """
+        try:
+            work_dir = Path(work_dir)
+            work_dir.mkdir(parents=True, exist_ok=True)
+
+            sections = self._merge_ranges(ranges, self.section_padding)
+            ydl_opts = dict(
+                self._ydl_options(self.video_format),
+                outtmpl=str(work_dir / 'section_%(section_start)s.%(ext)s'),
+                download_ranges=yt_dlp.utils.download_range_func(None, sections),
+                # Точный рез по запрошенному времени, чтобы субтитры совпадали с кадром
+                force_keyframes_at_cuts=True
+            )
+            if progress_callback:
+                ydl_opts['progress_hooks'] = [self._progress_hook(progress_callback, len(sections))]
+            with Span("download_sections", media_seconds=sum(e - s for s, e in sections)):
+                await asyncio.to_thread(self._download_url, video_url, ydl_opts)
+
+            files = {}
+            for path in work_dir.glob('section_*'):
+                try:
+                    files[float(path.stem.split('_', 1)[1])] = str(path)
+                except ValueError:
+                    continue
+            if not files:
+                raise Exception("yt-dlp не создал ни одной секции")
+            BYTES_DOWNLOADED.labels("sections").inc(sum(os.path.getsize(p) for p in files.values()))
+
+            result = []
+            for start, end in ranges:
+                section_start = next(
+                    s for s, e in sections if s <= start and end <= e
+                )
+                nearest = min(files, key=lambda value: abs(value - section_start))
+                result.append((files[nearest], section_start))
+
+            logger.info(
+                f"Скачано секций: {len(sections)}, "
+                f"{sum(e - s for s, e in sections):.1f} с видео"
+            )
+            return result
+
+        except Exception as e:
+            logger.error(f"Ошибка при скачивании фрагментов видео: {str(e)}")
+            raise Exception(f"Не удалось скачать фрагменты видео: {str(e)}")
+
+    def _merge_ranges(
+        self,
+        ranges: List[Tuple[float, float]],
+        padding: float
+    ) -> List[Tuple[float, float]]:
+        """Объединение диапазонов с запасом padding по краям"""
+        merged = []
+        for start, end in sorted(ranges):
+            start, end = max(0.0, start - padding), end + padding
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
             else:
-                logger.warning("Файл cookies не найден. Продолжаю без авторизации.")
+                merged.append((start, end))
+        return merged
+
+    def _ydl_options(self, format_spec: str) -> Dict:
+        ydl_opts = {
+            'format': format_spec,
+            'max_filesize': 500_000_000,
+            # Оборванная загрузка (перезапуск воркера) продолжается с .part-файла
+            'continuedl': True,
+        }
+
+        if os.path.exists(self.cookies_file):
+            ydl_opts['cookiefile'] = self.cookies_file
+
+        return ydl_opts
 
+    def _progress_hook(self, progress_callback: Callable[..., None], files: int = 1):
+        """
+        Хук прогресса yt-dlp. files — сколько файлов скачивается по очереди
+        (секции), общий прогресс делится между ними поровну.
+        """
+        finished = 0
+
+        def hook(status: Dict):
+            nonlocal finished
+            if status.get('status') == 'downloading':
+                total = status.get('total_bytes') or status.get('total_bytes_estimate')
+                downloaded = status.get('downloaded_bytes') or 0
+                if total:
+                    progress_callback(
+                        (finished + min(1.0, downloaded / total)) / files,
+                        downloaded_bytes=downloaded,
+                        total_bytes=total,
+                        speed=status.get('speed')
+                    )
+            elif status.get('status') == 'finished':
+                finished = min(files, finished + 1)
+                progress_callback(finished / files)
+
+        return hook
+
+    async def _download_cached(
+        self,
+        video_url: str,
+        format_spec: str,
+        progress_callback: Optional[Callable[..., None]] = None
+    ) -> str:
+        ydl_opts = self._ydl_options(format_spec)
+        info = await asyncio.to_thread(self._extract_info, video_url, ydl_opts)
+        # Повторный приём той же ссылки оценивается без запроса к сайту
+        await asyncio.to_thread(self._remember_metadata, video_url, self._metadata(info))
+        key = self._cache_key(info, format_spec)
+        if progress_callback:
+            ydl_opts['progress_hooks'] = [self._progress_hook(progress_callback)]
+
+        fetched = False
+
+        def fetch():
+            nonlocal fetched
+            fetched = True
+            return asyncio.to_thread(self._download, info, key, ydl_opts)
+
+        path = await self.download_cache.acquire(key, fetch)
+        CACHE_LOOKUPS.labels("download", "miss" if fetched else "hit").inc()
+        return path
+
+    def _download_url(self, video_url: str, ydl_opts: Dict):
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.download([video_url])
+
+    def discard_audio(self, audio: Union[str, np.ndarray, None]):
+        """
+        Удаление промежуточного аудио после транскрипции: WAV или файла
+        сброса np.memmap. Массив в памяти удалять не нужно.
+        """
+        if isinstance(audio, np.memmap):
+            path = audio.filename
+        elif isinstance(audio, str):
+            path = audio
+        else:
+            return
+        if self.storage.remove(path):
+            logger.info(f"Промежуточное аудио удалено: {path}")
+
+    def audio_reference(self, audio: Union[str, np.ndarray]) -> Optional[Dict]:
+        """
+        Описание извлечённого аудио для контрольной точки: WAV или файл сброса
+        np.memmap. Массив в памяти не переживает перезапуск — None.
+        """
+        if isinstance(audio, np.memmap):
+            return {"path": audio.filename, "kind": "pcm_f32", "samples": len(audio)}
+        if isinstance(audio, str):
+            return {"path": audio, "kind": "wav", "size": Path(audio).stat().st_size}
+        return None
+
+    def reopen_audio(self, reference: Dict) -> Union[str, np.ndarray, None]:
+        """Аудио по контрольной точке; None — файл удалён или дописан не до конца"""
+        path = Path(reference["path"])
+        if not path.exists():
+            return None
+        if reference["kind"] == "pcm_f32":
+            if path.stat().st_size != reference["samples"] * 4:
+                return None
+            audio = np.memmap(path, dtype=np.float32, mode='r', shape=(reference["samples"],))
+        else:
+            if path.stat().st_size != reference["size"]:
+                return None
+            audio = str(path)
+        # Срок хранения промежуточного файла отсчитывается заново
+        self.storage.touch(path, ttl=INTERMEDIATE_TTL)
+        return audio
+
+    @contextmanager
+    def hold_audio(self, audio: Union[str, np.ndarray]):
+        """Защита файла аудио от очистки хранилища, пока идёт транскрипция"""
+        reference = self.audio_reference(audio)
+        if reference is None:
+            yield
+            return
+        with self.storage.hold(reference["path"]):
+            yield
+
+    async def probe_media(self, media_path: str) -> Dict:
+        """
+        Длительность, разрешение, аудиодорожка и индекс ключевых кадров файла.
+        Результат кэшируется рядом с файлом и живёт, пока файл в кэше загрузок.
+        """
+        try:
+            return await self.media_probe.probe(media_path)
+
+        except Exception as e:
+            logger.error(f"Ошибка при анализе медиафайла: {str(e)}")
+            raise Exception(f"Не удалось получить информацию о медиафайле: {str(e)}")
+
+    def retain_video(self, video_path: str) -> bool:
+        """
+        Дополнительная ссылка на уже скачанный файл (например, при переходе
+        к следующему этапу). False — файла в кэше нет, его нужно скачать заново.
+        """
+        return self.download_cache.retain(video_path)
+
+    def release_video(self, video_path: str):
+        """Освобождение ссылки на видео или аудио из кэша загрузок"""
+        self.download_cache.release(video_path)
+
+    def has_video(self, video_path: Optional[str]) -> bool:
+        return bool(video_path) and self.download_cache.contains(video_path)
+
+    def pin_video(self, video_path: str, owner: str, ttl_seconds: float) -> bool:
+        """
+        Закрепление скачанного файла за задачей (например, черновиком, который
+        можно перерендерить) на ttl_seconds — вне зависимости от процесса
+        """
+        return self.download_cache.pin(video_path, owner, ttl_seconds)
+
+    def _extract_info(self, video_url: str, ydl_opts: Dict) -> Dict:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            return ydl.extract_info(video_url, download=False)
+
+    def _download(self, info: Dict, key: str, ydl_opts: Dict) -> str:
+        # Имя файла по ключу кэша: видео с одинаковым названием не перезаписывают друг друга
+        ydl_opts = dict(ydl_opts, outtmpl=str(self.download_cache.cache_dir / f"{key}.%(ext)s"))
+        with Span("download", media_seconds=info.get('duration')):
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(video_url, download=False)
+                info = ydl.process_ie_result(info, download=True)
                 filename = ydl.prepare_filename(info)
-                ydl.download([video_url])
-                logger.info(f"Видео скачано: {filename}")
-                return filename
+        if os.path.exists(filename):
+            BYTES_DOWNLOADED.labels("full").inc(os.path.getsize(filename))
+        return filename
 
-        except Exception as e:
-            logger.error(f"Ошибка при скачивании видео: {str(e)}")
-            raise Exception(f"Не удалось скачать видео: {str(e)}")
+    def _cache_key(self, info: Dict, format_spec: str) -> str:
+        """Ключ содержимого: экстрактор + id видео + формат"""
+        extractor = info.get('extractor_key') or info.get('extractor') or 'generic'
+        video_id = info.get('id') or hashlib.sha1(info.get('webpage_url', '').encode()).hexdigest()
+        format_hash = hashlib.sha1(format_spec.encode()).hexdigest()[:8]
+        raw_key = f"{extractor}-{video_id}-{format_hash}"
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', raw_key)
 
-    async def extract_audio(self, video_path: str) -> str:
+    def _audio_path(self, name: Optional[str], suffix: str) -> Path:
+        """Путь промежуточного аудио: по id задачи или уникальный"""
+        return self.audio_dir / f"{name or uuid.uuid4().hex}{suffix}"
+
+    async def extract_audio(self, video_path: str, name: Optional[str] = None) -> str:
         """
-        Извлечение аудио из видео
+        Извлечение аудио из видео.
+        name — имя файла WAV (id задачи); без него имя уникальное.
         """
         try:
             video_path = Path(video_path)
-            audio_path = video_path.with_suffix('.wav')
+            audio_path = self._audio_path(name, '.wav')
+            self.storage.register(audio_path, "audio", ttl=INTERMEDIATE_TTL)
             
             # Извлечение аудио с помощью ffmpeg
             cmd = [
@@ -61,7 +400,13 @@ class VideoProcessor:
                 '-y'  # Перезаписать файл
             ]
             
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            with Span("extract_audio") as span:
+                result = await self.runner.run(cmd, capture_stdout=False)
+                if result.returncode == 0:
+                    # WAV pcm_s16le моно: 2 байта на сэмпл после 44-байтового заголовка
+                    size = audio_path.stat().st_size
+                    span.media_seconds = max(0, size - 44) / 2 / SAMPLE_RATE
+                    BYTES_WRITTEN.labels("audio").inc(size)
             
             if result.returncode != 0:
                 raise Exception(f"FFmpeg error: {result.stderr}")
@@ -71,4 +416,56 @@ class VideoProcessor:
             
         except Exception as e:
             logger.error(f"Ошибка при извлечении аудио: {str(e)}")
-            raise Exception(f"Не удалось извлечь аудио: {str(e)}")
\ No newline at end of file
+            raise Exception(f"Не удалось извлечь аудио: {str(e)}")
+
+    async def extract_audio_pcm(self, video_path: str, name: Optional[str] = None) -> np.ndarray:
+        """
+        Извлечение аудио сразу в float32 PCM 16 кГц без промежуточного WAV.
+        Длинные записи сверх AUDIO_MEMORY_LIMIT_MB хранятся в np.memmap;
+        name — имя файла сброса (id задачи), без него имя уникальное.
+        """
+        buffer = None
+        try:
+            video_path = Path(video_path)
+            buffer = PcmStreamBuffer(
+                spill_path=str(self._audio_path(name, '.f32')),
+                max_memory_bytes=self.audio_memory_limit
+            )
+
+            cmd = [
+                'ffmpeg', '-i', str(video_path),
+                '-vn',
+                '-ar', str(SAMPLE_RATE),  # Частота дискретизации 16kHz
+                '-ac', '1',      # Моно
+                '-f', 's16le',
+                'pipe:1'
+            ]
+
+            async def write(chunk: bytes):
+                # Конвертация и запись в файл сброса — в потоке, не в event loop
+                await asyncio.to_thread(buffer.write, chunk)
+
+            with Span("extract_audio") as span:
+                result = await self.runner.run(cmd, stdout_callback=write)
+
+                if result.returncode != 0:
+                    raise Exception(f"FFmpeg error: {result.stderr}")
+
+                audio = await asyncio.to_thread(buffer.finalize)
+                span.media_seconds = len(audio) / SAMPLE_RATE
+            if buffer.spilled:
+                self.storage.register(buffer.spill_path, "audio", ttl=INTERMEDIATE_TTL)
+            storage = "memmap" if buffer.spilled else "память"
+            logger.info(
+                f"Аудио извлечено ({storage}): {video_path.name}, "
+                f"{len(audio) / SAMPLE_RATE:.1f} с"
+            )
+            return audio
+
+        except Exception as e:
+            if buffer is not None:
+                buffer.close()
+                if buffer.spilled:
+                    self.storage.remove(buffer.spill_path)
+            logger.error(f"Ошибка при извлечении аудио: {str(e)}")
+            raise Exception(f"Не удалось извлечь аудио: {str(e)}")
@@ -0,0 +1,96 @@
+import time
+
+import fakeredis
+import pytest
+
+from services.task_store import MemoryTaskStore, RedisTaskStore, SQLiteTaskStore
+
+TTL_SECONDS = 60
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryTaskStore()
+    if request.param == "sqlite":
+        return SQLiteTaskStore(str(tmp_path / "tasks.sqlite3"))
+    return RedisTaskStore(client=fakeredis.FakeRedis(), ttl_seconds=TTL_SECONDS)
+
+
+def test_create_and_get(store):
+    store.create("t1", {"status": "processing", "priority": 3, "media": {"duration": 12.5}})
+
+    assert store.get("t1") == {"status": "processing", "priority": 3, "media": {"duration": 12.5}}
+    assert store.exists("t1")
+    assert store.get("missing") is None
+    assert not store.exists("missing")
+
+
+def test_create_replaces_record(store):
+    store.create("t1", {"status": "processing", "stage": "download"})
+    store.create("t1", {"status": "queued"})
+
+    assert store.get("t1") == {"status": "queued"}
+
+
+def test_update_merges_fields(store):
+    store.create("t1", {"status": "processing", "stage": "download", "progress": 0.0})
+    store.update("t1", {"stage": "transcribing", "progress": 0.5})
+    store.update("t1", {})
+
+    assert store.get("t1") == {"status": "processing", "stage": "transcribing", "progress": 0.5}
+
+
+def test_record_is_a_copy(store):
+    store.create("t1", {"status": "processing"})
+    record = store.get("t1")
+    record["status"] = "completed"
+
+    assert store.get("t1")["status"] == "processing"
+
+
+def test_payload_is_separate_from_record(store):
+    transcription = {"text": "привет", "segments": [{"start": 0.0, "end": 1.2, "text": "привет"}]}
+    store.create("t1", {"status": "completed"})
+    store.put_payload("t1", "transcription", transcription)
+
+    assert store.get_payload("t1", "transcription") == transcription
+    assert "transcription" not in store.get("t1")
+    assert store.get_payload("t1", "audio_features") is None
+
+    store.delete_payload("t1", "transcription")
+    assert store.get_payload("t1", "transcription") is None
+
+
+def test_redis_update_refreshes_ttl():
+    client = fakeredis.FakeRedis()
+    store = RedisTaskStore(client=client, ttl_seconds=TTL_SECONDS)
+    store.create("t1", {"status": "processing"})
+    client.expire("task:t1", 1)
+
+    store.update("t1", {"stage": "rendering"})
+
+    assert client.ttl("task:t1") > 1
+    time.sleep(1.1)
+    assert store.get("t1") == {"status": "processing", "stage": "rendering"}
+
+
+def test_redis_record_and_payload_expire():
+    client = fakeredis.FakeRedis()
+    store = RedisTaskStore(client=client, ttl_seconds=1)
+    store.create("t1", {"status": "processing"})
+    store.put_payload("t1", "transcription", {"segments": []})
+
+    assert 0 < client.ttl("task:t1") <= 1
+    time.sleep(1.1)
+    assert store.get("t1") is None
+    assert store.get_payload("t1", "transcription") is None
+
+
+def test_redis_without_ttl_keeps_records():
+    client = fakeredis.FakeRedis()
+    store = RedisTaskStore(client=client)
+    store.create("t1", {"status": "processing"})
+    store.update("t1", {"stage": "rendering"})
+
+    assert client.ttl("task:t1") == -1
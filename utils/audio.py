@@ -0,0 +1,172 @@
+import wave
+import hashlib
+from typing import List, Optional, Union
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+# Источник аудио: путь к WAV или float32 PCM в памяти (в т.ч. np.memmap)
+AudioSource = Union[str, np.ndarray]
+
+
+def wav_num_samples(audio_path: str) -> int:
+    """Число сэмплов в WAV файле"""
+    with wave.open(audio_path, 'rb') as wav:
+        return wav.getnframes()
+
+
+def read_wav_range(audio_path: str, start_sample: int, end_sample: int) -> np.ndarray:
+    """
+    Чтение фрагмента 16 кГц моно pcm_s16le WAV в float32 [-1, 1],
+    как его ожидает Whisper
+    """
+    with wave.open(audio_path, 'rb') as wav:
+        if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+            raise ValueError(f"Ожидается моно pcm_s16le WAV: {audio_path}")
+        start_sample = max(0, start_sample)
+        end_sample = min(wav.getnframes(), end_sample)
+        wav.setpos(start_sample)
+        frames = wav.readframes(max(0, end_sample - start_sample))
+    return np.frombuffer(frames, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+def num_samples(audio: AudioSource) -> int:
+    """Число сэмплов в источнике аудио"""
+    if isinstance(audio, np.ndarray):
+        return len(audio)
+    return wav_num_samples(audio)
+
+
+def read_range(audio: AudioSource, start_sample: int, end_sample: int) -> np.ndarray:
+    """Фрагмент источника аудио в float32"""
+    if isinstance(audio, np.ndarray):
+        return np.asarray(audio[max(0, start_sample):end_sample], dtype=np.float32)
+    return read_wav_range(audio, start_sample, end_sample)
+
+
+class PcmStreamBuffer:
+    """
+    Приёмник потока pcm_s16le (stdout ffmpeg) в float32 буфер.
+    Пока объём меньше max_memory_bytes, данные держатся в памяти; после
+    порога всё сбрасывается в файл spill_path и результатом становится np.memmap.
+    """
+
+    def __init__(self, spill_path: str, max_memory_bytes: int):
+        self.spill_path = spill_path
+        self.max_memory_bytes = max_memory_bytes
+        self._chunks: List[np.ndarray] = []
+        self._memory_bytes = 0
+        self._spill_file = None
+        self._remainder = b""
+        self.samples = 0
+
+    def write(self, data: bytes):
+        data = self._remainder + data
+        # Нечётный байт оставляем до следующей порции
+        usable = len(data) - len(data) % 2
+        self._remainder = data[usable:]
+        if not usable:
+            return
+
+        samples = np.frombuffer(data[:usable], dtype=np.int16).astype(np.float32) / 32768.0
+        self.samples += len(samples)
+
+        if self._spill_file is not None:
+            self._spill_file.write(samples.tobytes())
+            return
+
+        self._chunks.append(samples)
+        self._memory_bytes += samples.nbytes
+        if self._memory_bytes > self.max_memory_bytes:
+            self._spill_file = open(self.spill_path, 'wb')
+            for chunk in self._chunks:
+                self._spill_file.write(chunk.tobytes())
+            self._chunks = []
+            self._memory_bytes = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self._spill_file is not None
+
+    def finalize(self) -> np.ndarray:
+        if self._spill_file is not None:
+            self._spill_file.close()
+            if self.samples == 0:
+                return np.zeros(0, dtype=np.float32)
+            return np.memmap(self.spill_path, dtype=np.float32, mode='r', shape=(self.samples,))
+        if not self._chunks:
+            return np.zeros(0, dtype=np.float32)
+        audio = np.concatenate(self._chunks)
+        self._chunks = []
+        return audio
+
+    def close(self):
+        """Закрытие файла сброса без формирования результата (при ошибке)"""
+        if self._spill_file is not None and not self._spill_file.closed:
+            self._spill_file.close()
+
+
+def audio_fingerprint(audio: AudioSource, block_seconds: int = 60) -> str:
+    """
+    Хэш содержимого PCM (не файла и не URL): одна и та же дорожка,
+    скачанная по разным ссылкам, даёт одинаковый отпечаток
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    total_samples = num_samples(audio)
+    digest.update(str(total_samples).encode())
+    block_samples = block_seconds * SAMPLE_RATE
+    for start in range(0, total_samples, block_samples):
+        # Квантуем в int16, чтобы WAV и PCM из памяти давали один и тот же хэш
+        block = read_range(audio, start, start + block_samples)
+        digest.update(np.round(block * 32768.0).astype(np.int16).tobytes())
+    return digest.hexdigest()
+
+
+def frame_rms(audio: np.ndarray, frame_size: int) -> np.ndarray:
+    """RMS энергия по неперекрывающимся кадрам"""
+    frame_count = len(audio) // frame_size
+    if frame_count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:frame_count * frame_size].reshape(frame_count, frame_size)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+
+def find_silence_split_points(
+    audio: AudioSource,
+    chunk_seconds: float,
+    search_seconds: float = 30.0,
+    frame_seconds: float = 0.1,
+    start_sample: int = 0,
+    end_sample: Optional[int] = None
+) -> List[int]:
+    """
+    Границы чанков (в сэмплах) для разбиения длинного аудио или его участка.
+    Около каждой целевой границы ищется самый тихий кадр в окне
+    ±search_seconds, чтобы не резать слова посередине.
+    Возвращает список вида [start_sample, ..., end_sample].
+    """
+    total_samples = num_samples(audio) if end_sample is None else end_sample
+    chunk_samples = int(chunk_seconds * SAMPLE_RATE)
+    search_samples = int(search_seconds * SAMPLE_RATE)
+    frame_size = max(1, int(frame_seconds * SAMPLE_RATE))
+
+    boundaries = [start_sample]
+    target = start_sample + chunk_samples
+    # Последний чанк не делаем короче половины целевого размера
+    while target < total_samples - chunk_samples // 2:
+        window_start = max(boundaries[-1] + frame_size, target - search_samples)
+        window_end = min(total_samples, target + search_samples)
+        window = read_range(audio, window_start, window_end)
+        energy = frame_rms(window, frame_size)
+
+        if len(energy):
+            split = window_start + int(np.argmin(energy)) * frame_size + frame_size // 2
+        else:
+            split = target
+
+        boundaries.append(split)
+        target = split + chunk_samples
+
+    boundaries.append(total_samples)
+    return boundaries
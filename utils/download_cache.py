@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import socket
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from utils.media_probe import sidecar_path
+
+logger = logging.getLogger(__name__)
+
+# Ссылка, которую процесс не снял (например, упал), перестаёт защищать файл
+REF_LEASE = float(os.getenv("DOWNLOAD_CACHE_REF_LEASE_HOURS", "12")) * 3600
+# Загрузку ключа ведёт один процесс; захват без обновления дольше этого
+# срока (процесс упал) может перехватить другой
+FETCH_STALE_SECONDS = float(os.getenv("DOWNLOAD_CACHE_FETCH_STALE_SECONDS", "60"))
+FETCH_HEARTBEAT_SECONDS = FETCH_STALE_SECONDS / 4
+# Как часто ожидающий процесс проверяет, готов ли файл
+FETCH_POLL_SECONDS = 1.0
+
+
+class DownloadCache:
+    """
+    Кэш скачанных файлов по ключу содержимого (экстрактор + id + формат).
+    Одновременные запросы одного ключа разделяют одну загрузку (single-flight):
+    внутри процесса — общей задачей asyncio, между процессами — захватом
+    ключа в индексе, остальные процессы ждут готовую запись. Размер ограничен max_bytes: вытесняются давно не
+    использованные файлы, на которые нет активных ссылок и закреплений; файлы без обращений
+    дольше ttl_seconds удаляются и при свободном бюджете. Индекс и ссылки
+    хранятся в SQLite (WAL) в каталоге кэша — общие для API и воркеров всех
+    очередей, поэтому файл, который читает один процесс, не вытеснит другой.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int, ttl_seconds: Optional[float] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.index_path = self.cache_dir / "cache_index.sqlite3"
+
+        self._lock = threading.Lock()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        # Ссылки этого процесса: путь -> токены в общей таблице refs
+        self._tokens: Dict[str, List[str]] = {}
+        self._conn = sqlite3.connect(
+            str(self.index_path),
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_path ON entries (path)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS refs ("
+            "token TEXT PRIMARY KEY, key TEXT NOT NULL, acquired_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS refs_key ON refs (key)")
+        # Закрепления: файл нужен задаче дольше, чем держится ссылка процесса
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pins ("
+            "owner TEXT PRIMARY KEY, key TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pins_key ON pins (key)")
+        # Метаданные по ссылке: оценка стоимости при приёме без запроса к сайту
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "url TEXT PRIMARY KEY, data TEXT NOT NULL, fetched_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fetching ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, heartbeat REAL NOT NULL)"
+        )
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    async def acquire(self, key: str, fetch: Callable[[], Awaitable[str]]) -> str:
+        """
+        Путь к файлу по ключу; при промахе файл скачивается через fetch.
+        Каждый acquire добавляет ссылку — парный вызов release обязателен.
+        """
+        path = self._ref_existing("key", key)
+        if path is not None:
+            logger.info(f"Кэш загрузок: попадание {key}")
+        while path is None:
+            task = self._in_flight.get(key)
+            if task is None:
+                task = asyncio.create_task(self._fetch(key, fetch))
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            else:
+                logger.info(f"Кэш загрузок: ожидаю уже идущую загрузку {key}")
+            # shield: отмена одного ожидающего не прерывает общую загрузку
+            await asyncio.shield(task)
+            # Между записью в индекс и ссылкой файл мог вытеснить другой процесс
+            path = self._ref_existing("key", key)
+
+        self._evict()
+        return path
+
+    def retain(self, path: str) -> bool:
+        """
+        Дополнительная ссылка на уже скачанный файл по его пути.
+        Возвращает False, если файла нет в кэше.
+        """
+        return self._ref_existing("path", str(path)) is not None
+
+    def release(self, path: str):
+        """Снятие ссылки на файл, полученный через acquire или retain"""
+        tokens = self._tokens.get(str(path))
+        if not tokens:
+            return
+        token = tokens.pop()
+        if not tokens:
+            del self._tokens[str(path)]
+        with self._lock:
+            self._conn.execute("DELETE FROM refs WHERE token = ?", (token,))
+        self._evict()
+
+    def get_metadata(self, url: str, max_age: float) -> Optional[Dict]:
+        """Метаданные по ссылке, полученные не раньше max_age секунд назад"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM metadata WHERE url = ? AND fetched_at >= ?",
+                (url, time.time() - max_age)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_metadata(self, url: str, data: Dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO metadata (url, data, fetched_at) VALUES (?, ?, ?)",
+                (url, json.dumps(data, ensure_ascii=False), time.time())
+            )
+
+    def contains(self, path: str) -> bool:
+        """Есть ли файл в кэше (без ссылки на него)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT path FROM entries WHERE path = ?", (str(path),)
+            ).fetchone()
+        return row is not None and Path(row[0]).exists()
+
+    def pin(self, path: str, owner: str, ttl_seconds: float) -> bool:
+        """
+        Защита файла от вытеснения на ttl_seconds от имени owner (например,
+        задачи) независимо от процесса; повторный pin продлевает срок.
+        Возвращает False, если файла нет в кэше.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT key, path FROM entries WHERE path = ?", (str(path),)
+                ).fetchone()
+                if row is None or not Path(row[1]).exists():
+                    self._conn.execute("COMMIT")
+                    return False
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO pins (owner, key, expires_at) VALUES (?, ?, ?)",
+                    (owner, row[0], time.time() + ttl_seconds)
+                )
+                self._conn.execute("COMMIT")
+                return True
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def unpin(self, owner: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM pins WHERE owner = ?", (owner,))
+        self._evict()
+
+    def _ref_existing(self, column: str, value: str) -> Optional[str]:
+        """
+        Ссылка на файл из индекса (по ключу или пути) в одной транзакции с
+        проверкой записи: вытеснение в другом процессе не может удалить файл
+        между проверкой и появлением ссылки
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    f"SELECT key, path FROM entries WHERE {column} = ?", (value,)
+                ).fetchone()
+                if row is None or not Path(row[1]).exists():
+                    if row is not None:
+                        self._conn.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+                    self._conn.execute("COMMIT")
+                    return None
+                key, path = row
+                token = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO refs (token, key, acquired_at) VALUES (?, ?, ?)",
+                    (token, key, now)
+                )
+                self._conn.execute(
+                    "UPDATE entries SET last_access = ? WHERE key = ?", (now, key)
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        self._tokens.setdefault(path, []).append(token)
+        return path
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[str]]):
+        """
+        Загрузка ключа под захватом. Если ключ уже качает другой процесс,
+        ждём его запись в индексе; упал — захват перехватывается
+        """
+        waiting = False
+        while not self._claim(key):
+            if self._has_entry(key):
+                return
+            if not waiting:
+                logger.info(f"Кэш загрузок: {key} скачивает другой процесс, жду")
+                waiting = True
+            await asyncio.sleep(FETCH_POLL_SECONDS)
+
+        heartbeat = asyncio.create_task(self._keep_claim(key))
+        try:
+            if self._has_entry(key):
+                # Другой процесс успел скачать файл между проверкой и захватом
+                return
+            logger.info(f"Кэш загрузок: промах {key}, скачиваю")
+            path = await fetch()
+            with self._lock:
+                self._conn.execute("BEGIN IMMEDIATE")
+                try:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO entries (key, path, size, last_access) "
+                        "VALUES (?, ?, ?, ?)",
+                        (key, str(path), os.path.getsize(path), time.time())
+                    )
+                    self._conn.execute(
+                        "DELETE FROM fetching WHERE key = ? AND owner = ?", (key, self.owner)
+                    )
+                    self._conn.execute("COMMIT")
+                except BaseException:
+                    self._conn.execute("ROLLBACK")
+                    raise
+        finally:
+            heartbeat.cancel()
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM fetching WHERE key = ? AND owner = ?", (key, self.owner)
+                )
+
+    def _claim(self, key: str) -> bool:
+        """Захват загрузки ключа этим процессом; False — качает другой"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT owner, heartbeat FROM fetching WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[0] != self.owner and now - row[1] < FETCH_STALE_SECONDS:
+                    self._conn.execute("COMMIT")
+                    return False
+                if row is not None and row[0] != self.owner:
+                    logger.warning(f"Кэш загрузок: захват {key} процессом {row[0]} устарел")
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO fetching (key, owner, heartbeat) VALUES (?, ?, ?)",
+                    (key, self.owner, now)
+                )
+                self._conn.execute("COMMIT")
+                return True
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    async def _keep_claim(self, key: str):
+        while True:
+            await asyncio.sleep(FETCH_HEARTBEAT_SECONDS)
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE fetching SET heartbeat = ? WHERE key = ? AND owner = ?",
+                    (time.time(), key, self.owner)
+                )
+
+    def _has_entry(self, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+        return row is not None and Path(row[0]).exists()
+
+    def _evict(self):
+        """
+        Вытеснение LRU записей без ссылок (ни в одном процессе), пока кэш
+        больше бюджета, и записей без обращений дольше ttl_seconds
+        """
+        now = time.time()
+        stale_before = now - self.ttl_seconds if self.ttl_seconds else 0.0
+        victims: List[Tuple[str, str, int]] = []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM refs WHERE acquired_at < ?", (now - REF_LEASE,))
+                self._conn.execute("DELETE FROM pins WHERE expires_at <= ?", (now,))
+                total = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM entries"
+                ).fetchone()[0]
+                # Записи упорядочены по last_access: дальше только более свежие
+                for key, path, size, last_access in self._conn.execute(
+                    "SELECT key, path, size, last_access FROM entries e "
+                    "WHERE NOT EXISTS (SELECT 1 FROM refs r WHERE r.key = e.key) "
+                    "AND NOT EXISTS (SELECT 1 FROM pins p WHERE p.key = e.key) "
+                    "ORDER BY last_access"
+                ).fetchall():
+                    if total <= self.max_bytes and last_access >= stale_before:
+                        break
+                    if key in self._in_flight:
+                        continue
+                    victims.append((key, path, size))
+                    total -= size
+                self._conn.executemany(
+                    "DELETE FROM entries WHERE key = ?", [(key,) for key, _, _ in victims]
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        # Файлы удаляются после фиксации: новые ссылки на них уже не появятся
+        for key, path, size in victims:
+            try:
+                Path(path).unlink(missing_ok=True)
+                sidecar_path(path).unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Не удалось удалить {path}: {e}")
+            logger.info(f"Кэш загрузок: вытеснен {key} ({size} байт)")
+
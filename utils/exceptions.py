@@ -12,4 +12,26 @@ class AudioExtractionError(VideoProcessingError):
 
 class TranscriptionError(VideoProcessingError):
     """Ошибка транскрипции"""
-    pass
\ No newline at end of file
+    pass
+
+class ProcessExecutionError(VideoProcessingError):
+    """Ошибка выполнения внешнего процесса (ffmpeg/ffprobe)"""
+    pass
+
+class ProcessTimeoutError(ProcessExecutionError):
+    """Внешний процесс превысил таймаут"""
+    pass
+
+class StageBusy(VideoProcessingError):
+    """Этап задачи выполняет другой живой воркер; задание нужно повторить через retry_after секунд"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionRejected(VideoProcessingError):
+    """Задание не принято: очередь заполнена; retry_after — через сколько секунд повторить"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
@@ -0,0 +1,34 @@
+from typing import Callable, List
+
+
+def progress_args() -> List[str]:
+    """Аргументы ffmpeg: машиночитаемый прогресс key=value в stdout"""
+    return ['-progress', 'pipe:1', '-nostats']
+
+
+class FfmpegProgressParser:
+    """
+    Разбор вывода `ffmpeg -progress pipe:1`. Принимает stdout по частям
+    (как stdout_callback у ProcessRunner) и сообщает обработанное время
+    медиа в секундах при каждом завершённом блоке прогресса.
+    """
+
+    def __init__(self, callback: Callable[[float], None]):
+        self.callback = callback
+        self.out_time = 0.0
+        self._buffer = b""
+
+    def feed(self, chunk: bytes):
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        for line in lines:
+            key, _, value = line.decode("utf-8", errors="replace").strip().partition("=")
+            # out_time_us и out_time_ms оба в микросекундах (историческая особенность ffmpeg)
+            if key in ("out_time_us", "out_time_ms"):
+                try:
+                    self.out_time = max(self.out_time, int(value) / 1_000_000)
+                except ValueError:
+                    # До первого кадра ffmpeg пишет N/A
+                    continue
+            elif key == "progress":
+                self.callback(self.out_time)
@@ -0,0 +1,44 @@
+import re
+from typing import Optional, Tuple
+from fastapi import HTTPException
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    Разбор заголовка Range (один диапазон байт). Возвращает (start, end)
+    включительно или None, если нужно отдать файл целиком.
+    """
+    if not header:
+        return None
+
+    match = _RANGE_RE.match(header.strip())
+    if not match:
+        # Несколько диапазонов и другие единицы не поддерживаются — отдаём весь файл
+        return None
+
+    start_str, end_str = match.groups()
+    if not start_str and not end_str:
+        return None
+
+    if not start_str:
+        # bytes=-N — последние N байт
+        length = int(end_str)
+        if length == 0:
+            raise _not_satisfiable(size)
+        return max(0, size - length), size - 1
+
+    start = int(start_str)
+    end = int(end_str) if end_str else size - 1
+    if start >= size or end < start:
+        raise _not_satisfiable(size)
+    return start, min(end, size - 1)
+
+
+def _not_satisfiable(size: int) -> HTTPException:
+    return HTTPException(
+        status_code=416,
+        detail="Запрошенный диапазон недоступен",
+        headers={"Content-Range": f"bytes */{size}"}
+    )
@@ -0,0 +1,315 @@
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from fractions import Fraction
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from utils.metrics import CACHE_LOOKUPS, Span
+from utils.process_runner import ProcessRunner, process_runner
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файла-спутника: при изменении полей старые результаты пересчитываются
+PROBE_VERSION = 1
+SIDECAR_SUFFIX = ".probe.json"
+
+# Индекс ключевых кадров требует прочитать все пакеты видеопотока (без декодирования)
+PROBE_KEYFRAMES = os.getenv("PROBE_KEYFRAMES", "true").lower() in ("1", "true", "yes")
+# Допуск при сверке хайлайтов с длительностью: метаданные контейнера бывают неточны
+DURATION_TOLERANCE = float(os.getenv("PROBE_DURATION_TOLERANCE", "0.5"))
+
+
+def sidecar_path(media_path: str) -> Path:
+    """Файл с результатом probe, который лежит рядом с медиафайлом"""
+    return Path(str(media_path) + SIDECAR_SUFFIX)
+
+
+class MediaProbe:
+    """
+    Информация о медиафайле: длительность, fps, разрешение с учётом поворота,
+    аудиодорожка и индекс ключевых кадров. ffprobe запускается один раз на
+    файл: результат хранится рядом с ним (<файл>.probe.json) и в памяти
+    процесса; смена размера или mtime файла делает результат недействительным.
+    """
+
+    def __init__(self, runner: ProcessRunner = None, max_entries: int = 64):
+        self.runner = runner or process_runner
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def probe(self, media_path: str) -> Dict:
+        path = Path(media_path)
+        stat = path.stat()
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        key = str(path)
+
+        info = self._entries.get(key)
+        if info is None or not self._is_fresh(info, stamp):
+            info = await asyncio.to_thread(self._read_sidecar, path, stamp)
+        if info is not None:
+            CACHE_LOOKUPS.labels("probe", "hit").inc()
+        else:
+            CACHE_LOOKUPS.labels("probe", "miss").inc()
+            task = self._in_flight.get(key)
+            if task is None:
+                task = asyncio.create_task(self._probe(path, stamp))
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            info = await asyncio.shield(task)
+
+        self._entries[key] = info
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return info
+
+    def _is_fresh(self, info: Dict, stamp: Tuple[int, int]) -> bool:
+        return (
+            info.get("version") == PROBE_VERSION
+            and (info.get("size"), info.get("mtime_ns")) == stamp
+        )
+
+    def _read_sidecar(self, path: Path, stamp: Tuple[int, int]) -> Optional[Dict]:
+        sidecar = sidecar_path(path)
+        if not sidecar.exists():
+            return None
+        try:
+            with open(sidecar, 'r', encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Файл probe повреждён, пересчитываю: {sidecar}: {e}")
+            return None
+        return info if self._is_fresh(info, stamp) else None
+
+    def _write_sidecar(self, path: Path, info: Dict):
+        sidecar = sidecar_path(path)
+        tmp_path = sidecar.with_name(f"{sidecar.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+            os.replace(tmp_path, sidecar)
+        except OSError as e:
+            # Без файла-спутника probe просто повторится в другом процессе
+            logger.warning(f"Не удалось сохранить результат probe {sidecar}: {e}")
+
+    async def _probe(self, path: Path, stamp: Tuple[int, int]) -> Dict:
+        with Span("probe") as span:
+            cmd = [
+                'ffprobe',
+                '-v', 'error',
+                '-show_entries',
+                'format=duration,start_time'
+                ':stream=index,codec_type,width,height,avg_frame_rate,r_frame_rate,'
+                'sample_aspect_ratio,channels,channel_layout,sample_rate'
+                ':stream_disposition=attached_pic'
+                ':stream_tags=rotate'
+                ':stream_side_data=rotation',
+                '-of', 'json',
+                str(path)
+            ]
+            result = await self.runner.run(cmd)
+            if result.returncode != 0:
+                raise Exception(f"ffprobe error: {result.stderr}")
+
+            info = self._parse(json.loads(result.stdout))
+            info.update(version=PROBE_VERSION, size=stamp[0], mtime_ns=stamp[1])
+
+            video_index = info.pop("video_index")
+            if video_index is not None and PROBE_KEYFRAMES:
+                info["keyframes"] = await self._keyframes(path, video_index, info["start_time"])
+            span.media_seconds = info["duration"]
+
+        await asyncio.to_thread(self._write_sidecar, path, info)
+        logger.info(
+            f"Probe {path.name}: {info['duration']:.1f} с, "
+            f"{info['width']}x{info['height']}, ключевых кадров: {len(info['keyframes'])}"
+        )
+        return info
+
+    def _parse(self, probe: Dict) -> Dict:
+        streams = probe.get('streams', [])
+        fmt = probe.get('format', {})
+
+        # Обложка в аудиофайле — тоже видеопоток, но не видео
+        video = next(
+            (
+                s for s in streams
+                if s.get('codec_type') == 'video'
+                and not s.get('disposition', {}).get('attached_pic')
+            ),
+            None
+        )
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+        info = {
+            "duration": _to_float(fmt.get('duration')) or 0.0,
+            "start_time": _to_float(fmt.get('start_time')) or 0.0,
+            "width": None,
+            "height": None,
+            "sar": 1.0,
+            "rotation": 0,
+            "fps": None,
+            "has_audio": audio is not None,
+            "audio_channels": audio.get('channels') if audio else None,
+            "audio_channel_layout": audio.get('channel_layout') if audio else None,
+            "audio_sample_rate": int(audio['sample_rate']) if audio and audio.get('sample_rate') else None,
+            "keyframes": [],
+            "video_index": video['index'] if video else None
+        }
+
+        if video:
+            width, height = int(video['width']), int(video['height'])
+            rotation = _rotation(video)
+            # ffmpeg поворачивает кадры автоматически: фильтры видят уже повёрнутое изображение
+            if rotation % 180 == 90:
+                width, height = height, width
+            info.update(
+                width=width,
+                height=height,
+                rotation=rotation,
+                sar=_ratio(video.get('sample_aspect_ratio')) or 1.0,
+                fps=_ratio(video.get('avg_frame_rate')) or _ratio(video.get('r_frame_rate'))
+            )
+        return info
+
+    async def _keyframes(self, path: Path, stream_index: int, start_time: float) -> List[float]:
+        """Время ключевых кадров по флагам пакетов — без декодирования видео"""
+        times = []
+        buffer = b""
+
+        def feed(chunk: bytes):
+            nonlocal buffer
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                pts_time, _, flags = line.decode("ascii", errors="replace").strip().partition(",")
+                if 'K' in flags:
+                    value = _to_float(pts_time)
+                    if value is not None:
+                        times.append(value - start_time)
+
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', str(stream_index),
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0',
+            str(path)
+        ]
+        result = await self.runner.run(cmd, stdout_callback=feed)
+        feed(b"\n")
+        if result.returncode != 0:
+            logger.warning(f"Не удалось построить индекс ключевых кадров {path.name}: {result.stderr}")
+            return []
+        return np.unique(np.round(np.maximum(times, 0.0), 6)).tolist() if times else []
+
+
+def media_summary(info: Dict) -> Dict:
+    """Сведения для записи задачи — без индекса ключевых кадров"""
+    return {
+        key: info.get(key)
+        for key in (
+            "duration", "width", "height", "fps", "has_audio",
+            "audio_channels", "audio_channel_layout", "audio_sample_rate"
+        )
+    }
+
+
+def seek_lead_in(info: Dict, times: Sequence[float]) -> np.ndarray:
+    """
+    Сколько секунд ffmpeg декодирует впустую при переходе к каждому из
+    моментов times: от предыдущего ключевого кадра до нужного момента.
+    Без индекса ключевых кадров — нули.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    keyframes = np.asarray(info.get("keyframes") or [], dtype=np.float64)
+    if not len(keyframes):
+        return np.zeros_like(times)
+    index = np.searchsorted(keyframes, times, side='right') - 1
+    previous = np.where(index >= 0, keyframes[np.maximum(index, 0)], 0.0)
+    return times - previous
+
+
+def range_errors(
+    duration: Optional[float],
+    ranges: Sequence[Tuple[float, float]],
+    tolerance: float = DURATION_TOLERANCE
+) -> List[str]:
+    """Описание диапазонов, выходящих за пределы медиафайла"""
+    errors = []
+    for i, (start, end) in enumerate(ranges):
+        if start < 0 or end <= start:
+            errors.append(f"Хайлайт {i}: некорректный диапазон {start}–{end}")
+        elif duration and end > duration + tolerance:
+            errors.append(
+                f"Хайлайт {i}: конец {end} с за пределами видео длительностью {duration:.2f} с"
+            )
+    return errors
+
+
+def crop_filter(info: Optional[Dict], width: int, height: int) -> str:
+    """
+    Обрезка по центру под соотношение width:height по реальному разрешению
+    и SAR источника. Широкий кадр обрезается по ширине, узкий (вертикальное
+    видео) — по высоте; если пропорции уже совпадают, обрезки нет.
+    """
+    if not info or not info.get("width") or not info.get("height"):
+        # Источник не удалось исследовать: прежнее предположение о горизонтальном видео
+        return f"crop=ih*9/16:ih:iw/2-ih*9/32:0,scale={width}:{height},setsar=1"
+
+    source_width, source_height = info["width"], info["height"]
+    sar = info.get("sar") or 1.0
+    target = Fraction(width, height)
+    display = Fraction(source_width * sar / source_height).limit_denominator(10000)
+
+    if display > target:
+        crop_width = _even(source_height * target / sar)
+        crop_height = source_height
+    elif display < target:
+        crop_width = source_width
+        crop_height = _even(source_width * sar / target)
+    else:
+        return f"scale={width}:{height},setsar=1"
+
+    x = (source_width - crop_width) // 2
+    y = (source_height - crop_height) // 2
+    return f"crop={crop_width}:{crop_height}:{x}:{y},scale={width}:{height},setsar=1"
+
+
+def _even(value) -> int:
+    return max(2, int(value) // 2 * 2)
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ratio(value: Optional[str]) -> Optional[float]:
+    """'30000/1001' или '1:1' -> float; '0/0' и 'N/A' -> None"""
+    if not value:
+        return None
+    numerator, _, denominator = value.replace(':', '/').partition('/')
+    try:
+        numerator, denominator = float(numerator), float(denominator or 1)
+    except ValueError:
+        return None
+    if not numerator or not denominator:
+        return None
+    return numerator / denominator
+
+
+def _rotation(stream: Dict) -> int:
+    for side_data in stream.get('side_data_list', []):
+        if 'rotation' in side_data:
+            return int(side_data['rotation']) % 360
+    rotate = stream.get('tags', {}).get('rotate')
+    return int(rotate) % 360 if rotate else 0
@@ -0,0 +1,170 @@
+import os
+import time
+import logging
+from typing import Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+    REGISTRY
+)
+
+logger = logging.getLogger(__name__)
+
+# Процессы воркеров Celery и пула транскрипции пишут метрики в общий каталог
+# (PROMETHEUS_MULTIPROC_DIR), а /metrics собирает их вместе
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+STAGE_DURATION = Histogram(
+    "narezka_stage_duration_seconds",
+    "Время выполнения этапа обработки",
+    ["stage", "status"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+)
+STAGE_REALTIME_FACTOR = Histogram(
+    "narezka_stage_realtime_factor",
+    "Секунды медиа, обработанные за секунду работы этапа",
+    ["stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+MEDIA_SECONDS = Counter(
+    "narezka_stage_media_seconds_total",
+    "Секунды медиа, обработанные этапом",
+    ["stage"]
+)
+BYTES_DOWNLOADED = Counter(
+    "narezka_downloaded_bytes_total",
+    "Байт скачано yt-dlp",
+    ["kind"]
+)
+BYTES_WRITTEN = Counter(
+    "narezka_written_bytes_total",
+    "Байт записано или отдано: клипы, аудио, потоковые ZIP",
+    ["kind"]
+)
+CACHE_LOOKUPS = Counter(
+    "narezka_cache_lookups_total",
+    "Обращения к кэшам загрузок, метаданных и транскрипций",
+    ["cache", "result"]
+)
+QUEUE_DEPTH = Gauge(
+    "narezka_queue_depth",
+    "Заданий в очереди, ещё не взятых воркерами",
+    ["queue"],
+    multiprocess_mode="livemax"
+)
+FFMPEG_ACTIVE = Gauge(
+    "narezka_ffmpeg_active_processes",
+    "Запущенные процессы ffmpeg/ffprobe",
+    multiprocess_mode="livesum"
+)
+STORAGE_BYTES = Gauge(
+    "narezka_storage_bytes",
+    "Объём учтённых файлов задач: клипы и промежуточные файлы",
+    multiprocess_mode="livemax"
+)
+STORAGE_EVICTED_BYTES = Counter(
+    "narezka_storage_evicted_bytes_total",
+    "Байт удалено очисткой хранилища",
+    ["kind", "reason"]
+)
+ADMISSION_DECISIONS = Counter(
+    "narezka_admission_decisions_total",
+    "Решения о приёме заданий",
+    ["pool", "decision"]
+)
+ADMISSION_BACKLOG = Gauge(
+    "narezka_admission_backlog_seconds",
+    "Ожидаемая работа принятых и не завершённых заданий",
+    ["pool"],
+    multiprocess_mode="livemax"
+)
+MODEL_MEMORY = Gauge(
+    "narezka_model_memory_bytes",
+    "Память параметров загруженных моделей",
+    ["model"],
+    multiprocess_mode="livesum"
+)
+
+
+class Span:
+    """
+    Замер этапа: время выполнения (с признаком ошибки) и realtime factor,
+    если известна длительность обработанного медиа. media_seconds можно
+    задать и внутри блока, когда она становится известна.
+
+        with Span("transcribe", media_seconds=duration):
+            ...
+    """
+
+    def __init__(self, stage: str, media_seconds: Optional[float] = None):
+        self.stage = stage
+        self.media_seconds = media_seconds
+        self.duration = 0.0
+        self._start = 0.0
+
+    def __enter__(self) -> "Span":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._start
+        status = "error" if exc_type is not None else "ok"
+        STAGE_DURATION.labels(self.stage, status).observe(self.duration)
+
+        if exc_type is None and self.media_seconds:
+            MEDIA_SECONDS.labels(self.stage).inc(self.media_seconds)
+            if self.duration > 0:
+                STAGE_REALTIME_FACTOR.labels(self.stage).observe(self.media_seconds / self.duration)
+
+        logger.debug(
+            f"Этап {self.stage}: {self.duration:.2f} с"
+            + (f", медиа {self.media_seconds:.1f} с" if self.media_seconds else "")
+        )
+        return False
+
+
+def model_memory_bytes(model) -> int:
+    """Объём параметров и буферов модели torch"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def resident_memory_bytes() -> Optional[int]:
+    """Резидентная память процесса (Linux, /proc); None — недоступно"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _registry():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Текст метрик для /metrics в формате Prometheus"""
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: int):
+    """HTTP-сервер метрик для процессов без FastAPI (воркеры Celery)"""
+    start_http_server(port, registry=_registry())
+    logger.info(f"Метрики Prometheus доступны на порту {port}")
+
+
+def mark_process_dead(pid: int):
+    """Удаление live-метрик завершившегося процесса (для multiprocess режима)"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
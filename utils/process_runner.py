@@ -0,0 +1,157 @@
+import asyncio
+import os
+import inspect
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Optional, Union
+
+from utils.exceptions import ProcessExecutionError, ProcessTimeoutError
+from utils.metrics import FFMPEG_ACTIVE
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних строк stderr сохраняем для сообщения об ошибке
+STDERR_TAIL_LINES = 50
+READ_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass
+class ProcessResult:
+    returncode: int
+    stdout: bytes
+    stderr: str
+
+
+class ProcessRunner:
+    """
+    Асинхронный запуск внешних процессов (ffmpeg/ffprobe) без блокировки event loop.
+    Ограничивает число одновременно работающих процессов, поддерживает таймауты
+    и отмену, а stderr читает потоково, а не буферизует целиком.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        default_timeout: Optional[float] = None
+    ):
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("FFMPEG_MAX_CONCURRENCY", os.cpu_count() or 2))
+        if default_timeout is None:
+            timeout_env = os.getenv("FFMPEG_TIMEOUT")
+            default_timeout = float(timeout_env) if timeout_env else None
+
+        self.max_concurrency = max(1, max_concurrency)
+        self.default_timeout = default_timeout
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.active = 0
+
+    async def run(
+        self,
+        cmd: List[str],
+        timeout: Optional[float] = None,
+        capture_stdout: bool = True,
+        stderr_callback: Optional[Callable[[str], None]] = None,
+        stdout_callback: Optional[Callable[[bytes], Union[None, Awaitable[None]]]] = None,
+        check: bool = False
+    ) -> ProcessResult:
+        """
+        Запуск команды. При таймауте или отмене процесс принудительно завершается.
+        Если задан stdout_callback, stdout передаётся ему по частям и не буферизуется;
+        callback может быть асинхронным.
+        """
+        timeout = timeout if timeout is not None else self.default_timeout
+
+        async with self._semaphore:
+            logger.debug(f"Запуск процесса: {' '.join(cmd)}")
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=(
+                    asyncio.subprocess.PIPE
+                    if capture_stdout or stdout_callback is not None
+                    else asyncio.subprocess.DEVNULL
+                ),
+                stderr=asyncio.subprocess.PIPE
+            )
+            self.active += 1
+            FFMPEG_ACTIVE.inc()
+
+            stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+            stdout_chunks = []
+
+            async def read_stdout():
+                if process.stdout is None:
+                    return
+                while True:
+                    chunk = await process.stdout.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if stdout_callback is not None:
+                        # Асинхронный приёмник ожидается: так он не отстаёт от ffmpeg
+                        result = stdout_callback(chunk)
+                        if inspect.isawaitable(result):
+                            await result
+                    else:
+                        stdout_chunks.append(chunk)
+
+            async def read_stderr():
+                async for line in self._iter_lines(process.stderr):
+                    stderr_tail.append(line)
+                    if stderr_callback is not None:
+                        stderr_callback(line)
+
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(read_stdout(), read_stderr(), process.wait()),
+                    timeout=timeout
+                )
+            except asyncio.TimeoutError:
+                await self._kill(process)
+                raise ProcessTimeoutError(
+                    f"Процесс {cmd[0]} превысил таймаут {timeout} с"
+                )
+            except asyncio.CancelledError:
+                await self._kill(process)
+                raise
+            finally:
+                self.active -= 1
+                FFMPEG_ACTIVE.dec()
+
+        result = ProcessResult(
+            returncode=process.returncode,
+            stdout=b"".join(stdout_chunks),
+            stderr="\n".join(stderr_tail)
+        )
+
+        if check and result.returncode != 0:
+            raise ProcessExecutionError(
+                f"{cmd[0]} завершился с кодом {result.returncode}: {result.stderr}"
+            )
+
+        return result
+
+    async def _iter_lines(self, stream: asyncio.StreamReader):
+        """Построчное чтение потока; ffmpeg разделяет строки прогресса символом \\r"""
+        buffer = b""
+        while True:
+            chunk = await stream.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer += chunk.replace(b"\r", b"\n")
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line:
+                    yield line.decode("utf-8", errors="replace")
+        if buffer:
+            yield buffer.decode("utf-8", errors="replace")
+
+    async def _kill(self, process: asyncio.subprocess.Process):
+        if process.returncode is None:
+            logger.warning(f"Принудительное завершение процесса {process.pid}")
+            process.kill()
+            await process.wait()
+
+
+# Общий экземпляр для всех сервисов процесса
+process_runner = ProcessRunner()
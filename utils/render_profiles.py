@@ -0,0 +1,82 @@
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class RenderProfile:
+    """Параметры кодирования клипов"""
+    name: str
+    width: int
+    height: int
+    preset: str
+    crf: int
+    audio_bitrate: str
+    maxrate: Optional[str] = None
+    bufsize: Optional[str] = None
+    # Черновой профиль: субтитры и скачанные фрагменты сохраняются,
+    # чтобы потом перерендерить клипы в чистовом качестве без повторной работы
+    keep_intermediates: bool = False
+    # Относительная стоимость кодирования секунды клипа (для приёма заданий)
+    cost_factor: float = 1.0
+
+    def encoder_args(self, threads: int) -> List[str]:
+        args = [
+            '-c:v', 'libx264',
+            '-preset', self.preset,
+            '-crf', str(self.crf),
+        ]
+        if self.maxrate:
+            args += ['-maxrate', self.maxrate, '-bufsize', self.bufsize or self.maxrate]
+        return args + [
+            '-threads', str(threads),
+            '-c:a', 'aac',
+            '-b:a', self.audio_bitrate,
+        ]
+
+
+RENDER_PROFILES: Dict[str, RenderProfile] = {
+    # Быстрая проверка точек реза: в разы быстрее standard
+    "preview": RenderProfile(
+        name="preview",
+        width=540,
+        height=960,
+        preset="ultrafast",
+        crf=30,
+        audio_bitrate="64k",
+        maxrate="1M",
+        bufsize="2M",
+        keep_intermediates=True,
+        cost_factor=0.3
+    ),
+    # Прежние настройки по умолчанию
+    "standard": RenderProfile(
+        name="standard",
+        width=1080,
+        height=1920,
+        preset="medium",
+        crf=23,
+        audio_bitrate="128k"
+    ),
+    "final": RenderProfile(
+        name="final",
+        width=1080,
+        height=1920,
+        preset="slow",
+        crf=20,
+        audio_bitrate="192k",
+        cost_factor=2.5
+    ),
+}
+
+DEFAULT_RENDER_PROFILE = os.getenv("RENDER_PROFILE_DEFAULT", "standard")
+
+
+def get_render_profile(name: Optional[str] = None) -> RenderProfile:
+    name = name or DEFAULT_RENDER_PROFILE
+    if name not in RENDER_PROFILES:
+        raise ValueError(
+            f"Неизвестный профиль рендеринга: {name}. "
+            f"Доступны: {', '.join(RENDER_PROFILES)}"
+        )
+    return RENDER_PROFILES[name]
@@ -0,0 +1,85 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionCache:
+    """
+    Дисковый кэш результатов транскрипции. Ключ — отпечаток аудио плюс
+    настройки модели, значение — JSON, сжатый zlib. Объём ограничен
+    max_bytes, вытесняются давно не читавшиеся записи (по mtime).
+    """
+
+    SUFFIX = ".json.z"
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def make_key(fingerprint: str, settings: Dict) -> str:
+        settings_json = json.dumps(settings, sort_keys=True)
+        return hashlib.blake2b(
+            f"{fingerprint}:{settings_json}".encode(), digest_size=20
+        ).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            result = json.loads(zlib.decompress(data))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Повреждённая запись кэша транскрипций {key}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+
+        # Обновляем mtime — это порядок LRU для вытеснения
+        os.utime(path)
+        return result
+
+    def put(self, key: str, result: Dict):
+        data = zlib.compress(
+            json.dumps(result, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            level=6
+        )
+        path = self._path(key)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        logger.info(f"Транскрипция сохранена в кэш: {key} ({len(data)} байт)")
+        self._evict()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{self.SUFFIX}"
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob(f"*{self.SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            logger.info(f"Кэш транскрипций: вытеснен {path.name}")
@@ -0,0 +1,159 @@
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class TranscriptionStore:
+    """
+    Компактное колоночное представление транскрипции: тайминги и уверенность
+    в массивах NumPy, тексты слов — индексы в общей таблице уникальных слов.
+    Слова сегмента i лежат в диапазоне word_offsets[i]:word_offsets[i + 1].
+    Поиск по времени — двоичный, O(log n + k).
+    """
+
+    __slots__ = (
+        "segment_start", "segment_end", "segment_end_max", "segment_confidence",
+        "segment_text", "word_offsets", "word_start", "word_end", "word_probability",
+        "word_ids", "vocabulary", "extra"
+    )
+
+    # Поля верхнего уровня, которые хранятся в массивах, а не в extra
+    _CORE_KEYS = ("segments",)
+
+    def __init__(
+        self,
+        segment_start: np.ndarray,
+        segment_end: np.ndarray,
+        segment_confidence: np.ndarray,
+        segment_text: List[str],
+        word_offsets: np.ndarray,
+        word_start: np.ndarray,
+        word_end: np.ndarray,
+        word_probability: np.ndarray,
+        word_ids: np.ndarray,
+        vocabulary: List[str],
+        extra: Dict
+    ):
+        self.segment_start = segment_start
+        self.segment_end = segment_end
+        # Нарастающий максимум концов: монотонен, поэтому по нему можно искать двоичным поиском
+        self.segment_end_max = np.maximum.accumulate(segment_end) if len(segment_end) else segment_end
+        self.segment_confidence = segment_confidence
+        self.segment_text = segment_text
+        self.word_offsets = word_offsets
+        self.word_start = word_start
+        self.word_end = word_end
+        self.word_probability = word_probability
+        self.word_ids = word_ids
+        self.vocabulary = vocabulary
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, transcription: Dict) -> "TranscriptionStore":
+        """Построение из словаря формата AudioTranscriber.transcribe"""
+        segments = sorted(transcription.get("segments", []), key=lambda s: s["start"])
+
+        vocabulary: List[str] = []
+        word_index: Dict[str, int] = {}
+        word_offsets = [0]
+        word_start, word_end, word_probability, word_ids = [], [], [], []
+
+        for segment in segments:
+            for word in segment.get("words", []):
+                text = word.get("word", "")
+                word_id = word_index.get(text)
+                if word_id is None:
+                    word_id = word_index[text] = len(vocabulary)
+                    vocabulary.append(text)
+                word_ids.append(word_id)
+                word_start.append(word.get("start", 0))
+                word_end.append(word.get("end", 0))
+                word_probability.append(word.get("probability", 0))
+            word_offsets.append(len(word_ids))
+
+        return cls(
+            segment_start=np.array([s["start"] for s in segments], dtype=np.float64),
+            segment_end=np.array([s["end"] for s in segments], dtype=np.float64),
+            segment_confidence=np.array([s.get("confidence", 0) for s in segments], dtype=np.float64),
+            segment_text=[s.get("text", "") for s in segments],
+            word_offsets=np.array(word_offsets, dtype=np.int64),
+            word_start=np.array(word_start, dtype=np.float64),
+            word_end=np.array(word_end, dtype=np.float64),
+            word_probability=np.array(word_probability, dtype=np.float64),
+            word_ids=np.array(word_ids, dtype=np.int32),
+            vocabulary=vocabulary,
+            extra={k: v for k, v in transcription.items() if k not in cls._CORE_KEYS}
+        )
+
+    @classmethod
+    def ensure(cls, transcription: Union[Dict, "TranscriptionStore"]) -> "TranscriptionStore":
+        if isinstance(transcription, cls):
+            return transcription
+        return cls.from_dict(transcription)
+
+    def __len__(self) -> int:
+        return len(self.segment_start)
+
+    @property
+    def word_count(self) -> int:
+        return len(self.word_ids)
+
+    def segment_range(self, start_time: float, end_time: float) -> Tuple[int, int]:
+        """
+        Границы [lo, hi) индексов-кандидатов на пересечение с интервалом:
+        у сегментов до lo конец не позже start_time, после hi начало не раньше end_time
+        """
+        lo = int(np.searchsorted(self.segment_end_max, start_time, side="right"))
+        hi = int(np.searchsorted(self.segment_start, end_time, side="left"))
+        return lo, max(lo, hi)
+
+    def segments_in_range(self, start_time: float, end_time: float) -> Iterator[int]:
+        """Индексы сегментов, пересекающихся с [start_time, end_time]"""
+        lo, hi = self.segment_range(start_time, end_time)
+        for index in range(lo, hi):
+            if self.segment_end[index] > start_time and self.segment_start[index] < end_time:
+                yield index
+
+    def window(self, start_time: Optional[float] = None, end_time: Optional[float] = None) -> np.ndarray:
+        """Индексы сегментов, пересекающихся с окном; границы окна необязательны"""
+        start_time = -np.inf if start_time is None else start_time
+        end_time = np.inf if end_time is None else end_time
+        lo, hi = self.segment_range(start_time, end_time)
+        index = np.arange(lo, hi)
+        mask = (self.segment_end[lo:hi] > start_time) & (self.segment_start[lo:hi] < end_time)
+        return index[mask]
+
+    def segment_words(self, index: int) -> Tuple[int, int]:
+        return int(self.word_offsets[index]), int(self.word_offsets[index + 1])
+
+    def word_text(self, word_index: int) -> str:
+        return self.vocabulary[self.word_ids[word_index]]
+
+    def segment_dict(self, index: int, words: bool = True) -> Dict:
+        segment = {
+            "start": float(self.segment_start[index]),
+            "end": float(self.segment_end[index]),
+            "text": self.segment_text[index],
+            "confidence": float(self.segment_confidence[index])
+        }
+        if not words:
+            return segment
+        first, last = self.segment_words(index)
+        return {
+            **segment,
+            "words": [
+                {
+                    "word": self.word_text(w),
+                    "start": float(self.word_start[w]),
+                    "end": float(self.word_end[w]),
+                    "probability": float(self.word_probability[w])
+                }
+                for w in range(first, last)
+            ]
+        }
+
+    def to_dict(self) -> Dict:
+        """Обратное преобразование в исходный словарный формат (для API)"""
+        result = dict(self.extra)
+        result["segments"] = [self.segment_dict(i) for i in range(len(self))]
+        return result
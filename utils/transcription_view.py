@@ -0,0 +1,167 @@
+import gzip
+import json
+import base64
+import hashlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from utils.transcription_store import TranscriptionStore
+
+try:
+    import msgpack
+except ImportError:
+    # Необязательная зависимость: без неё msgpack просто не предлагается клиентам
+    msgpack = None
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+MSGPACK = "application/msgpack"
+
+# Тайминги Whisper кратны 20 мс: миллисекунд достаточно, а ответ заметно короче
+TIME_PRECISION = 3
+# Меньшие ответы не сжимаются: gzip не окупается
+GZIP_MIN_BYTES = 1024
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """Формат ответа по заголовку Accept; по умолчанию JSON"""
+    offered = [JSON, NDJSON] + ([MSGPACK, "application/x-msgpack"] if msgpack else [])
+    best, best_quality = JSON, 0.0
+    for item in (accept or "").split(","):
+        media_type, _, params = item.strip().partition(";")
+        media_type = media_type.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in offered and quality > best_quality:
+            best = MSGPACK if "msgpack" in media_type else media_type
+            best_quality = quality
+    return best
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.strip().partition(";")
+        if coding.strip().lower() == "gzip":
+            return params.replace(" ", "") != "q=0"
+    return False
+
+
+def make_etag(version: str, *parts) -> str:
+    """
+    Слабый ETag представления: версия транскрипции (неизменна после
+    завершения задачи) и параметры запроса, от которых зависит ответ
+    """
+    digest = hashlib.sha1(json.dumps([version, *parts]).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Слабое сравнение: префикс W/ не учитывается
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def _tag(*parts) -> str:
+    return hashlib.sha1(json.dumps(parts).encode()).hexdigest()[:8]
+
+
+def encode_cursor(offset: int, version: str, window: Tuple) -> str:
+    """
+    Курсор следующей страницы: позиция в последовательности сегментов окна,
+    привязанная к версии транскрипции и параметрам окна (start, end, detail)
+    """
+    raw = json.dumps(
+        {"o": offset, "v": _tag(version), "w": _tag(*window)}, separators=(",", ":")
+    ).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, version: str, window: Tuple) -> int:
+    """
+    Позиция в окне по курсору. Курсор от другой версии транскрипции или
+    от другого окна (start, end, detail) — 400: иначе клиент молча получил
+    бы страницы другой последовательности
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded))
+        offset, cursor_version, cursor_window = int(data["o"]), data["v"], data["w"]
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Некорректный курсор")
+    if cursor_version != _tag(version) or offset < 0:
+        raise HTTPException(status_code=400, detail="Курсор устарел, запросите первую страницу")
+    if cursor_window != _tag(*window):
+        raise HTTPException(
+            status_code=400,
+            detail="Курсор выдан для других start, end или detail"
+        )
+    return offset
+
+
+def select_page(
+    store: TranscriptionStore,
+    start_time: Optional[float],
+    end_time: Optional[float],
+    offset: int,
+    limit: Optional[int]
+) -> Tuple[List[int], Optional[int]]:
+    """Индексы сегментов страницы и позиция следующей страницы (None — последняя)"""
+    indices = store.window(start_time, end_time)
+    stop = len(indices) if limit is None else min(len(indices), offset + limit)
+    page = indices[offset:stop].tolist()
+    return page, stop if stop < len(indices) else None
+
+
+def _round(segment: Dict) -> Dict:
+    segment["start"] = round(segment["start"], TIME_PRECISION)
+    segment["end"] = round(segment["end"], TIME_PRECISION)
+    for word in segment.get("words", ()):
+        word["start"] = round(word["start"], TIME_PRECISION)
+        word["end"] = round(word["end"], TIME_PRECISION)
+    return segment
+
+
+def page_segments(
+    store: TranscriptionStore,
+    indices: Iterable[int],
+    words: bool,
+    round_times: bool = True
+) -> List[Dict]:
+    segments = (store.segment_dict(i, words=words) for i in indices)
+    if round_times:
+        return [_round(segment) for segment in segments]
+    return list(segments)
+
+
+def encode_page(media_type: str, header: Dict, segments: List[Dict]) -> bytes:
+    """
+    Кодирование страницы. JSON и msgpack — один документ с полем segments;
+    NDJSON — первая строка с полями страницы, далее по сегменту на строку
+    """
+    if media_type == NDJSON:
+        lines = [header] + segments
+        return "".join(
+            json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n" for line in lines
+        ).encode("utf-8")
+    document = dict(header, segments=segments)
+    if media_type == MSGPACK:
+        return msgpack.packb(document, use_bin_type=True)
+    return json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def maybe_gzip(body: bytes, headers: Dict, enabled: bool) -> bytes:
+    if not enabled or len(body) < GZIP_MIN_BYTES:
+        return body
+    headers["Content-Encoding"] = "gzip"
+    return gzip.compress(body, compresslevel=5)
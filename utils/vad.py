@@ -0,0 +1,167 @@
+from bisect import bisect_left, bisect_right
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.audio import SAMPLE_RATE, AudioSource, num_samples, read_range
+
+# Размер блока чтения WAV при подсчёте признаков, кратен размеру кадра
+BLOCK_SECONDS = 60
+
+
+def frame_features(audio: np.ndarray, frame_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Энергия кадра в дБ и доля переходов через ноль (ZCR) по неперекрывающимся кадрам
+    """
+    frame_count = len(audio) // frame_size
+    if frame_count == 0:
+        empty = np.zeros(0, dtype=np.float32)
+        return empty, empty
+    frames = audio[:frame_count * frame_size].reshape(frame_count, frame_size)
+    energy = np.mean(frames * frames, axis=1)
+    energy_db = 10.0 * np.log10(energy + 1e-10)
+    signs = np.signbit(frames)
+    zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / frame_size
+    return energy_db.astype(np.float32), zcr.astype(np.float32)
+
+
+def source_frame_features(audio: AudioSource, frame_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Признаки по всей записи, читаемой блоками, чтобы не держать весь PCM в памяти"""
+    total_samples = num_samples(audio)
+    block_samples = (BLOCK_SECONDS * SAMPLE_RATE // frame_size) * frame_size
+    energies, zcrs = [], []
+    for start in range(0, total_samples, block_samples):
+        block = read_range(audio, start, start + block_samples)
+        energy_db, zcr = frame_features(block, frame_size)
+        energies.append(energy_db)
+        zcrs.append(zcr)
+    if not energies:
+        empty = np.zeros(0, dtype=np.float32)
+        return empty, empty
+    return np.concatenate(energies), np.concatenate(zcrs)
+
+
+def hysteresis_mask(
+    energy_db: np.ndarray,
+    zcr: np.ndarray,
+    high_db: float,
+    low_db: float,
+    zcr_max: float
+) -> np.ndarray:
+    """
+    Маска речевых кадров с гистерезисом: участок начинается с кадра выше
+    верхнего порога (с допустимым ZCR) и продолжается, пока энергия выше нижнего.
+    Пороги отсчитываются от уровня шума (10-й перцентиль энергии).
+    """
+    if len(energy_db) == 0:
+        return np.zeros(0, dtype=bool)
+
+    noise_floor = np.percentile(energy_db, 10)
+    trigger = (energy_db > noise_floor + high_db) & (zcr < zcr_max)
+    sustain = energy_db > noise_floor + low_db
+
+    # Нумерация непрерывных участков sustain; оставляем те, где есть trigger
+    run_starts = sustain & ~np.concatenate(([False], sustain[:-1]))
+    run_ids = np.cumsum(run_starts) * sustain
+    run_count = int(run_ids.max())
+    if run_count == 0:
+        return np.zeros(len(energy_db), dtype=bool)
+    has_trigger = np.zeros(run_count + 1, dtype=bool)
+    has_trigger[run_ids[trigger & sustain]] = True
+    has_trigger[0] = False
+    return has_trigger[run_ids]
+
+
+def mask_to_regions(
+    mask: np.ndarray,
+    frame_size: int,
+    total_samples: int,
+    min_speech_seconds: float,
+    padding_seconds: float,
+    merge_gap_seconds: float
+) -> List[Tuple[int, int]]:
+    """Перевод маски кадров в интервалы сэмплов с отступами и склейкой близких участков"""
+    if not mask.any():
+        return []
+
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1) * frame_size
+    ends = np.flatnonzero(edges == -1) * frame_size
+
+    keep = (ends - starts) >= int(min_speech_seconds * SAMPLE_RATE)
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return []
+
+    padding = int(padding_seconds * SAMPLE_RATE)
+    starts = np.maximum(0, starts - padding)
+    ends = np.minimum(total_samples, ends + padding)
+
+    # Склейка участков, разделённых короткими паузами
+    merge_gap = int(merge_gap_seconds * SAMPLE_RATE)
+    gaps = starts[1:] - ends[:-1]
+    new_group = np.concatenate(([True], gaps > merge_gap))
+    group_ids = np.cumsum(new_group) - 1
+    merged_starts = starts[new_group]
+    merged_ends = np.zeros(len(merged_starts), dtype=ends.dtype)
+    np.maximum.at(merged_ends, group_ids, ends)
+
+    return [(int(s), int(e)) for s, e in zip(merged_starts, merged_ends)]
+
+
+def detect_speech_regions(
+    audio: AudioSource,
+    frame_seconds: float = 0.03,
+    high_db: float = 12.0,
+    low_db: float = 6.0,
+    zcr_max: float = 0.35,
+    min_speech_seconds: float = 0.25,
+    padding_seconds: float = 0.3,
+    merge_gap_seconds: float = 1.0
+) -> List[Tuple[int, int]]:
+    """
+    Энергетический VAD по 16 кГц записи. Возвращает интервалы речи в сэмплах.
+    """
+    frame_size = max(1, int(frame_seconds * SAMPLE_RATE))
+    energy_db, zcr = source_frame_features(audio, frame_size)
+    mask = hysteresis_mask(energy_db, zcr, high_db, low_db, zcr_max)
+    return mask_to_regions(
+        mask,
+        frame_size,
+        num_samples(audio),
+        min_speech_seconds,
+        padding_seconds,
+        merge_gap_seconds
+    )
+
+
+class SpeechTimeline:
+    """
+    Отображение времени в склеенном из речевых участков аудио обратно
+    на исходную шкалу записи
+    """
+
+    def __init__(self, regions: List[Tuple[int, int]]):
+        self.regions = regions
+        self.compact_starts = []
+        position = 0
+        for start, end in regions:
+            self.compact_starts.append(position)
+            position += end - start
+        self.compact_length = position
+
+    def to_original(self, seconds: float, is_end: bool = False) -> float:
+        """
+        Концы интервалов, попадающие ровно на стык участков, относятся к
+        предыдущему участку, а не к началу следующего
+        """
+        if not self.regions:
+            return seconds
+        sample = seconds * SAMPLE_RATE
+        if is_end:
+            index = bisect_left(self.compact_starts, sample) - 1
+        else:
+            index = bisect_right(self.compact_starts, sample) - 1
+        index = min(max(index, 0), len(self.regions) - 1)
+        original = self.regions[index][0] + (sample - self.compact_starts[index])
+        return min(original, self.regions[index][1]) / SAMPLE_RATE
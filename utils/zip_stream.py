@@ -0,0 +1,157 @@
+import struct
+import zlib
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
+
+# Размер блока чтения файлов при потоковой отдаче
+CHUNK_SIZE = 1024 * 1024
+
+# Граница, после которой нужны поля ZIP64
+_ZIP64_LIMIT = 0xFFFFFFFF
+_ZIP64_COUNT_LIMIT = 0xFFFF
+
+
+def file_crc32(path: str) -> int:
+    """CRC32 файла — нужен заголовку ZIP до отдачи самих данных"""
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def iter_file(path: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Чтение файла блоками в диапазоне [start, end] включительно"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def _dos_datetime(timestamp: float) -> Tuple[int, int]:
+    moment = datetime.fromtimestamp(timestamp)
+    if moment.year < 1980:
+        moment = datetime(1980, 1, 1)
+    dos_time = (moment.hour << 11) | (moment.minute << 5) | (moment.second // 2)
+    dos_date = ((moment.year - 1980) << 9) | (moment.month << 4) | moment.day
+    return dos_time, dos_date
+
+
+class ZipStreamWriter:
+    """
+    Потоковая сборка ZIP без сжатия (ZIP_STORED) и без архива на диске.
+    Размер и CRC32 каждого файла известны заранее, поэтому локальный заголовок
+    пишется сразу с правильными значениями, без дескриптора данных, а длина
+    всего архива вычисляется до отдачи первого байта.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self._entries: List[Tuple[bytes, int, int, int, int, int]] = []
+
+    def local_header(self, name: str, size: int, crc: int, mtime: float) -> bytes:
+        """Заголовок очередного файла; за ним должны идти ровно size байт данных"""
+        encoded_name = name.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(mtime)
+        zip64 = size >= _ZIP64_LIMIT
+        extra = struct.pack('<HHQQ', 0x0001, 16, size, size) if zip64 else b''
+        header = struct.pack(
+            '<IHHHHHIIIHH',
+            0x04034b50,
+            45 if zip64 else 20,
+            0x0800,  # имя в UTF-8
+            0,  # ZIP_STORED
+            dos_time,
+            dos_date,
+            crc,
+            _ZIP64_LIMIT if zip64 else size,
+            _ZIP64_LIMIT if zip64 else size,
+            len(encoded_name),
+            len(extra)
+        ) + encoded_name + extra
+
+        self._entries.append((encoded_name, size, crc, dos_time, dos_date, self.offset))
+        self.offset += len(header) + size
+        return header
+
+    def central_directory(self) -> bytes:
+        """Центральный каталог и конец архива — пишутся после всех файлов"""
+        records = []
+        for encoded_name, size, crc, dos_time, dos_date, offset in self._entries:
+            extra_fields = []
+            if size >= _ZIP64_LIMIT:
+                extra_fields += [size, size]
+            if offset >= _ZIP64_LIMIT:
+                extra_fields.append(offset)
+            extra = (
+                struct.pack('<HH', 0x0001, 8 * len(extra_fields))
+                + struct.pack(f'<{len(extra_fields)}Q', *extra_fields)
+            ) if extra_fields else b''
+            version = 45 if extra_fields else 20
+            records.append(struct.pack(
+                '<IHHHHHHIIIHHHHHII',
+                0x02014b50,
+                (3 << 8) | version,  # создан в Unix
+                version,
+                0x0800,
+                0,
+                dos_time,
+                dos_date,
+                crc,
+                _ZIP64_LIMIT if size >= _ZIP64_LIMIT else size,
+                _ZIP64_LIMIT if size >= _ZIP64_LIMIT else size,
+                len(encoded_name),
+                len(extra),
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                _ZIP64_LIMIT if offset >= _ZIP64_LIMIT else offset
+            ) + encoded_name + extra)
+
+        directory = b''.join(records)
+        directory_offset = self.offset
+        count = len(self._entries)
+
+        tail = b''
+        if (
+            count >= _ZIP64_COUNT_LIMIT
+            or directory_offset >= _ZIP64_LIMIT
+            or len(directory) >= _ZIP64_LIMIT
+        ):
+            zip64_end_offset = directory_offset + len(directory)
+            tail += struct.pack(
+                '<IQHHIIQQQQ',
+                0x06064b50, 44, 45, 45, 0, 0,
+                count, count, len(directory), directory_offset
+            )
+            tail += struct.pack('<IIQI', 0x07064b50, 0, zip64_end_offset, 1)
+            count = min(count, _ZIP64_COUNT_LIMIT)
+            directory_offset = min(directory_offset, _ZIP64_LIMIT)
+
+        tail += struct.pack(
+            '<IHHHHIIH',
+            0x06054b50, 0, 0, count, count,
+            min(len(directory), _ZIP64_LIMIT), directory_offset, 0
+        )
+        self.offset += len(directory) + len(tail)
+        return directory + tail
+
+    @staticmethod
+    def archive_size(files: List[Tuple[str, int]]) -> int:
+        """Точный размер архива для Content-Length: files — (имя, размер)"""
+        writer = ZipStreamWriter()
+        for name, size in files:
+            writer.local_header(name, size, 0, 0)
+        writer.central_directory()
+        return writer.offset
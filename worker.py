@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from celery import Celery
+from celery.signals import worker_process_shutdown, worker_ready
+from dotenv import load_dotenv
+
+# Каталог метрик prefork-процессов должен существовать до создания метрик
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+from services.job_queue import JOB_ROUTES, celery_transport_options, execute_job, get_job_queue
+from utils.exceptions import StageBusy
+from utils.metrics import mark_process_dead, start_metrics_server
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+
+# Запуск воркера отдельной очереди, например:
+#   celery -A worker.celery worker -Q transcribe --concurrency=1
+celery = Celery("narezka", broker=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+celery.conf.update(
+    task_routes={f"jobs.{job}": {"queue": queue} for job, queue in JOB_ROUTES.items()},
+    # Задания длинные: берём по одному и подтверждаем после выполнения
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    task_reject_on_worker_lost=True,
+    broker_transport_options=celery_transport_options(),
+)
+
+@worker_ready.connect
+def _start_metrics(**kwargs):
+    # Процессы prefork пишут метрики в PROMETHEUS_MULTIPROC_DIR, главный процесс их отдаёт
+    port = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+    if port:
+        start_metrics_server(port)
+
+
+@worker_process_shutdown.connect
+def _cleanup_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
+
+
+# Один event loop на процесс воркера: общие asyncio-примитивы сервисов
+# привязываются к нему и переиспользуются между заданиями
+_loop = None
+
+
+def _run(task, job: str, **kwargs):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    try:
+        _loop.run_until_complete(execute_job(job, kwargs, get_job_queue()))
+    except StageBusy as e:
+        # Этап держит другой воркер (или упавший, чей захват ещё не истёк):
+        # задание не подтверждается как выполненное, а повторяется позже
+        raise task.retry(
+            countdown=e.retry_after,
+            max_retries=None,
+            priority=(task.request.delivery_info or {}).get("priority")
+        )
+
+
+@celery.task(name="jobs.download", bind=True)
+def download(self, task_id: str, video_url: str):
+    _run(self, "download", task_id=task_id, video_url=video_url)
+
+
+@celery.task(name="jobs.transcribe", bind=True)
+def transcribe(self, task_id: str):
+    _run(self, "transcribe", task_id=task_id)
+
+
+@celery.task(name="jobs.render", bind=True)
+def render(
+    self,
+    highlight_task_id: str,
+    original_task_id: str,
+    highlights: list,
+    profile: str = None,
+    upgrade_from: str = None
+):
+    _run(
+        self,
+        "render",
+        highlight_task_id=highlight_task_id,
+        original_task_id=original_task_id,
+        highlights=highlights,
+        profile=profile,
+        upgrade_from=upgrade_from
+    )